@@ -0,0 +1,158 @@
+import os
+import queue
+import threading
+import time
+import numpy as np
+from concurrent.futures import Future
+from typing import Dict, List
+
+# Dynamic micro-batching for the embedding model
+EMBED_MAX_BATCH = int(os.environ.get("EMBED_MAX_BATCH", "64"))
+EMBED_MAX_WAIT_MS = float(os.environ.get("EMBED_MAX_WAIT_MS", "5"))
+
+# Length bucketing (ONNX backend; SentenceTransformer.encode already sorts by
+# length itself): texts are sorted by token count and run through the model
+# EMBED_BUCKET_SIZE at a time, so a forward pass is padded to the longest
+# text of similar-length neighbours instead of the longest text overall.
+# Texts longer than EMBED_MAX_TOKENS tokens (special tokens included) are
+# cut to their first EMBED_MAX_TOKENS tokens; the model's own limit still applies.
+EMBED_BUCKETING_ENABLED = os.environ.get("EMBED_BUCKETING", "1") != "0"
+EMBED_BUCKET_SIZE = int(os.environ.get("EMBED_BUCKET_SIZE", "32"))
+EMBED_MAX_TOKENS = int(os.environ.get("EMBED_MAX_TOKENS", "256"))
+
+def length_buckets(lengths, bucket_size: int = EMBED_BUCKET_SIZE, sort: bool = EMBED_BUCKETING_ENABLED) -> List[np.ndarray]:
+    """
+    Positions of the texts, split into forward passes of at most bucket_size.
+    With sort, positions are ordered by length first (stable, so ties keep
+    input order); callers write each bucket's vectors back to its positions.
+    """
+    positions = np.argsort(np.asarray(lengths), kind="stable") if sort else np.arange(len(lengths))
+    return [positions[start:start + bucket_size] for start in range(0, len(positions), bucket_size)]
+
+class PaddingStats:
+    """Real vs padded token counts of the forward passes the model has run"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {'batches': 0, 'texts': 0, 'tokens': 0, 'padded_tokens': 0, 'truncated_texts': 0}
+
+    def record(self, lengths, truncated: int = 0):
+        """lengths: token counts (after truncation) of one forward pass"""
+        if not len(lengths):
+            return
+        with self.lock:
+            self.counters['batches'] += 1
+            self.counters['texts'] += len(lengths)
+            self.counters['tokens'] += int(sum(lengths))
+            self.counters['padded_tokens'] += int(max(lengths)) * len(lengths)
+            self.counters['truncated_texts'] += truncated
+
+    def stats(self) -> Dict:
+        with self.lock:
+            stats = dict(self.counters)
+        # Share of the computed positions that were padding
+        stats['padding_ratio'] = (round(1 - stats['tokens'] / stats['padded_tokens'], 4)
+                                  if stats['padded_tokens'] else 0.0)
+        stats['bucketing'] = EMBED_BUCKETING_ENABLED
+        stats['bucket_size'] = EMBED_BUCKET_SIZE
+        stats['max_tokens'] = EMBED_MAX_TOKENS
+        return stats
+
+padding_stats = PaddingStats()
+
+def padding_ratio(lengths, bucket_size: int = EMBED_BUCKET_SIZE, sort: bool = EMBED_BUCKETING_ENABLED) -> float:
+    """Padding share the given token counts would get, without running the model"""
+    lengths = np.asarray(lengths)
+    padded = sum(int(lengths[bucket].max()) * len(bucket) for bucket in length_buckets(lengths, bucket_size, sort))
+    return round(1 - int(lengths.sum()) / padded, 4) if padded else 0.0
+
+class EmbedCoalescer:
+    """
+    Collects concurrent embed calls and runs them as one batched encode.
+
+    The first request to arrive opens a batch. The worker keeps taking requests
+    until the batch holds max_batch texts or max_wait_ms has passed since it
+    opened, runs a single inner.embed_texts over all of them and hands every
+    caller its own slice. Requests that are already max_batch texts or larger
+    skip the queue and run directly in the caller's thread.
+    """
+    name = "coalescing"
+
+    def __init__(self, inner, max_batch: int = EMBED_MAX_BATCH, max_wait_ms: float = EMBED_MAX_WAIT_MS):
+        self.inner = inner
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000.0
+        self.queue = queue.Queue()
+        self.worker = None
+        # Also guards the counters, which request threads and the worker both update
+        self.worker_lock = threading.Lock()
+        self.counters = {'requests': 0, 'batches': 0, 'texts': 0, 'direct_calls': 0}
+
+    def _ensure_worker(self):
+        if self.worker is None:
+            with self.worker_lock:
+                if self.worker is None:
+                    self.worker = threading.Thread(target=self._run, name="embed-coalescer", daemon=True)
+                    self.worker.start()
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        texts = list(texts)
+        if len(texts) >= self.max_batch:
+            with self.worker_lock:
+                self.counters['direct_calls'] += 1
+            return self.inner.embed_texts(texts)
+
+        self._ensure_worker()
+        future = Future()
+        self.queue.put((texts, future))
+        return future.result()
+
+    def embed_text(self, text: str) -> np.ndarray:
+        return self.embed_texts([text])[0]
+
+    def _collect(self):
+        """Block for the first request, then gather more until the batch is full or the wait expires"""
+        batch = [self.queue.get()]
+        count = len(batch[0][0])
+        deadline = time.monotonic() + self.max_wait
+        while count < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                item = self.queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(item)
+            count += len(item[0])
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            all_texts = [text for texts, _ in batch for text in texts]
+            try:
+                vectors = self.inner.embed_texts(all_texts)
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            with self.worker_lock:
+                self.counters['requests'] += len(batch)
+                self.counters['batches'] += 1
+                self.counters['texts'] += len(all_texts)
+
+            offset = 0
+            for texts, future in batch:
+                future.set_result(vectors[offset:offset + len(texts)])
+                offset += len(texts)
+
+    def stats(self) -> Dict:
+        with self.worker_lock:
+            stats = dict(self.counters)
+        stats['max_batch'] = self.max_batch
+        stats['max_wait_ms'] = self.max_wait * 1000.0
+        stats['avg_batch_size'] = round(stats['texts'] / stats['batches'], 2) if stats['batches'] else 0.0
+        stats['queued'] = self.queue.qsize()
+        return stats
@@ -0,0 +1,74 @@
+import json
+import sys
+import time
+from embedder import MODEL_NAME
+from batching import padding_ratio
+from onnx_backend import ONNX_INTRA_OP_THREADS, ONNX_MODEL_DIR, OnnxModel
+from corpus import DATA_FILES, load_texts
+
+def throughput(model, texts, batch_size, repeat, **options):
+    """texts per second of model.encode(texts), best of `repeat` runs after one warm-up batch"""
+    model.encode(texts[:batch_size], batch_size=batch_size, **options)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        model.encode(texts, batch_size=batch_size, **options)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(len(texts) / best, 1)
+
+def load_backends(model_dir=ONNX_MODEL_DIR):
+    """PyTorch and both ONNX variants; a backend that cannot load is reported with its error"""
+    def pytorch():
+        from sentence_transformers import SentenceTransformer
+        return SentenceTransformer(MODEL_NAME, device="cpu")
+
+    loaders = {
+        'pytorch': pytorch,
+        'onnx_fp32': lambda: OnnxModel(model_dir, "fp32"),
+        'onnx_int8': lambda: OnnxModel(model_dir, "int8"),
+    }
+    backends = {}
+    for name, loader in loaders.items():
+        try:
+            backends[name] = loader()
+        except Exception as e:
+            backends[name] = e
+    return backends
+
+def run_benchmark(pattern=DATA_FILES, limit=1000, batch_size=32, repeat=3, model_dir=ONNX_MODEL_DIR):
+    """
+    Embedding throughput of every backend on the dataFiles texts, with the
+    ONNX variants also run in input order (no length bucketing), and the
+    padding share of both batchings
+    """
+    texts = load_texts(pattern)[:limit]
+    report = {'texts': len(texts), 'batch_size': batch_size, 'onnx_intra_op_threads': ONNX_INTRA_OP_THREADS}
+    for name, model in load_backends(model_dir).items():
+        if isinstance(model, Exception):
+            report[f'{name}_error'] = str(model)
+            continue
+        if name == 'pytorch':
+            report[f'{name}_texts_per_sec'] = throughput(model, texts, batch_size, repeat)
+            continue
+        report[f'{name}_texts_per_sec'] = throughput(model, texts, batch_size, repeat, sort_by_length=True)
+        report[f'{name}_unbucketed_texts_per_sec'] = throughput(model, texts, batch_size, repeat,
+                                                                sort_by_length=False)
+        if 'padding_ratio_bucketed' not in report:
+            lengths = [len(encoding.ids) for encoding in model.tokenizer.encode_batch(texts)]
+            report['padding_ratio_bucketed'] = padding_ratio(lengths, batch_size, sort=True)
+            report['padding_ratio_unbucketed'] = padding_ratio(lengths, batch_size, sort=False)
+    if 'pytorch_texts_per_sec' in report:
+        for variant in ('onnx_fp32', 'onnx_int8'):
+            if f'{variant}_texts_per_sec' in report:
+                report[f'{variant}_speedup'] = round(
+                    report[f'{variant}_texts_per_sec'] / report['pytorch_texts_per_sec'], 2
+                )
+    return report
+
+# CLI interface
+if __name__ == "__main__":
+    # Usage: python bench_embedding.py [limit] [batch_size]  (export the model first)
+    limit = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    batch_size = int(sys.argv[2]) if len(sys.argv) > 2 else 32
+    print(json.dumps(run_benchmark(limit=limit, batch_size=batch_size), indent=2))
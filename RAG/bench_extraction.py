@@ -0,0 +1,37 @@
+import json
+import sys
+import time
+from extraction import extract_metadata, extract_metadata_batch, EXTRACT_WORKERS
+from corpus import DATA_FILES, load_texts
+from test_extraction import legacy_extract_metadata
+
+def throughput(function, texts, repeat):
+    """texts per second of function(texts), best of `repeat` runs"""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function(texts)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return round(len(texts) / best, 1)
+
+def run_benchmark(pattern=DATA_FILES, scale=20, repeat=3, workers=EXTRACT_WORKERS):
+    """Metadata extraction throughput on the dataFiles texts, repeated `scale` times"""
+    texts = load_texts(pattern) * scale
+    return {
+        'texts': len(texts),
+        'avg_chars': round(sum(map(len, texts)) / max(len(texts), 1), 1),
+        'legacy_texts_per_sec': throughput(lambda batch: [legacy_extract_metadata(t) for t in batch], texts, repeat),
+        'single_pass_texts_per_sec': throughput(lambda batch: [extract_metadata(t) for t in batch], texts, repeat),
+        'batch_pool_texts_per_sec': throughput(
+            lambda batch: extract_metadata_batch(batch, workers=workers, min_parallel=1), texts, repeat
+        ),
+        'workers': workers,
+    }
+
+# CLI interface
+if __name__ == "__main__":
+    # Usage: python bench_extraction.py ["../dataFiles/*.json"] [scale]  (quote the glob)
+    pattern = sys.argv[1] if len(sys.argv) > 1 else DATA_FILES
+    scale = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    print(json.dumps(run_benchmark(pattern, scale), indent=2))
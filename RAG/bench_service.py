@@ -0,0 +1,311 @@
+import json
+import os
+import re
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import zlib
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+from corpus import DATA_FILES, load_texts
+
+# Offline benchmark of the whole service stack (SQLite, extraction, FAISS,
+# search) on synthetic corpora built from the dataFiles texts. The embedding
+# model is replaced by StubEmbedder, so nothing is downloaded and runs are
+# reproducible. Each corpus size runs in a fresh interpreter with its own
+# temporary database and index files.
+#
+# Usage: python bench_service.py [--sizes 10000,100000] [--indexes "SQ8;IVF256,Flat;PQ48"]
+#            [--clients 8] [--queries 400] [--single 500] [--seed 0] [--out results.json]
+#            [--compare baseline.json] [--tolerance 0.2]
+
+DEFAULT_SIZES = [10000]
+DEFAULT_INDEXES = ["SQ8", "IVF256,Flat", "PQ48"]
+BULK_FILE_SIZE = 1000  # listings per safe_batch_insert_listings call, about one campus file
+
+_token = re.compile(r"\w+")
+_price = re.compile(r"\$\d[\d,]*")
+_rooms = re.compile(r"\b\d(?=\s*(?:bed|br|bath|ba)\b)", re.IGNORECASE)
+
+class StubEmbedder:
+    """
+    Deterministic stand-in for the sentence-transformers model: a text's
+    vector is the normalized sum of fixed random vectors of its words, so
+    texts sharing words end up close together, like real embeddings.
+    """
+    name = "stub"
+
+    def __init__(self, dim: int = 384, seed: int = 0):
+        self.dim = dim
+        self.seed = seed
+        self.rows = {}
+        self.table = np.empty((0, dim), dtype="float32")
+        self.lock = threading.Lock()
+
+    def _token_rows(self, tokens: List[str]) -> List[int]:
+        """Row of every token's vector in self.table, adding unseen tokens (lock held)"""
+        new = [token for token in dict.fromkeys(tokens) if token not in self.rows]
+        if new:
+            vectors = [np.random.default_rng([self.seed, zlib.crc32(token.encode())]).standard_normal(self.dim)
+                       for token in new]
+            for token in new:
+                self.rows[token] = len(self.rows)
+            self.table = np.vstack([self.table, np.asarray(vectors, dtype="float32")])
+        return [self.rows[token] for token in tokens]
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        tokens = [_token.findall(text.lower()) or ["<empty>"] for text in texts]
+        with self.lock:
+            rows = self._token_rows([token for words in tokens for token in words])
+            table = self.table
+        starts = np.cumsum([0] + [len(words) for words in tokens[:-1]])
+        vectors = np.add.reduceat(table[rows], starts, axis=0) if rows else np.empty((0, self.dim))
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        return np.ascontiguousarray(vectors, dtype="float32")
+
+    def embed_text(self, text: str) -> np.ndarray:
+        return self.embed_texts([text])[0]
+
+def synthetic_corpus(n: int, seed: int = 0, pattern: str = DATA_FILES) -> List[Dict]:
+    """
+    n listings derived from the real posts: prices and room counts are
+    redrawn, and a random sentence of another post is appended, so the
+    texts stay realistic but do not repeat
+    """
+    texts = load_texts(pattern)
+    sentences = [sentence.strip() for text in texts for sentence in re.split(r"[.!\n]", text) if sentence.strip()]
+    rng = np.random.default_rng(seed)
+    listings = []
+    for position in range(n):
+        text = texts[rng.integers(len(texts))]
+        text = _price.sub(lambda _: f"${int(rng.integers(400, 2500))}", text)
+        text = _rooms.sub(lambda _: str(int(rng.integers(1, 5))), text)
+        text = f"{text} {sentences[rng.integers(len(sentences))]} #{position}"
+        listings.append({"text": text, "user_id": str(position), "user_name": f"user {position % 997}"})
+    return listings
+
+def synthetic_queries(listings: List[Dict], n: int, seed: int = 1) -> List[Dict]:
+    """Short phrases taken from stored listings, about a third of them with filters"""
+    rng = np.random.default_rng(seed)
+    queries = []
+    for _ in range(n):
+        words = _token.findall(listings[rng.integers(len(listings))]["text"])
+        start = int(rng.integers(max(len(words) - 6, 1)))
+        query = {"query": " ".join(words[start:start + int(rng.integers(3, 7))]) or "room", "top_k": 10}
+        roll = rng.random()
+        if roll < 0.2:
+            query["max_price"] = int(rng.integers(600, 2000))
+        elif roll < 0.33:
+            query["min_beds"] = int(rng.integers(1, 4))
+        queries.append(query)
+    return queries
+
+def percentiles(latencies: List[float]) -> Dict:
+    values = np.asarray(latencies) * 1000
+    return {
+        'p50_ms': round(float(np.percentile(values, 50)), 3),
+        'p90_ms': round(float(np.percentile(values, 90)), 3),
+        'p99_ms': round(float(np.percentile(values, 99)), 3),
+        'mean_ms': round(float(values.mean()), 3),
+    }
+
+def rss_bytes() -> int:
+    """Peak resident memory of this process"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+def measure_inserts(listings: List[Dict], single: int) -> Dict:
+    """Listings/sec through insert_listing (one at a time) and safe_batch_insert_listings (per file)"""
+    from db import get_pool
+    from insertion import insert_listing
+    from safeInsertion import safe_batch_insert_listings
+
+    report = {}
+    with get_pool().connection() as conn:
+        start = time.perf_counter()
+        for listing in listings[:single]:
+            insert_listing(conn, listing["text"], listing["user_id"], listing["user_name"])
+        elapsed = time.perf_counter() - start
+        report['single'] = {'listings': single, 'seconds': round(elapsed, 3),
+                            'listings_per_sec': round(single / elapsed, 1) if elapsed else None}
+
+        bulk = listings[single:]
+        start = time.perf_counter()
+        for offset in range(0, len(bulk), BULK_FILE_SIZE):
+            safe_batch_insert_listings(conn, bulk[offset:offset + BULK_FILE_SIZE])
+        elapsed = time.perf_counter() - start
+        report['bulk'] = {'listings': len(bulk), 'file_size': BULK_FILE_SIZE, 'seconds': round(elapsed, 3),
+                          'listings_per_sec': round(len(bulk) / elapsed, 1) if elapsed else None}
+    return report
+
+def measure_search(queries: List[Dict], clients: int, mode: str = "vector") -> Dict:
+    """Latency percentiles and throughput of search() with `clients` concurrent callers"""
+    from db import get_pool
+    from search import search
+
+    def run(query):
+        with get_pool().connection() as conn:
+            start = time.perf_counter()
+            search(conn, query["query"], query.get("max_price"), query.get("min_beds"), query["top_k"],
+                   mode=mode)
+            return time.perf_counter() - start
+
+    # One untimed pass per client warms the connections and the metadata mirror
+    with ThreadPoolExecutor(max_workers=clients) as executor:
+        list(executor.map(run, queries[:clients]))
+        start = time.perf_counter()
+        latencies = list(executor.map(run, queries))
+        elapsed = time.perf_counter() - start
+    report = percentiles(latencies)
+    report.update({'mode': mode, 'clients': clients, 'queries': len(queries),
+                   'queries_per_sec': round(len(queries) / elapsed, 1)})
+    return report
+
+def run_size(size: int, indexes: List[str], clients: int, n_queries: int, single: int, seed: int) -> Dict:
+    """One corpus size, inside a fresh interpreter whose cwd is a scratch directory"""
+    import embedder
+    import insertion
+    from db import DB_PATH
+    from index_factory import describe_index, index_memory_bytes
+    from index_tools import compress_index
+
+    embedder.set_embedder(StubEmbedder())
+    listings = synthetic_corpus(size, seed)
+    queries = synthetic_queries(listings, n_queries, seed + 1)
+    report = {'size': size, 'avg_chars': round(sum(len(listing["text"]) for listing in listings) / size, 1)}
+
+    rss_before = rss_bytes()
+    report['insert'] = measure_inserts(listings, min(single, size))
+    holder = insertion.get_index_holder()
+    with holder.read() as index:
+        report['memory'] = {
+            'index': describe_index(index),
+            'index_bytes_per_vector': round(index_memory_bytes(index) / max(index.ntotal, 1), 1),
+            'process_bytes_per_listing': round((rss_bytes() - rss_before) / size, 1),
+        }
+    report['search'] = {'Flat': {mode: measure_search(queries, clients, mode) for mode in ("vector", "hybrid")}}
+
+    # Non-exact indexes: trained on the stored vectors, installed the way an
+    # operator would, and picked up by the running holder
+    report['indexes'] = {}
+    for factory in indexes:
+        compression = compress_index(DB_PATH, insertion.index_file, factory)
+        holder.refresh(force=True)
+        report['indexes'][factory] = {
+            'memory': compression['memory'],
+            'recall': compression['evaluation'],
+            'recall_reranked': compression['evaluation_reranked'],
+            'search': measure_search(queries, clients, "vector"),
+        }
+        # Back to the exact index for the next candidate
+        compress_index(DB_PATH, insertion.index_file, "Flat")
+        holder.refresh(force=True)
+    return report
+
+def run_in_subprocess(size: int, indexes: List[str], clients: int, n_queries: int, single: int, seed: int) -> Dict:
+    """run_size in a fresh interpreter, in a scratch directory with service settings fit for measuring"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    config = json.dumps({'size': size, 'indexes': indexes, 'clients': clients, 'n_queries': n_queries,
+                         'single': single, 'seed': seed})
+    env = dict(os.environ,
+               PYTHONPATH=os.pathsep.join(filter(None, [here, os.environ.get("PYTHONPATH")])),
+               LISTINGS_DB="bench.db",
+               FAISS_INDEX_FACTORY="Flat",
+               QUERY_CACHE="0",      # every search does the full work
+               DEDUP_MODE="off",     # the synthetic listings share most of their text
+               WARMUP="0")
+    with tempfile.TemporaryDirectory(prefix="rag-bench-") as workdir:
+        result = subprocess.run([sys.executable, os.path.join(here, "bench_service.py"), "--child", config],
+                                cwd=workdir, env=env, capture_output=True, text=True)
+    if result.returncode != 0:
+        raise RuntimeError(f"benchmark of {size} listings failed:\n{result.stderr[-2000:]}")
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+def run_benchmark(sizes=DEFAULT_SIZES, indexes=DEFAULT_INDEXES, clients=8, n_queries=400, single=500,
+                  seed=0) -> Dict:
+    """Every corpus size, each in its own process, as one JSON-serializable report"""
+    import faiss
+    return {
+        'meta': {
+            'python': sys.version.split()[0],
+            'numpy': np.__version__,
+            'faiss': getattr(faiss, "__version__", None),
+            'cpus': os.cpu_count(),
+            'seed': seed,
+            'embedder': StubEmbedder.name,
+            'started_at': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        'runs': [run_in_subprocess(size, indexes, clients, n_queries, single, seed) for size in sizes],
+    }
+
+def flatten(report, prefix="") -> Dict[str, float]:
+    """Numeric leaves of a report keyed by their path ("runs.0.search.Flat.vector.p99_ms")"""
+    if isinstance(report, dict):
+        items = report.items()
+    elif isinstance(report, list):
+        items = enumerate(report)
+    else:
+        return {prefix: report} if isinstance(report, (int, float)) and not isinstance(report, bool) else {}
+    flat = {}
+    for key, value in items:
+        flat.update(flatten(value, f"{prefix}.{key}" if prefix else str(key)))
+    return flat
+
+def compare_reports(baseline: Dict, current: Dict, tolerance: float = 0.2) -> List[Dict]:
+    """
+    Metrics that got worse than the baseline by more than `tolerance`
+    (relative): latencies and memory going up, throughput and recall going down
+    """
+    old, new = flatten(baseline.get('runs', [])), flatten(current.get('runs', []))
+    regressions = []
+    for path, before in old.items():
+        after = new.get(path)
+        if after is None or not before:
+            continue
+        name = path.rsplit(".", 1)[-1]
+        if name.endswith("_ms") or "bytes" in name:
+            change = (after - before) / before
+        elif name.endswith("per_sec") or name == "recall_at_k":
+            change = (before - after) / before
+        else:
+            continue
+        if change > tolerance:
+            regressions.append({'metric': path, 'baseline': before, 'current': after, 'worse_by': round(change, 3)})
+    return regressions
+
+# CLI interface
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    if args[:1] == ["--child"]:
+        # The stub prints nothing, but the service does: keep stdout for the report
+        config = json.loads(args[1])
+        stdout = sys.stdout
+        sys.stdout = sys.stderr
+        report = run_size(config['size'], config['indexes'], config['clients'], config['n_queries'],
+                          config['single'], config['seed'])
+        sys.stdout = stdout
+        print(json.dumps(report))
+        sys.exit(0)
+
+    def option(name, default):
+        return args[args.index(name) + 1] if name in args else default
+
+    sizes = [int(size) for size in option("--sizes", ",".join(map(str, DEFAULT_SIZES))).split(",")]
+    indexes = [factory for factory in option("--indexes", ";".join(DEFAULT_INDEXES)).split(";") if factory]
+    report = run_benchmark(sizes, indexes, clients=int(option("--clients", 8)),
+                           n_queries=int(option("--queries", 400)), single=int(option("--single", 500)),
+                           seed=int(option("--seed", 0)))
+    if "--compare" in args:
+        # Exit status 1 when a metric regressed against the baseline report
+        with open(option("--compare", None)) as f:
+            report['regressions'] = compare_reports(json.load(f), report, float(option("--tolerance", 0.2)))
+    output = json.dumps(report, indent=2)
+    if "--out" in args:
+        with open(option("--out", None), "w") as f:
+            f.write(output)
+    print(output)
+    if report.get('regressions'):
+        sys.exit(1)
@@ -0,0 +1,58 @@
+import json
+import os
+import subprocess
+import sys
+
+# Entry points whose cold import we care about: the service and the CLI tools
+MODULES = ["flaskApp", "insertion", "search", "safeInsertion", "index_tools", "inspectDB", "shards"]
+# Modules that must not be imported until they are actually used
+HEAVY_MODULES = ["torch", "sentence_transformers", "pandas", "requests"]
+
+IMPORT_SCRIPT = """
+import json, sys, time
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "heavy": [name for name in {heavy!r} if name in sys.modules]}}))
+"""
+
+WARMUP_SCRIPT = """
+import json, time
+start = time.perf_counter()
+import lifecycle
+lifecycle.warm_up()
+state = lifecycle.readiness()
+print(json.dumps({"seconds": time.perf_counter() - start,
+                  "model_seconds": state["model_seconds"], "index_seconds": state["index_seconds"]}))
+"""
+
+def run_python(script, **env):
+    """Run a script in a fresh interpreter next to the RAG modules, returns its JSON output"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    output = subprocess.run([sys.executable, "-c", script], cwd=here, check=True,
+                            capture_output=True, text=True, env=dict(os.environ, **env)).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def import_time(module, repeat=3):
+    """Best cold import time of `module` over `repeat` fresh interpreters, and the heavy modules it pulled in"""
+    runs = [run_python(IMPORT_SCRIPT.format(module=module, heavy=HEAVY_MODULES)) for _ in range(repeat)]
+    return {
+        'seconds': round(min(run['seconds'] for run in runs), 3),
+        'heavy_modules': runs[0]['heavy'],
+    }
+
+def run_benchmark(modules=MODULES, repeat=3, warmup=True):
+    """Cold import time per entry point, plus the model/index warm-up it no longer pays at import"""
+    report = {'python': sys.version.split()[0], 'imports': {}}
+    for module in modules:
+        report['imports'][module] = import_time(module, repeat)
+    if warmup:
+        result = run_python(WARMUP_SCRIPT)
+        report['warmup'] = {key: round(value, 3) if value is not None else None for key, value in result.items()}
+    return report
+
+# CLI interface
+if __name__ == "__main__":
+    # Usage: python bench_startup.py [module ...] [--no-warmup]
+    modules = [arg for arg in sys.argv[1:] if not arg.startswith("--")] or MODULES
+    print(json.dumps(run_benchmark(modules, warmup='--no-warmup' not in sys.argv), indent=2))
@@ -0,0 +1,16 @@
+import glob
+import json
+import os
+
+# The scraped posts the tests and benchmarks run on
+DATA_FILES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'dataFiles', '*.json')
+
+def load_texts(pattern=DATA_FILES):
+    """Every non-empty post text in dataFiles/*.json"""
+    texts = []
+    for path in sorted(glob.glob(pattern)):
+        with open(path, encoding='utf-8') as f:
+            for post in json.load(f):
+                if isinstance(post, dict) and post.get('text'):
+                    texts.append(post['text'])
+    return texts
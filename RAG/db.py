@@ -1,7 +1,84 @@
+import os
+import queue
 import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import List, Optional, Sequence
+from shards import shard_db_path
 
-def init_db():
-    conn = sqlite3.connect("uga.db")
+DB_PATH = os.environ.get("LISTINGS_DB", "uga.db")
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+DB_CACHE_KB = int(os.environ.get("DB_CACHE_KB", "65536"))
+
+# Connection settings: WAL lets readers run while a writer commits, NORMAL
+# synchronous is durable across application crashes in WAL mode, and a
+# larger statement cache keeps the hot queries prepared.
+PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    f"PRAGMA cache_size=-{DB_CACHE_KB}",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA busy_timeout=5000",
+]
+
+# Indexes for the search filters and the DatabaseInspector queries
+INDEXES = [
+    "CREATE INDEX IF NOT EXISTS idx_listings_price_min ON listings(price_min)",
+    "CREATE INDEX IF NOT EXISTS idx_listings_beds ON listings(beds)",
+    "CREATE INDEX IF NOT EXISTS idx_listings_user_id ON listings(user_id)",
+]
+
+# Full-text index over listings.text (external content, so the text is stored
+# once). Triggers keep it in sync with every insert, update and delete path.
+FTS_STATEMENTS = [
+    "CREATE VIRTUAL TABLE IF NOT EXISTS listings_fts USING fts5(text, content='listings', content_rowid='id')",
+    """CREATE TRIGGER IF NOT EXISTS listings_fts_insert AFTER INSERT ON listings BEGIN
+        INSERT INTO listings_fts(rowid, text) VALUES (new.id, new.text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS listings_fts_delete AFTER DELETE ON listings BEGIN
+        INSERT INTO listings_fts(listings_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS listings_fts_update AFTER UPDATE OF text ON listings BEGIN
+        INSERT INTO listings_fts(listings_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO listings_fts(rowid, text) VALUES (new.id, new.text);
+    END""",
+]
+
+# Every insert, text update and delete of a listing is noted in listing_changes,
+# so reconciliation (index_tools.py reconcile) only looks at rows changed since
+# its high-water mark in sync_state
+CHANGE_TRACKING_STATEMENTS = [
+    """CREATE TABLE IF NOT EXISTS listing_changes (
+        seq INTEGER PRIMARY KEY AUTOINCREMENT,
+        listing_id INTEGER
+    )""",
+    "CREATE TABLE IF NOT EXISTS sync_state (name TEXT PRIMARY KEY, value INTEGER)",
+    """CREATE TRIGGER IF NOT EXISTS listing_changes_insert AFTER INSERT ON listings BEGIN
+        INSERT INTO listing_changes(listing_id) VALUES (new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS listing_changes_update AFTER UPDATE OF text ON listings BEGIN
+        INSERT INTO listing_changes(listing_id) VALUES (new.id);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS listing_changes_delete AFTER DELETE ON listings BEGIN
+        INSERT INTO listing_changes(listing_id) VALUES (old.id);
+    END""",
+]
+
+INSERT_LISTING_SQL = """
+    INSERT INTO listings (text, location, price_min, price_max, beds, baths, user_id, user_name)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+def connect(path: str = DB_PATH):
+    """Open a tuned connection (shared between threads by the pool, never concurrently)"""
+    conn = sqlite3.connect(path, check_same_thread=False, cached_statements=256)
+    for pragma in PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+def init_db(path: str = DB_PATH):
+    conn = connect(path)
     cur = conn.cursor()
     cur.execute("""
     CREATE TABLE IF NOT EXISTS listings (
@@ -16,5 +93,126 @@ def init_db():
         user_name TEXT
     );
     """)
+    # Reposts caught by the insert-time near-duplicate check (see dedup.py)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS duplicates (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        duplicate_of INTEGER,
+        similarity REAL,
+        action TEXT,
+        text TEXT,
+        user_id TEXT,
+        user_name TEXT,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    """)
+    for statement in INDEXES + CHANGE_TRACKING_STATEMENTS:
+        cur.execute(statement)
+    init_fts(cur)
     conn.commit()
     return conn
+
+def init_fts(cur) -> bool:
+    """Create the FTS5 index and its triggers, backfilling existing rows the first time"""
+    cur.execute("SELECT 1 FROM sqlite_master WHERE name = 'listings_fts'")
+    exists = cur.fetchone() is not None
+    try:
+        for statement in FTS_STATEMENTS:
+            cur.execute(statement)
+    except sqlite3.OperationalError as e:
+        # SQLite built without FTS5: hybrid search falls back to vector only
+        print(f"Full-text index unavailable: {e}")
+        return False
+    if not exists:
+        cur.execute("INSERT INTO listings_fts(listings_fts) VALUES ('rebuild')")
+    return True
+
+def get_sync_state(conn, name: str):
+    cur = conn.execute("SELECT value FROM sync_state WHERE name = ?", (name,))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+def set_sync_state(conn, name: str, value):
+    conn.execute("INSERT OR REPLACE INTO sync_state (name, value) VALUES (?, ?)", (name, value))
+
+def has_fts(conn) -> bool:
+    cur = conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'listings_fts'")
+    return cur.fetchone() is not None
+
+def insert_listings_bulk(conn, rows: Sequence[Sequence]) -> List[int]:
+    """
+    Insert many listings with one executemany and return their ids.
+    rows: (text, location, price_min, price_max, beds, baths, user_id, user_name)
+
+    Ids are assigned up front from the AUTOINCREMENT sequence, so they are
+    known without one round trip per row. Runs inside the caller's
+    transaction (opened with BEGIN IMMEDIATE if there is none), which holds
+    the write lock so no other writer can take the same ids.
+    """
+    if not rows:
+        return []
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT MAX(COALESCE((SELECT seq FROM sqlite_sequence WHERE name = 'listings'), 0),
+                   COALESCE((SELECT MAX(id) FROM listings), 0))
+    """)
+    first_id = cur.fetchone()[0] + 1
+    ids = list(range(first_id, first_id + len(rows)))
+    cur.executemany("""
+        INSERT INTO listings (id, text, location, price_min, price_max, beds, baths, user_id, user_name)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, [(row_id, *row) for row_id, row in zip(ids, rows)])
+    cur.close()
+    return ids
+
+class ConnectionPool:
+    """Bounded pool of tuned connections; callers block when all are checked out"""
+
+    def __init__(self, path: str = DB_PATH, size: int = DB_POOL_SIZE):
+        self.path = path
+        self.size = size
+        self.idle = queue.LifoQueue(maxsize=size)
+        self.created = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, timeout: float = 30):
+        try:
+            return self.idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self.lock:
+            if self.created < self.size:
+                self.created += 1
+                return init_db(self.path)
+        return self.idle.get(timeout=timeout)
+
+    def release(self, conn):
+        if conn.in_transaction:
+            # Never hand out a connection in the middle of someone else's transaction
+            conn.rollback()
+        self.idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+# One pool per shard (None is the default DB_PATH store)
+_pools = {}
+_pool_lock = threading.Lock()
+
+def get_pool(shard: Optional[str] = None) -> ConnectionPool:
+    """Process-wide connection pool for DB_PATH, or for a campus shard's database"""
+    pool = _pools.get(shard)
+    if pool is None:
+        with _pool_lock:
+            pool = _pools.get(shard)
+            if pool is None:
+                pool = ConnectionPool(shard_db_path(shard, DB_PATH))
+                _pools[shard] = pool
+    return pool
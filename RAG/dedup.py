@@ -0,0 +1,224 @@
+import os
+import re
+import threading
+import zlib
+import numpy as np
+from typing import Dict, Iterable, List, Optional, Tuple
+from embedding_cache import normalize_text
+
+# Insert-time near-duplicate detection (MinHash over word shingles + LSH banding)
+#   skip   reposts are not inserted, the caller gets the existing listing's id
+#   merge  the existing listing takes the repost's text (fresher price/dates)
+#   off    no check
+DEDUP_MODE = os.environ.get("DEDUP_MODE", "skip")
+# Estimated Jaccard similarity of the shingle sets above which two listings are the same
+DEDUP_THRESHOLD = float(os.environ.get("DEDUP_THRESHOLD", "0.8"))
+DEDUP_SHINGLE_SIZE = int(os.environ.get("DEDUP_SHINGLE_SIZE", "3"))
+# 32 bands of 4 rows: pairs above ~0.5 similarity almost always share a band
+DEDUP_NUM_PERM = 128
+DEDUP_BANDS = 32
+
+# Hashes are mixed with (a * x + b) mod PRIME; a < 2**31 keeps the product inside uint64
+_PRIME = np.uint64(4294967291)
+_rng = np.random.default_rng(20240611)
+_A = _rng.integers(1, 2**31, size=DEDUP_NUM_PERM, dtype=np.uint64)
+_B = _rng.integers(0, 2**32, size=DEDUP_NUM_PERM, dtype=np.uint64)
+
+_word = re.compile(r"[^\W_]+")
+
+def shingles(text: str, size: int = DEDUP_SHINGLE_SIZE) -> set:
+    """Word n-grams of the lowercased text; punctuation and emoji do not count"""
+    words = _word.findall(normalize_text(text).lower())
+    if len(words) <= size:
+        return {" ".join(words)} if words else set()
+    return {" ".join(words[i:i + size]) for i in range(len(words) - size + 1)}
+
+def minhash(text: str) -> Optional[np.ndarray]:
+    """MinHash signature (DEDUP_NUM_PERM uint32), None for text without words"""
+    grams = shingles(text)
+    if not grams:
+        return None
+    hashes = np.fromiter((zlib.crc32(gram.encode("utf-8")) for gram in grams), dtype=np.uint64, count=len(grams))
+    mixed = (_A[:, None] * hashes[None, :] + _B[:, None]) % _PRIME
+    return mixed.min(axis=1).astype(np.uint32)
+
+class DuplicateDetector:
+    """
+    MinHash signatures of the stored listings, bucketed by LSH band. A new
+    text is only compared against listings that share at least one band
+    with it, so a check costs about the same for 1k or 1M listings.
+    """
+
+    def __init__(self, threshold: float = DEDUP_THRESHOLD, bands: int = DEDUP_BANDS):
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = DEDUP_NUM_PERM // bands
+        self.lock = threading.Lock()
+        self.signatures = {}
+        self.buckets = [dict() for _ in range(bands)]
+        self.max_id = 0
+        self.stats_counters = {'checks': 0, 'candidates': 0, 'duplicates': 0}
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [band.tobytes() for band in signature.reshape(self.bands, self.rows)]
+
+    def _add(self, row_id: int, signature: np.ndarray):
+        """Index one signature (lock held)"""
+        self._remove(row_id)
+        self.signatures[row_id] = signature
+        for bucket, key in zip(self.buckets, self._band_keys(signature)):
+            bucket.setdefault(key, set()).add(row_id)
+        self.max_id = max(self.max_id, row_id)
+
+    def _remove(self, row_id: int):
+        signature = self.signatures.pop(row_id, None)
+        if signature is None:
+            return
+        for bucket, key in zip(self.buckets, self._band_keys(signature)):
+            members = bucket.get(key)
+            if members is not None:
+                members.discard(row_id)
+                if not members:
+                    del bucket[key]
+
+    def add(self, rows: Iterable[Tuple[int, Optional[np.ndarray]]]):
+        """rows: (id, signature) pairs; None signatures are ignored"""
+        with self.lock:
+            for row_id, signature in rows:
+                if signature is not None:
+                    self._add(int(row_id), signature)
+
+    def remove(self, ids: Iterable[int]):
+        with self.lock:
+            for row_id in ids:
+                self._remove(int(row_id))
+
+    def best_match(self, signature: Optional[np.ndarray]) -> Optional[Tuple[int, float]]:
+        """(id, similarity) of the most similar stored listing above the threshold"""
+        if signature is None:
+            return None
+        with self.lock:
+            self.stats_counters['checks'] += 1
+            candidates = set()
+            for bucket, key in zip(self.buckets, self._band_keys(signature)):
+                candidates.update(bucket.get(key, ()))
+            self.stats_counters['candidates'] += len(candidates)
+            best = None
+            for row_id in candidates:
+                similarity = float(np.mean(self.signatures[row_id] == signature))
+                if similarity >= self.threshold and (best is None or similarity > best[1]):
+                    best = (row_id, similarity)
+            if best is not None:
+                self.stats_counters['duplicates'] += 1
+            return best
+
+    def load(self, conn, after_id: int = 0):
+        """Sign every listing with id > after_id"""
+        cur = conn.cursor()
+        cur.execute("SELECT id, text FROM listings WHERE id > ? ORDER BY id", (after_id,))
+        rows = cur.fetchall()
+        cur.close()
+        self.add((row_id, minhash(text or "")) for row_id, text in rows)
+        return len(rows)
+
+    def refresh(self, conn):
+        """Pick up listings other processes inserted since the last load"""
+        return self.load(conn, after_id=self.max_id)
+
+    def stats(self) -> Dict:
+        with self.lock:
+            stats = dict(self.stats_counters)
+            stats['listings'] = len(self.signatures)
+            stats['threshold'] = self.threshold
+            return stats
+
+# One detector per shard (None is the default store)
+_detectors = {}
+_detector_lock = threading.Lock()
+
+def get_duplicate_detector(conn=None, shard: Optional[str] = None) -> DuplicateDetector:
+    """Process-wide detector of a shard, loaded from SQLite on first use"""
+    detector = _detectors.get(shard)
+    if detector is None:
+        with _detector_lock:
+            detector = _detectors.get(shard)
+            if detector is None:
+                detector = DuplicateDetector()
+                if conn is not None:
+                    detector.load(conn)
+                _detectors[shard] = detector
+    return detector
+
+def check_duplicates(conn, texts: List[str], shard: Optional[str] = None):
+    """
+    Near-duplicate check for texts about to be inserted. Returns
+    (signatures, matches): matches[i] is None for a new listing,
+    ('listing', id, similarity) for a repost of a stored listing and
+    ('batch', position, similarity) for a repost of an earlier text of
+    the same batch.
+    """
+    signatures = [minhash(text) for text in texts]
+    if DEDUP_MODE == "off":
+        return signatures, [None] * len(texts)
+
+    detector = get_duplicate_detector(conn, shard)
+    detector.refresh(conn)
+    matches = [None] * len(texts)
+    for position, signature in enumerate(signatures):
+        match = detector.best_match(signature)
+        if match is not None:
+            matches[position] = ('listing',) + match
+
+    # Drop matches against listings another process has deleted since
+    matched_ids = sorted({match[1] for match in matches if match is not None})
+    if matched_ids:
+        placeholders = ','.join(['?' for _ in matched_ids])
+        cur = conn.cursor()
+        cur.execute(f"SELECT id FROM listings WHERE id IN ({placeholders})", matched_ids)
+        existing = {row[0] for row in cur.fetchall()}
+        cur.close()
+        detector.remove(set(matched_ids) - existing)
+        matches = [match if match is None or match[1] in existing else None for match in matches]
+
+    # Reposts inside the batch itself, checked against a batch-local detector
+    local = DuplicateDetector(detector.threshold, detector.bands)
+    for position, signature in enumerate(signatures):
+        if matches[position] is not None or signature is None:
+            continue
+        match = local.best_match(signature)
+        if match is not None:
+            matches[position] = ('batch',) + match
+        else:
+            local.add([(position, signature)])
+    return signatures, matches
+
+def record_duplicates(conn, entries: List[Tuple]):
+    """Log skipped/merged reposts: (duplicate_of, similarity, action, text, user_id, user_name)"""
+    if entries:
+        conn.executemany("""
+            INSERT INTO duplicates (duplicate_of, similarity, action, text, user_id, user_name)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, entries)
+
+def remember_listings(rows: Iterable[Tuple[int, Optional[np.ndarray]]], shard: Optional[str] = None):
+    """Insert paths call this after commit; a no-op until the detector is first used"""
+    detector = _detectors.get(shard)
+    if detector is not None:
+        detector.add(rows)
+
+def forget_listings(ids: Iterable[int], shard: Optional[str] = None):
+    detector = _detectors.get(shard)
+    if detector is not None:
+        detector.remove(ids)
+
+def dedup_stats() -> Dict:
+    """Checks, candidates compared and duplicates caught, per loaded shard"""
+    if DEDUP_MODE == "off" or not _detectors:
+        return {'mode': DEDUP_MODE, 'loaded': False}
+    stats = {'mode': DEDUP_MODE, 'loaded': True}
+    for shard, detector in list(_detectors.items()):
+        if shard is None:
+            stats.update(detector.stats())
+        else:
+            stats.setdefault('shards', {})[shard] = detector.stats()
+    return stats
@@ -0,0 +1,250 @@
+import os
+import threading
+import numpy as np
+from typing import Dict, List
+from transport import FORMAT_MIMETYPES, decode_embeddings
+from embedding_cache import EmbeddingCache, cache_key
+from batching import EmbedCoalescer, EMBED_BUCKET_SIZE, EMBED_MAX_TOKENS, padding_stats
+
+# Embedding configuration (dimension = 384 and at most 256 tokens for MiniLM)
+dim = 384
+MODEL_MAX_TOKENS = 256
+MODEL_NAME = os.environ.get("EMBEDDING_MODEL", "all-MiniLM-L6-v2")
+EMBEDDER_BACKEND = os.environ.get("EMBEDDER_BACKEND", "local")  # "local", "onnx" or "remote"
+EMBED_SERVER_URL = os.environ.get("EMBED_SERVER_URL", "http://localhost:5000")
+EMBED_WIRE_FORMAT = os.environ.get("EMBED_WIRE_FORMAT", "f32")  # json, f32, npy or base64
+EMBEDDING_CACHE_ENABLED = os.environ.get("EMBEDDING_CACHE", "1") != "0"
+EMBED_COALESCE_ENABLED = os.environ.get("EMBED_COALESCE", "1") != "0"
+
+# Load the sentence-transformers model only when needed (importing it pulls
+# in torch, which alone takes seconds, so even the import waits for first use)
+model = None
+_model_lock = threading.Lock()
+
+def get_model():
+    """Lazy load the sentence-transformers model (one copy per process)"""
+    global model
+    if model is None:
+        with _model_lock:
+            if model is None:
+                from sentence_transformers import SentenceTransformer
+                loaded = SentenceTransformer(MODEL_NAME)
+                # Truncation policy: never look past EMBED_MAX_TOKENS tokens
+                loaded.max_seq_length = min(loaded.max_seq_length or EMBED_MAX_TOKENS, EMBED_MAX_TOKENS)
+                model = loaded
+    return model
+
+def model_loaded():
+    """Whether this process has loaded the model yet (without loading it)"""
+    if EMBEDDER_BACKEND == "onnx":
+        from onnx_backend import onnx_model_loaded
+        return onnx_model_loaded()
+    return model is not None
+
+# Backends that run the model in this process; the embedding endpoints serve
+# with one of them so a remote client never calls back into itself
+IN_PROCESS_BACKENDS = ("local", "onnx")
+SERVING_BACKEND = EMBEDDER_BACKEND if EMBEDDER_BACKEND in IN_PROCESS_BACKENDS else "local"
+
+def cache_model_name(backend: str = None) -> str:
+    """
+    Model identity used in embedding cache keys. The ONNX graphs give slightly
+    different vectors than PyTorch, and a tighter EMBED_MAX_TOKENS changes the
+    vectors of long texts, so their entries are kept apart.
+    """
+    backend = backend or EMBEDDER_BACKEND
+    name = MODEL_NAME
+    if backend == "onnx":
+        from onnx_backend import ONNX_VARIANT
+        name = f"{name}+onnx-{ONNX_VARIANT}"
+    if EMBED_MAX_TOKENS < MODEL_MAX_TOKENS:
+        name = f"{name}@{EMBED_MAX_TOKENS}tok"
+    return name
+
+class Embedder:
+    """Base class: turns texts into float32 numpy vectors"""
+    name = "base"
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        """Embed a list of texts, returns a (len(texts), dim) float32 array"""
+        raise NotImplementedError
+
+    def embed_text(self, text: str) -> np.ndarray:
+        """Embed a single text, returns a (dim,) float32 array"""
+        return self.embed_texts([text])[0]
+
+class LocalEmbedder(Embedder):
+    """Calls the loaded SentenceTransformer directly, no HTTP round trip"""
+    name = "local"
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.empty((0, dim), dtype="float32")
+        # encode already sorts the texts by length into batches of batch_size
+        # and truncates them to max_seq_length, so no bucketing here
+        vectors = get_model().encode(list(texts), batch_size=EMBED_BUCKET_SIZE)
+        return np.ascontiguousarray(vectors, dtype="float32").reshape(len(texts), -1)
+
+class OnnxEmbedder(Embedder):
+    """Runs the exported model with ONNX Runtime (see onnx_backend.py), no torch needed"""
+    name = "onnx"
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        from onnx_backend import get_onnx_model
+        if not texts:
+            return np.empty((0, dim), dtype="float32")
+        vectors = get_onnx_model().encode(list(texts))
+        return np.ascontiguousarray(vectors, dtype="float32").reshape(len(texts), -1)
+
+class RemoteEmbedder(Embedder):
+    """
+    Calls the /embed and /embeds endpoints of an embedding server.
+    Asks for raw float32 bodies (see transport.py) and still understands
+    plain JSON from servers that do not negotiate.
+    """
+    name = "remote"
+
+    def __init__(self, base_url: str = EMBED_SERVER_URL, timeout: float = 60, wire_format: str = EMBED_WIRE_FORMAT):
+        import requests
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers["Accept"] = FORMAT_MIMETYPES[wire_format]
+
+    def _post(self, path: str, payload: dict, key: str) -> np.ndarray:
+        resp = self.session.post(f"{self.base_url}{path}", json=payload, timeout=self.timeout)
+        if resp.status_code != 200:
+            raise Exception(f"Embedding server error: {resp.status_code} - {resp.text}")
+        return decode_embeddings(resp.content, resp.headers.get("Content-Type"), resp.headers, key)
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.empty((0, dim), dtype="float32")
+        vectors = self._post("/embeds", {"texts": list(texts)}, "embeddings")
+        return vectors.reshape(len(texts), -1)
+
+    def embed_text(self, text: str) -> np.ndarray:
+        return self._post("/embed", {"text": text}, "embedding").reshape(-1)
+
+class CachedEmbedder(Embedder):
+    """Embedding cache in front of another embedder, only cache misses reach the model"""
+
+    def __init__(self, inner: Embedder, cache: EmbeddingCache, model_name: str = MODEL_NAME):
+        self.inner = inner
+        self.cache = cache
+        self.model_name = model_name
+        self.name = f"cached-{inner.name}"
+
+    def embed_texts(self, texts: List[str]) -> np.ndarray:
+        if not texts:
+            return np.empty((0, dim), dtype="float32")
+        keys = [cache_key(self.model_name, text) for text in texts]
+        found = self.cache.get_many(keys)
+
+        # Embed each missing text once, even if it repeats inside the batch
+        pending = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in pending:
+                pending[key] = text
+        if pending:
+            vectors = self.inner.embed_texts(list(pending.values()))
+            computed = dict(zip(pending.keys(), vectors))
+            self.cache.put_many(computed)
+            found.update(computed)
+
+        return np.stack([found[key] for key in keys]).astype("float32", copy=False)
+
+    def stats(self) -> Dict:
+        return self.cache.stats()
+
+_embedders = {}
+_embedders_lock = threading.Lock()
+_embedding_cache = None
+_coalescer = None
+
+def get_embedding_cache() -> EmbeddingCache:
+    """Process-wide embedding cache shared by every backend"""
+    global _embedding_cache
+    if _embedding_cache is None:
+        _embedding_cache = EmbeddingCache()
+    return _embedding_cache
+
+def create_embedder(backend: str = None) -> Embedder:
+    """Build an embedder for the given backend name ("local", "onnx" or "remote")"""
+    global _coalescer
+    backend = backend or EMBEDDER_BACKEND
+    if backend in IN_PROCESS_BACKENDS:
+        embedder = LocalEmbedder() if backend == "local" else OnnxEmbedder()
+        if EMBED_COALESCE_ENABLED:
+            # Concurrent cache misses share one batched forward pass
+            _coalescer = EmbedCoalescer(embedder)
+            embedder = _coalescer
+    elif backend == "remote":
+        embedder = RemoteEmbedder()
+    else:
+        raise ValueError(f"Unknown embedder backend: {backend}")
+
+    if EMBEDDING_CACHE_ENABLED:
+        embedder = CachedEmbedder(embedder, get_embedding_cache(), cache_model_name(backend))
+    return embedder
+
+def get_embedder(backend: str = None) -> Embedder:
+    """
+    Get the process-wide embedder for a backend (EMBEDDER_BACKEND by default).
+    The embedding endpoints ask for "local" explicitly so a remote client
+    pointed at this server never calls back into itself.
+    """
+    backend = backend or EMBEDDER_BACKEND
+    if backend not in _embedders:
+        with _embedders_lock:
+            if backend not in _embedders:
+                _embedders[backend] = create_embedder(backend)
+    return _embedders[backend]
+
+def set_embedder(embedder: Embedder, backend: str = None):
+    """Replace the process-wide embedder (e.g. remote backend or a test stub)"""
+    _embedders[backend or EMBEDDER_BACKEND] = embedder
+
+def lookup_cached_vectors(texts: List[str]) -> Dict[str, np.ndarray]:
+    """
+    Original float32 vectors of already-embedded texts, straight from the
+    embedding cache (never runs the model). Used to re-rank candidates from a
+    compressed index with exact distances.
+    """
+    if not EMBEDDING_CACHE_ENABLED or not texts:
+        return {}
+    keys = {text: cache_key(cache_model_name(), text) for text in texts}
+    found = get_embedding_cache().get_many(list(keys.values()))
+    return {text: found[key] for text, key in keys.items() if key in found}
+
+def seed_embedding_cache(texts: List[str], vectors: np.ndarray):
+    """Store known vectors for texts (e.g. originals taken from an exact index)"""
+    get_embedding_cache().put_many({cache_key(cache_model_name(), text): vector for text, vector in zip(texts, vectors)})
+
+def embedding_cache_stats() -> Dict:
+    """Hit and miss counters of the embedding cache"""
+    if not EMBEDDING_CACHE_ENABLED:
+        return {'enabled': False}
+    stats = get_embedding_cache().stats()
+    stats['enabled'] = True
+    return stats
+
+def embedding_padding_stats() -> Dict:
+    """
+    Padding ratio and truncations of the ONNX model's forward passes. The
+    PyTorch backend is not instrumented, so its padding is reported as unmeasured.
+    """
+    if SERVING_BACKEND != "onnx":
+        return {'measured': False, 'backend': SERVING_BACKEND}
+    stats = padding_stats.stats()
+    stats['measured'] = True
+    stats['backend'] = SERVING_BACKEND
+    return stats
+
+def embedding_batch_stats() -> Dict:
+    """Micro-batching counters of the local model (requests per forward pass)"""
+    if _coalescer is None:
+        return {'enabled': False}
+    stats = _coalescer.stats()
+    stats['enabled'] = True
+    return stats
@@ -0,0 +1,121 @@
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+import numpy as np
+from collections import OrderedDict
+from typing import Dict, List, Optional
+
+# Two-level embedding cache: in-memory LRU in front of a persistent SQLite store
+EMBEDDING_CACHE_PATH = os.environ.get("EMBEDDING_CACHE_PATH", "embedding_cache.db")
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "10000"))
+
+_whitespace = re.compile(r"\s+")
+
+def normalize_text(text: str) -> str:
+    """Normalization applied before hashing, so trivially different copies share a key"""
+    return _whitespace.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+def cache_key(model_name: str, text: str) -> str:
+    """Hash of model name and normalized text"""
+    digest = hashlib.sha256()
+    digest.update(model_name.encode("utf-8"))
+    digest.update(b"\0")
+    digest.update(normalize_text(text).encode("utf-8"))
+    return digest.hexdigest()
+
+class EmbeddingCache:
+    """
+    LRU of recently used vectors backed by an SQLite table of every vector
+    ever computed. Pass path=None for a memory-only cache.
+    """
+
+    def __init__(self, path: Optional[str] = EMBEDDING_CACHE_PATH, capacity: int = EMBEDDING_CACHE_SIZE):
+        self.path = path
+        self.capacity = capacity
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats_counters = {'memory_hits': 0, 'disk_hits': 0, 'misses': 0, 'writes': 0}
+        self.conn = None
+        if path:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS embeddings (
+                key TEXT PRIMARY KEY,
+                dim INTEGER,
+                vector BLOB
+            );
+            """)
+            self.conn.commit()
+
+    def _remember(self, key: str, vector: np.ndarray):
+        """Put a vector in the LRU, evicting the least recently used ones"""
+        self.lru[key] = vector
+        self.lru.move_to_end(key)
+        while len(self.lru) > self.capacity:
+            self.lru.popitem(last=False)
+
+    def get_many(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        """Look keys up in memory, then on disk. Returns only the hits."""
+        found = {}
+        with self.lock:
+            missing = []
+            for key in keys:
+                vector = self.lru.get(key)
+                if vector is not None:
+                    self.lru.move_to_end(key)
+                    found[key] = vector
+                    self.stats_counters['memory_hits'] += 1
+                else:
+                    missing.append(key)
+
+            if missing and self.conn is not None:
+                unique_missing = list(dict.fromkeys(missing))
+                # Stay under SQLite's host parameter limit
+                for start in range(0, len(unique_missing), 500):
+                    chunk = unique_missing[start:start + 500]
+                    placeholders = ','.join(['?' for _ in chunk])
+                    rows = self.conn.execute(
+                        f"SELECT key, vector FROM embeddings WHERE key IN ({placeholders})", chunk
+                    ).fetchall()
+                    for key, blob in rows:
+                        vector = np.frombuffer(blob, dtype="<f4").astype("float32")
+                        found[key] = vector
+                        self._remember(key, vector)
+                still_missing = [key for key in missing if key not in found]
+                self.stats_counters['disk_hits'] += len(missing) - len(still_missing)
+                missing = still_missing
+
+            self.stats_counters['misses'] += len(missing)
+        return found
+
+    def put_many(self, items: Dict[str, np.ndarray]):
+        """Store freshly computed vectors in both levels"""
+        if not items:
+            return
+        with self.lock:
+            for key, vector in items.items():
+                self._remember(key, vector)
+            if self.conn is not None:
+                self.conn.executemany(
+                    "INSERT OR IGNORE INTO embeddings (key, dim, vector) VALUES (?, ?, ?)",
+                    [(key, int(vector.shape[0]), np.asarray(vector, dtype="<f4").tobytes())
+                     for key, vector in items.items()]
+                )
+                self.conn.commit()
+            self.stats_counters['writes'] += len(items)
+
+    def stats(self) -> Dict:
+        """Hit/miss counters and sizes"""
+        with self.lock:
+            stats = dict(self.stats_counters)
+            stats['memory_entries'] = len(self.lru)
+            stats['capacity'] = self.capacity
+            lookups = stats['memory_hits'] + stats['disk_hits'] + stats['misses']
+            stats['hit_ratio'] = round((stats['memory_hits'] + stats['disk_hits']) / lookups, 4) if lookups else 0.0
+            if self.conn is not None:
+                stats['disk_entries'] = self.conn.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+        return stats
@@ -1,45 +1,73 @@
 import json
+import multiprocessing
+import os
 import re
+import threading
+from concurrent.futures import ProcessPoolExecutor
 
+# Batches at least this large are spread over EXTRACT_WORKERS processes
+EXTRACT_WORKERS = int(os.environ.get("EXTRACT_WORKERS", str(os.cpu_count() or 1)))
+EXTRACT_PARALLEL_MIN = int(os.environ.get("EXTRACT_PARALLEL_MIN", "2000"))
 
+# All patterns are compiled once at import
+ADDRESS_PATTERN = re.compile(r'\d{1,5}\s[\w\s]+,\s*\w+,\s*[A-Z]{2}\s*\d{5}')
+# The ", City, ST 12345" tail every address ends with: finding it is cheap, and
+# without it the address pattern (which backtracks over [\w\s]+ at every
+# number in the text) cannot match
+ADDRESS_TAIL_PATTERN = re.compile(r',\s*\w+,\s*[A-Z]{2}\s*\d{5}')
+COMPLEX_PATTERN = re.compile(r'(?:The\s)?[A-Z][A-Za-z0-9&\-\']+(?:\s[A-Z][A-Za-z0-9&\-\']+){0,4}')
+CITY_UNI_PATTERN = re.compile(r'(Tallahassee|Athens|Tampa|College Town|FSU|UGA|USF)', re.IGNORECASE)
+# Bedrooms and bathrooms in one scan: group 3 is set for bedrooms, unset for bathrooms
+ROOMS_PATTERN = re.compile(
+    r'(\d+)(\.\d+)?\s*(?:(BR|Bed|Beds|Bedroom|Bedrooms)|BA|Bath|Baths|Bathroom|Bathrooms)',
+    re.IGNORECASE
+)
+PRICE_PATTERN = re.compile(r'\$([0-9]+(?:,[0-9]{3})*(?:\.\d{1,2})?)')
 
 def extract_location(text):
     # 1. Full street address
-    address_match = re.search(r'\d{1,5}\s[\w\s]+,\s*\w+,\s*[A-Z]{2}\s*\d{5}', text)
-    if address_match:
-        return address_match.group(0)
+    if ADDRESS_TAIL_PATTERN.search(text):
+        address_match = ADDRESS_PATTERN.search(text)
+        if address_match:
+            return address_match.group(0)
 
     # 2. Apartment / Complex names (capitalized words with optional "The")
-    complex_match = re.search(r'(?:The\s)?[A-Z][A-Za-z0-9&\-\']+(?:\s[A-Z][A-Za-z0-9&\-\']+){0,4}', text)
+    complex_match = COMPLEX_PATTERN.search(text)
     if complex_match:
         return complex_match.group(0)
 
     # 3. City / University mentions
-    city_uni_match = re.search(r'(Tallahassee|Athens|Tampa|College Town|FSU|UGA|USF)', text, re.IGNORECASE)
+    city_uni_match = CITY_UNI_PATTERN.search(text)
     if city_uni_match:
         return city_uni_match.group(0)
 
     return None
 
-def extract_metadata(text):
-    bedrooms, bathrooms, location, min_price, max_price = None, None, None, None, None
+def extract_rooms(text):
+    """(bedrooms, bathrooms) from the first mention of each, in a single scan"""
+    bedrooms, bathrooms = None, None
+    for match in ROOMS_PATTERN.finditer(text):
+        if match.group(3):
+            if bedrooms is None:
+                # "2.5 Bed" counts the digits after the point, like a plain search would
+                bedrooms = int(match.group(2)[1:] if match.group(2) else match.group(1))
+        elif bathrooms is None:
+            bathrooms = float(match.group(1) + (match.group(2) or ""))
+        if bedrooms is not None and bathrooms is not None:
+            break
+    return bedrooms, bathrooms
 
-    # Bedrooms
-    br_match = re.search(r'(\d+)\s*(?:BR|Bed|Beds|Bedroom|Bedrooms)', text, re.IGNORECASE)
-    if br_match:
-        bedrooms = int(br_match.group(1))
+def extract_metadata(text):
+    min_price, max_price = None, None
 
-    # Bathrooms
-    ba_match = re.search(r'(\d+(\.\d+)?)\s*(?:BA|Bath|Baths|Bathroom|Bathrooms)', text, re.IGNORECASE)
-    if ba_match:
-        bathrooms = float(ba_match.group(1))
+    # Bedrooms and bathrooms
+    bedrooms, bathrooms = extract_rooms(text)
 
     # Location extraction
     location = extract_location(text)
 
     # Prices
-    prices = re.findall(r'\$([0-9]+(?:,[0-9]{3})*(?:\.\d{1,2})?)', text)
-    prices = [float(p.replace(",", "")) for p in prices]
+    prices = [float(p.replace(",", "")) for p in PRICE_PATTERN.findall(text)]
     if prices:
         if len(prices) == 1:
             min_price = 0
@@ -48,4 +76,26 @@ def extract_metadata(text):
             min_price = min(prices)
             max_price = max(prices)
 
-    return  min_price, max_price,bedrooms, bathrooms, location
\ No newline at end of file
+    return min_price, max_price, bedrooms, bathrooms, location
+
+_pool = None
+_pool_lock = threading.Lock()
+
+def get_extraction_pool(workers=EXTRACT_WORKERS):
+    """Process pool for bulk extraction (spawned, so no threads or index are inherited)"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+def extract_metadata_batch(texts, workers=EXTRACT_WORKERS, chunksize=256, min_parallel=EXTRACT_PARALLEL_MIN):
+    """
+    extract_metadata for many texts, in input order. Large batches are
+    spread over a process pool; small ones are not worth the IPC.
+    """
+    texts = list(texts)
+    if workers <= 1 or len(texts) < min_parallel:
+        return [extract_metadata(text) for text in texts]
+    return list(get_extraction_pool(workers).map(extract_metadata, texts, chunksize=chunksize))
@@ -1,34 +1,67 @@
-from db import init_db
-from insertion import insert_listing
-from search import search
-from flask import Flask, request, jsonify
-from sentence_transformers import SentenceTransformer
+import os
+from db import get_pool
+from insertion import insert_listing, delete_listings, update_listing, get_index_stats, loaded_shards
+from safeInsertion import safe_batch_insert_listings
+from search import search, search_many, search_shards, SEARCH_MODES
+from shards import normalize_campus, resolve_campuses
+from flask import Flask, Response, g, request, jsonify
+from embedder import get_embedder, embedding_cache_stats, embedding_batch_stats, embedding_padding_stats, SERVING_BACKEND
+from transport import negotiate_format, encode_embeddings
+from query_cache import query_cache_stats
+from dedup import dedup_stats
+import lifecycle
 from flask_cors import CORS
-import sqlite3
-import threading
 
 # Initialize Flask app and enable CORS
 app = Flask(__name__)
 CORS(app)
 
-# Thread-local storage for database connections
-thread_local = threading.local()
+def create_app():
+    """
+    The app with its background work started: periodic FAISS snapshots and
+    compaction, and loading the model and index in the background (WARMUP=0
+    loads them on first use). Importing this module starts nothing; serve
+    with `gunicorn "flaskApp:create_app()"` so every worker starts its own
+    threads after the fork.
+    """
+    lifecycle.start()
+    return app
+
+def get_db_connection(shard=None):
+    """Get a pooled database connection for the current request (per campus shard)"""
+    if 'db_conns' not in g:
+        g.db_conns = {}
+    if shard not in g.db_conns:
+        g.db_conns[shard] = get_pool(shard).acquire()
+    return g.db_conns[shard]
+
+@app.teardown_appcontext
+def release_db_connection(exc):
+    """Return the request's connections to their bounded pools"""
+    for shard, conn in g.pop('db_conns', {}).items():
+        get_pool(shard).release(conn)
+
+def request_campus(data):
+    """Shard named by the request's "campus" (None for the default store); raises ValueError"""
+    return normalize_campus(data.get("campus") or request.args.get("campus"))
 
-def get_db_connection():
-    """Get a thread-local database connection"""
-    if not hasattr(thread_local, 'conn'):
-        thread_local.conn = init_db()
-    return thread_local.conn
+def embedding_response(vectors, fmt, key):
+    """Build a Flask response holding embeddings in the negotiated wire format"""
+    body, content_type, headers = encode_embeddings(vectors, fmt, key)
+    response = Response(body, content_type=content_type)
+    response.headers.update(headers)
+    return response
 
-# Load the sentence-transformers model only when needed
-model = None
+@app.route("/health", methods=["GET"])
+def health():
+    """Liveness: the process is up and serving requests (nothing is loaded for this)"""
+    return jsonify({"status": "ok"})
 
-def get_model():
-    """Lazy load the sentence-transformers model"""
-    global model
-    if model is None:
-        model = SentenceTransformer('all-MiniLM-L6-v2')
-    return model
+@app.route("/ready", methods=["GET"])
+def ready():
+    """Readiness: 200 once the model and index are loaded, 503 while warming up"""
+    state = lifecycle.readiness()
+    return jsonify(state), 200 if state["ready"] else 503
 
 @app.route('/embed', methods=['POST'])
 def embed_single():
@@ -36,15 +69,21 @@ def embed_single():
     Endpoint to embed a single text input.
     Request JSON: { "text": "Your text here" }
     Response JSON: { "embedding": [float, ...] }
+    Binary responses are negotiated with the Accept header (see transport.py).
     """
     data = request.get_json()
     text = data.get('text')
     if not text or not isinstance(text, str):
         return jsonify({'error': 'No valid text provided.'}), 400
 
-    # Compute embedding using lazy-loaded model
-    vector = get_model().encode(text)
-    return jsonify({'embedding': vector.tolist()})
+    try:
+        fmt = negotiate_format(request.accept_mimetypes, request.args.get('format') or data.get('format'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 406
+
+    # Compute embedding with the cached in-process embedder
+    vector = get_embedder(SERVING_BACKEND).embed_text(text)
+    return embedding_response(vector, fmt, 'embedding')
 
 @app.route('/embeds', methods=['POST'])
 def embed_batch():
@@ -52,15 +91,22 @@ def embed_batch():
     Endpoint to embed an array of text inputs.
     Request JSON: { "texts": ["text1", "text2", ...] }
     Response JSON: { "embeddings": [[float, ...], ...] }
+    Binary responses are negotiated with the Accept header (see transport.py).
     """
     data = request.get_json()
     texts = data.get('texts')
     if not texts or not isinstance(texts, list):
         return jsonify({'error': 'No valid texts list provided.'}), 400
 
-    # Compute embeddings using lazy-loaded model
-    vectors = get_model().encode(texts)
-    return jsonify({'embeddings': [vec.tolist() for vec in vectors]})
+    try:
+        fmt = negotiate_format(request.accept_mimetypes, request.args.get('format') or data.get('format'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 406
+
+    # Compute embeddings with the cached in-process embedder (cache misses run
+    # through the model in length buckets, see batching.py)
+    vectors = get_embedder(SERVING_BACKEND).embed_texts(texts)
+    return embedding_response(vectors, fmt, 'embeddings')
 
 @app.route("/insert", methods=["POST"])
 def insert():
@@ -68,33 +114,131 @@ def insert():
     text = data["text"]
     user_id = data.get("user_id", "")
     user_name = data.get("user_name", "")
-    conn = get_db_connection()
-    row_id = insert_listing(conn, text, user_id, user_name)
+    try:
+        shard = request_campus(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    conn = get_db_connection(shard)
+    row_id = insert_listing(conn, text, user_id, user_name, shard)
     return jsonify({"id": row_id})
 
 @app.route("/batchInsertion", methods=["POST"])
 def batch_insertion():
     data = request.json # contains a list of listings
-    inserted_ids = []
-    conn = get_db_connection()
-    for listing in data:
-        text = listing["text"]
-        user_id = listing["user"]["id"] if "user" in listing and "id" in listing["user"] else ""
-        user_name = listing["user"]["name"] if "user" in listing and "name" in listing["user"] else ""
-        row_id = insert_listing(conn, text, user_id, user_name)
-        inserted_ids.append(row_id)
+    # Listings are routed by their "campus" (or ?campus= for the whole file)
+    groups = {}
+    try:
+        default_campus = normalize_campus(request.args.get("campus"))
+        for position, listing in enumerate(data):
+            text = listing["text"]
+            user_id = listing["user"]["id"] if "user" in listing and "id" in listing["user"] else ""
+            user_name = listing["user"]["name"] if "user" in listing and "name" in listing["user"] else ""
+            shard = normalize_campus(listing["campus"]) if listing.get("campus") else default_campus
+            groups.setdefault(shard, []).append((position, {"text": text, "user_id": user_id, "user_name": user_name}))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    # One transaction, chunked embedding and a single index write per shard
+    inserted_ids = [None] * len(data)
+    for shard, entries in groups.items():
+        conn = get_db_connection(shard)
+        shard_ids = safe_batch_insert_listings(conn, [listing for _, listing in entries], shard=shard)
+        for (position, _), row_id in zip(entries, shard_ids):
+            inserted_ids[position] = row_id
     return jsonify({"inserted_ids": inserted_ids})
 
+@app.route("/delete", methods=["POST"])
+def delete():
+    """Delete listings by id: {"ids": [...], "campus"?}"""
+    data = request.json
+    ids = data.get("ids")
+    if not isinstance(ids, list):
+        return jsonify({"error": "'ids' must be a list of listing ids"}), 400
+    try:
+        shard = request_campus(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    conn = get_db_connection(shard)
+    deleted_ids = delete_listings(conn, ids, shard)
+    return jsonify({"deleted_ids": deleted_ids})
+
+@app.route("/update", methods=["POST"])
+def update():
+    """Replace a listing's text: {"id": ..., "text": ..., "user_id"?, "user_name"?, "campus"?}"""
+    data = request.json
+    row_id = data["id"]
+    text = data["text"]
+    try:
+        shard = request_campus(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    conn = get_db_connection(shard)
+    if not update_listing(conn, row_id, text, data.get("user_id"), data.get("user_name"), shard):
+        return jsonify({"error": f"listing {row_id} not found"}), 404
+    return jsonify({"id": row_id})
+
 @app.route("/search", methods=["POST"])
 def search_api():
     data = request.json
     query = data["query"]
     max_price = data.get("max_price")
     min_beds = data.get("min_beds")
+    top_k = int(data.get("top_k", 5))
+    min_baths = data.get("min_baths")
+    location = data.get("location")
+    # "vector" (default) or "hybrid" (BM25 + vector, fused)
+    mode = data.get("mode", "vector")
+    if mode not in SEARCH_MODES:
+        return jsonify({"error": f"mode must be one of {', '.join(SEARCH_MODES)}"}), 400
+    # "campus": one campus searches only that shard, "all" or a list fans out
+    # to those shards in parallel; without it the default store is searched
+    campus = data.get("campus")
+    if campus:
+        try:
+            shards = resolve_campuses(campus)
+        except (TypeError, ValueError) as e:
+            return jsonify({"error": str(e)}), 400
+        return jsonify(search_shards(shards, query, max_price, min_beds, top_k, min_baths, location, mode))
     conn = get_db_connection()
-    results = search(conn, query, max_price, min_beds)
+    results = search(conn, query, max_price, min_beds, top_k, min_baths, location, mode)
     return jsonify(results)
 
+@app.route("/searches", methods=["POST"])
+def search_batch_api():
+    """
+    Several searches in one request: {"queries": [{"query": ..., "top_k": ...,
+    "max_price": ..., "min_beds": ..., "min_baths": ..., "location": ...}, ...],
+    "campus"?} (all on the default store or on one campus shard)
+    """
+    data = request.json
+    queries = data.get("queries", [])
+    if not all(isinstance(q, dict) and q.get("query") for q in queries):
+        return jsonify({"error": "every entry of 'queries' needs a 'query'"}), 400
+    try:
+        shard = request_campus(data)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    conn = get_db_connection(shard)
+    return jsonify({"results": search_many(conn, queries, shard)})
+
+@app.route("/stats", methods=["GET"])
+def stats_api():
+    """Runtime counters (index, embedding cache, micro-batching and padding, search cache and dedup)"""
+    index_stats = get_index_stats()
+    shards = loaded_shards()
+    if shards:
+        index_stats["shards"] = {shard: get_index_stats(shard) for shard in shards}
+    return jsonify({
+        "index": index_stats,
+        "embedding_cache": embedding_cache_stats(),
+        "embedding_batches": embedding_batch_stats(),
+        "embedding_padding": embedding_padding_stats(),
+        "query_cache": query_cache_stats(),
+        "dedup": dedup_stats(),
+    })
+
 if __name__ == '__main__':
-    # Run the Flask development server (for production, use a WSGI server like gunicorn)
+    # Run the Flask development server (for production, use a WSGI server like gunicorn).
+    # The debug reloader serves from a child process; only that one starts the background work
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        create_app()
     app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
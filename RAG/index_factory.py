@@ -0,0 +1,178 @@
+import os
+import faiss
+import numpy as np
+from typing import Dict, Tuple
+
+# FAISS index type, as an index_factory string (wrapped in IndexIDMap):
+#   "Flat"          exact brute force (default)
+#   "IVF256,Flat"   inverted lists, exact vectors, FAISS_NPROBE lists probed per query
+#   "IVF256,PQ48"   inverted lists with product-quantized vectors
+#   "HNSW32"        graph index, FAISS_EF_SEARCH candidates explored per query
+#   "SQ8"/"SQfp16"  scalar-quantized vectors, 4x/2x smaller than float32
+#   "PQ48"          product-quantized vectors, 48 bytes each (32x smaller)
+INDEX_FACTORY = os.environ.get("FAISS_INDEX_FACTORY", "Flat")
+FAISS_NPROBE = int(os.environ.get("FAISS_NPROBE", "16"))
+FAISS_EF_SEARCH = int(os.environ.get("FAISS_EF_SEARCH", "64"))
+
+def create_index(factory: str, dim: int):
+    """Build an (untrained) IndexIDMap around the given factory string"""
+    return faiss.IndexIDMap(faiss.index_factory(dim, factory))
+
+def create_empty_index(dim: int, factory: str = INDEX_FACTORY):
+    """
+    Empty index for a fresh deployment. Index types that need training (IVF,
+    PQ) cannot accept vectors yet, so they start as Flat until
+    `python index_tools.py rebuild` trains them on the stored vectors.
+    """
+    index = create_index(factory, dim)
+    if not index.is_trained:
+        print(f"Index type {factory} needs training, starting with Flat until the first rebuild")
+        index = create_index("Flat", dim)
+    return configure_search(index)
+
+def inner_index(index):
+    """The index wrapped by IndexIDMap (or the index itself)"""
+    if hasattr(index, "id_map"):
+        return faiss.downcast_index(index.index)
+    return index
+
+def configure_search(index, nprobe: int = FAISS_NPROBE, ef_search: int = FAISS_EF_SEARCH):
+    """Apply the query-time knobs (nprobe for IVF, efSearch for HNSW)"""
+    inner = inner_index(index)
+    ivf = faiss.try_extract_index_ivf(inner)
+    if ivf is not None:
+        ivf.nprobe = min(nprobe, ivf.nlist)
+    if hasattr(inner, "hnsw"):
+        inner.hnsw.efSearch = ef_search
+    return index
+
+def make_search_params(index, selector):
+    """
+    SearchParameters of the right type for the index. Passing parameters
+    replaces the index defaults, so the configured nprobe/efSearch are
+    copied in alongside the ID selector.
+    """
+    inner = inner_index(index)
+    ivf = faiss.try_extract_index_ivf(inner)
+    if ivf is not None:
+        return faiss.SearchParametersIVF(sel=selector, nprobe=ivf.nprobe)
+    if hasattr(inner, "hnsw"):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=inner.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+# Base index types that keep full float32 vectors
+EXACT_STORAGE_TYPES = {"IndexFlat", "IndexFlatL2", "IndexFlatIP", "IndexIVFFlat", "IndexHNSWFlat"}
+
+def is_compressed(index) -> bool:
+    """True when the index stores quantized vectors and distances are approximate"""
+    return type(inner_index(index)).__name__ not in EXACT_STORAGE_TYPES
+
+def index_memory_bytes(index) -> int:
+    """Size of the serialized index, a close proxy for its resident memory"""
+    return int(faiss.serialize_index(index).nbytes)
+
+def supports_remove(index) -> bool:
+    """HNSW graphs cannot drop vectors; everything else here can"""
+    return not hasattr(inner_index(index), "hnsw")
+
+def extract_vectors(index) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    (ids, vectors) currently stored in an IndexIDMap, in internal order.
+    Exact for Flat/HNSW/IVF-Flat; quantized indexes return their decoded
+    approximation.
+    """
+    ids = faiss.vector_to_array(index.id_map).astype("int64")
+    if index.ntotal == 0:
+        return ids, np.empty((0, index.d), dtype="float32")
+    inner = inner_index(index)
+    ivf = faiss.try_extract_index_ivf(inner)
+    if ivf is not None:
+        ivf.make_direct_map()
+    vectors = inner.reconstruct_n(0, index.ntotal)
+    return ids, np.ascontiguousarray(vectors, dtype="float32")
+
+def rebuild_without(index, drop_ids: np.ndarray):
+    """
+    Copy of `index` without the vectors of drop_ids, for index types that
+    cannot remove (HNSW). Training is kept, only the contents are rebuilt.
+    """
+    ids, vectors = extract_vectors(index)
+    keep = ~np.isin(ids, drop_ids)
+    fresh = faiss.clone_index(index)
+    fresh.reset()
+    if keep.any():
+        fresh.add_with_ids(vectors[keep], ids[keep])
+    return configure_search(fresh)
+
+class IdOffsets:
+    """
+    Vectorized id -> internal offset lookups for an IndexIDMap, from one
+    copy of id_map into numpy (sorted, so lookups are a searchsorted)
+    """
+
+    def __init__(self, index):
+        if hasattr(index, "id_map") and index.ntotal:
+            self.ids = faiss.vector_to_array(index.id_map).astype("int64")
+        else:
+            self.ids = np.empty(0, dtype="int64")
+        self.order = np.argsort(self.ids, kind="stable")
+        self.sorted_ids = self.ids[self.order]
+
+    def __len__(self):
+        return len(self.ids)
+
+    def offsets(self, ids) -> np.ndarray:
+        """Internal offset of each id, -1 where the index does not hold it"""
+        ids = np.asarray(ids, dtype="int64")
+        offsets = np.full(len(ids), -1, dtype="int64")
+        if len(self.sorted_ids) == 0:
+            return offsets
+        positions = np.minimum(np.searchsorted(self.sorted_ids, ids), len(self.sorted_ids) - 1)
+        found = self.sorted_ids[positions] == ids
+        offsets[found] = self.order[positions[found]]
+        return offsets
+
+    def contains(self, ids) -> np.ndarray:
+        """Boolean mask of the ids the index holds"""
+        return self.offsets(ids) >= 0
+
+    def missing(self, ids) -> np.ndarray:
+        """Ids not in the index (sorted)"""
+        return np.setdiff1d(np.asarray(ids, dtype="int64"), self.sorted_ids)
+
+    def extra(self, ids) -> np.ndarray:
+        """Index ids that are not in `ids` (sorted)"""
+        return np.setdiff1d(self.sorted_ids, np.asarray(ids, dtype="int64"))
+
+def reconstruct_at(index, offset: int) -> np.ndarray:
+    """Stored vector at an internal offset (IndexIDMap itself cannot reconstruct)"""
+    inner = inner_index(index)
+    ivf = faiss.try_extract_index_ivf(inner)
+    if ivf is not None:
+        ivf.make_direct_map()
+    return inner.reconstruct(int(offset))
+
+def train_and_fill(factory: str, ids: np.ndarray, vectors: np.ndarray, max_train: int = 100000, seed: int = 1234):
+    """Train a new index of type `factory` on (a sample of) vectors and add them all"""
+    index = create_index(factory, vectors.shape[1])
+    if not index.is_trained:
+        train = vectors
+        if len(vectors) > max_train:
+            rng = np.random.default_rng(seed)
+            train = vectors[rng.choice(len(vectors), max_train, replace=False)]
+        inner_index(index).train(train)
+    if len(ids):
+        index.add_with_ids(vectors, ids)
+    return configure_search(index)
+
+def describe_index(index) -> Dict:
+    """Type and tuning knobs of an index, for stats and reports"""
+    inner = inner_index(index)
+    info = {'index_type': type(index).__name__, 'base_index_type': type(inner).__name__}
+    ivf = faiss.try_extract_index_ivf(inner)
+    if ivf is not None:
+        info['nlist'] = ivf.nlist
+        info['nprobe'] = ivf.nprobe
+    if hasattr(inner, "hnsw"):
+        info['ef_search'] = inner.hnsw.efSearch
+    return info
@@ -0,0 +1,362 @@
+import fcntl
+import os
+import struct
+import threading
+import zlib
+import faiss
+import numpy as np
+from contextlib import contextmanager
+from typing import Callable, Optional, Tuple
+
+# Append-only log of FAISS mutations written next to the index snapshot.
+#
+# Record layout (little-endian):
+#   op      uint8   (1 = add, 2 = delete, 3 = tombstone, 4 = commit)
+#   count   uint32  number of ids
+#   dim     uint32  vector dimension (0 for deletes and tombstones)
+#   crc32   uint32  checksum of the payload
+#   payload ids as int64[count], then vectors as float32[count * dim] for adds
+#
+# A tombstone hides ids from searches without touching the index; a later
+# add or delete of the id clears it. Tombstones still pending when the log is
+# rotated are logged again at the start of the new log. A commit record (no
+# ids) marks that the SQLite rows of earlier records were committed: it leaves
+# the index alone, but readers catching up on it bump their generation.
+#
+# A crash can only leave a torn record at the very end of the file, which
+# fails its length or checksum test and is dropped (and cut off by the writer).
+#
+# Several processes may append to the same log. They hold a shared flock on
+# `<index>.lock` while appending; snapshot() holds it exclusively, so the log
+# is never rotated under a writer, and a writer whose open log was rotated
+# away reopens it by path before its next append.
+OP_ADD = 1
+OP_DELETE = 2
+OP_TOMBSTONE = 3
+OP_COMMIT = 4
+HEADER = struct.Struct("<BIII")
+
+SNAPSHOT_INTERVAL = float(os.environ.get("INDEX_SNAPSHOT_INTERVAL", "60"))  # seconds between checks
+SNAPSHOT_MIN_BYTES = int(os.environ.get("INDEX_SNAPSHOT_MIN_BYTES", str(8 * 1024 * 1024)))
+
+def _fsync_dir(path: str):
+    """Make a rename in `path`'s directory durable (no-op where unsupported)"""
+    directory = os.path.dirname(os.path.abspath(path))
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+def write_snapshot(index, index_file: str):
+    """Write a full index snapshot atomically: temp file, fsync, rename"""
+    data = faiss.serialize_index(index)
+    write_snapshot_bytes(data, index_file)
+
+def write_snapshot_bytes(data, index_file: str):
+    tmp_file = f"{index_file}.tmp"
+    with open(tmp_file, "wb") as f:
+        f.write(memoryview(data))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_file, index_file)
+    _fsync_dir(index_file)
+
+def _read_records(path: str, start_offset: int = 0):
+    """Yield (op, ids, vectors, end_offset) for every intact record of a log file"""
+    if not os.path.exists(path):
+        return
+    with open(path, "rb") as f:
+        f.seek(start_offset)
+        data = f.read()
+    offset = 0
+    while offset + HEADER.size <= len(data):
+        op, count, dim, crc = HEADER.unpack_from(data, offset)
+        payload_size = count * 8 + count * dim * 4
+        start = offset + HEADER.size
+        end = start + payload_size
+        if op not in (OP_ADD, OP_DELETE, OP_TOMBSTONE, OP_COMMIT) or end > len(data):
+            break
+        payload = data[start:end]
+        if zlib.crc32(payload, zlib.crc32(data[offset:offset + HEADER.size - 4])) != crc:
+            break
+        ids = np.frombuffer(payload, dtype="<i8", count=count).astype("int64")
+        vectors = None
+        if op == OP_ADD:
+            vectors = np.frombuffer(payload, dtype="<f4", offset=count * 8).astype("float32").reshape(count, dim)
+        yield op, ids, vectors, start_offset + end
+        offset = end
+
+def _stored_ids(index) -> np.ndarray:
+    """The ids an IndexIDMap holds, as a view of its id_map (no copy)"""
+    if not hasattr(index, "id_map") or index.ntotal == 0:
+        return np.empty(0, dtype="int64")
+    return faiss.rev_swig_ptr(index.id_map.data(), index.id_map.size())
+
+def _holds(index, ids: np.ndarray) -> np.ndarray:
+    """Boolean mask of the ids `index` already holds, without building an id set"""
+    stored = _stored_ids(index)
+    if len(ids) <= 8:
+        # A vectorized scan per id beats np.isin's setup for a few ids
+        return np.array([bool((stored == i).any()) for i in ids], dtype=bool)
+    return np.isin(ids, stored)
+
+class IndexLog:
+    """
+    Write-ahead log for an IndexIDMap-wrapped FAISS index.
+
+    Mutations are appended as (ids, vectors) or delete records and fsync'd
+    per batch, so an insert costs O(batch) disk I/O instead of rewriting the
+    whole index. snapshot() folds the log into a new index file; replay()
+    applies the log on top of the last snapshot at load time.
+    """
+
+    def __init__(self, index_file: str):
+        self.index_file = index_file
+        self.path = f"{index_file}.log"
+        # Log being folded into a snapshot that has not been renamed into place yet
+        self.rotated_path = f"{index_file}.log.old"
+        self.lock_path = f"{index_file}.lock"
+        self.lock = threading.Lock()
+        self.file = None
+        self.lock_file = None
+        self.records_since_snapshot = 0
+        # Times the open log was found rotated away by another process
+        self.reopens = 0
+
+    @contextmanager
+    def _file_lock(self, mode: int):
+        """Cross-process lock on the log (self.lock held, it guards the lock file too)"""
+        if self.lock_file is None:
+            self.lock_file = open(self.lock_path, "ab")
+        fcntl.flock(self.lock_file.fileno(), mode)
+        try:
+            yield
+        finally:
+            fcntl.flock(self.lock_file.fileno(), fcntl.LOCK_UN)
+
+    @contextmanager
+    def locked(self, exclusive: bool = True):
+        """
+        Cross-process lock on the log: exclusive keeps every process from
+        appending, shared only keeps the log from being rotated meanwhile
+        """
+        with self.lock, self._file_lock(fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH):
+            yield
+
+    def signature(self) -> Optional[Tuple]:
+        """Identity of the snapshot file plus whether a rotated log is pending"""
+        try:
+            st = os.stat(self.index_file)
+        except FileNotFoundError:
+            return None
+        return (st.st_ino, st.st_mtime_ns, st.st_size, os.path.exists(self.rotated_path))
+
+    def _rotated(self) -> bool:
+        """Whether the open log is no longer the file at self.path"""
+        try:
+            current = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+        opened = os.fstat(self.file.fileno())
+        return (opened.st_dev, opened.st_ino) != (current.st_dev, current.st_ino)
+
+    def _open(self):
+        if self.file is not None and self._rotated():
+            # Another process folded the log into a snapshot: appending to the
+            # old file would lose the record when that file is deleted
+            self.file.close()
+            self.file = None
+            self.reopens += 1
+        if self.file is None:
+            # Unbuffered O_APPEND: every record reaches the file in one write call,
+            # so records appended by several processes never interleave
+            self.file = open(self.path, "ab", buffering=0)
+        return self.file
+
+    def repair(self):
+        """Cut a torn trailing record off the live log before appending to it"""
+        # Exclusive: a record another process is appending under the shared
+        # lock would look torn too
+        with self.locked(exclusive=True):
+            if not os.path.exists(self.path):
+                return
+            good_end = 0
+            for _, _, _, end in _read_records(self.path):
+                good_end = end
+            if good_end < os.path.getsize(self.path):
+                print(f"Truncating torn FAISS log tail at byte {good_end}")
+                with open(self.path, "r+b") as f:
+                    f.truncate(good_end)
+                    os.fsync(f.fileno())
+
+    @staticmethod
+    def _encode(op: int, ids: np.ndarray, vectors: Optional[np.ndarray]) -> bytes:
+        ids = np.ascontiguousarray(ids, dtype="<i8").reshape(-1)
+        payload = ids.tobytes()
+        dim = 0
+        if vectors is not None:
+            vectors = np.ascontiguousarray(vectors, dtype="<f4")
+            dim = vectors.shape[1]
+            payload += vectors.tobytes()
+        header = struct.pack("<BII", op, ids.shape[0], dim)
+        crc = zlib.crc32(payload, zlib.crc32(header))
+        return header + struct.pack("<I", crc) + payload
+
+    def _write(self, op: int, ids: np.ndarray, vectors: Optional[np.ndarray], sync: bool) -> Tuple[int, int]:
+        record = self._encode(op, ids, vectors)
+        with self.lock, self._file_lock(fcntl.LOCK_SH):
+            f = self._open()
+            f.write(record)
+            end = f.tell()
+            self.records_since_snapshot += 1
+            if sync:
+                os.fsync(f.fileno())
+        return end - len(record), end
+
+    def append_add(self, ids, vectors, sync: bool = True) -> Tuple[int, int]:
+        """Append an add record, returns its (start, end) byte offsets in the live log"""
+        return self._write(OP_ADD, ids, vectors, sync)
+
+    def append_delete(self, ids, sync: bool = True) -> Tuple[int, int]:
+        """Append a delete record, returns its (start, end) byte offsets in the live log"""
+        return self._write(OP_DELETE, ids, None, sync)
+
+    def append_tombstone(self, ids, sync: bool = True) -> Tuple[int, int]:
+        """Append a tombstone record, returns its (start, end) byte offsets in the live log"""
+        return self._write(OP_TOMBSTONE, ids, None, sync)
+
+    def append_commit(self) -> Tuple[int, int]:
+        """Append a commit marker (not fsync'd, it carries no data)"""
+        return self._write(OP_COMMIT, np.empty(0, dtype="int64"), None, sync=False)
+
+    def sync(self):
+        """fsync everything appended so far (end of a batch)"""
+        with self.lock:
+            if self.file is not None:
+                os.fsync(self.file.fileno())
+
+    def size(self) -> int:
+        """Bytes of log not yet folded into a snapshot"""
+        total = 0
+        for path in (self.rotated_path, self.path):
+            if os.path.exists(path):
+                total += os.path.getsize(path)
+        return total
+
+    def replay(self, index, start_offset: int = 0, stop_offset: Optional[int] = None,
+               include_rotated: bool = True, tombstones: Optional[set] = None) -> int:
+        """
+        Apply the rotated log and then the live log on top of `index`.
+        Replay is idempotent (an add first drops any vector already stored
+        under the same id), so a log that was already folded into the
+        snapshot can safely be applied again after a crash.
+        start_offset/stop_offset restrict the live log to a byte range (used to
+        catch up on records another process appended). Tombstone records are
+        applied to the `tombstones` set when one is given. Returns the live-log
+        offset replay stopped at.
+        A full replay (include_rotated) builds the set of stored ids once; a
+        catch-up only looks up the ids of each record it applies.
+        """
+        present = None
+
+        sources = [(self.path, start_offset)]
+        if include_rotated:
+            sources.insert(0, (self.rotated_path, 0))
+
+        applied = 0
+        live_end = start_offset
+        for path, offset in sources:
+            for op, ids, vectors, end in _read_records(path, offset):
+                if path == self.path:
+                    if stop_offset is not None and end > stop_offset:
+                        break
+                    live_end = end
+                if op == OP_COMMIT:
+                    continue
+                applied += 1
+                if op == OP_TOMBSTONE:
+                    if tombstones is not None:
+                        tombstones.update(ids.tolist())
+                    continue
+                if tombstones is not None:
+                    tombstones.difference_update(ids.tolist())
+                if include_rotated:
+                    if present is None:
+                        present = set(_stored_ids(index).tolist())
+                    stale = [int(i) for i in ids if int(i) in present]
+                else:
+                    stale = ids[_holds(index, ids)].tolist()
+                if stale:
+                    index.remove_ids(np.array(stale, dtype="int64"))
+                    if present is not None:
+                        present.difference_update(stale)
+                if op == OP_ADD:
+                    index.add_with_ids(vectors, ids)
+                    if present is not None:
+                        present.update(ids.tolist())
+        if applied:
+            print(f"Replayed {applied} FAISS log records, index has {index.ntotal} vectors")
+        return live_end
+
+    def snapshot(self, current_index: Callable, index_lock, before_serialize=None, after_rotate=None,
+                 tombstones: Optional[Callable] = None):
+        """
+        Fold the log into a new snapshot of current_index().
+        The index is serialized and the log rotated while holding index_lock,
+        so no mutation can fall between the two. The slow disk write happens
+        after index_lock is released, but the exclusive log lock is kept until
+        the rotated log is gone: other processes cannot append in between, and
+        a second snapshot cannot start from a half-folded log. The optional
+        hooks run under both locks; tombstones() gives the ids to carry over
+        into the new log.
+        """
+        # Same lock order as an append (index_lock, self.lock, file lock);
+        # index_lock alone is released before the disk write
+        index_lock.__enter__()
+        index_locked = True
+        try:
+            with self.lock, self._file_lock(fcntl.LOCK_EX):
+                if before_serialize is not None:
+                    before_serialize()
+                index = current_index()
+                data = faiss.serialize_index(index)
+                if self.file is not None:
+                    os.fsync(self.file.fileno())
+                    self.file.close()
+                    self.file = None
+                if os.path.exists(self.path):
+                    if os.path.exists(self.rotated_path):
+                        # A previous snapshot failed: keep both logs, in order
+                        with open(self.rotated_path, "ab") as old, open(self.path, "rb") as new:
+                            old.write(new.read())
+                            old.flush()
+                            os.fsync(old.fileno())
+                        os.remove(self.path)
+                    else:
+                        os.replace(self.path, self.rotated_path)
+                    _fsync_dir(self.path)
+                self.records_since_snapshot = 0
+                carried = tombstones() if tombstones is not None else ()
+                if len(carried):
+                    f = self._open()
+                    f.write(self._encode(OP_TOMBSTONE, np.asarray(carried, dtype="int64"), None))
+                    os.fsync(f.fileno())
+                if after_rotate is not None:
+                    after_rotate()
+                index_lock.__exit__(None, None, None)
+                index_locked = False
+
+                write_snapshot_bytes(data, self.index_file)
+                if os.path.exists(self.rotated_path):
+                    os.remove(self.rotated_path)
+                    _fsync_dir(self.path)
+        finally:
+            if index_locked:
+                index_lock.__exit__(None, None, None)
+        print(f"Wrote FAISS snapshot with {index.ntotal} vectors")
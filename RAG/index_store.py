@@ -0,0 +1,348 @@
+import os
+import threading
+import time
+import numpy as np
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+from index_factory import IdOffsets, rebuild_without, supports_remove
+
+# Seconds between checks for a newer on-disk index published by another process
+INDEX_RELOAD_CHECK_INTERVAL = float(os.environ.get("INDEX_RELOAD_CHECK_INTERVAL", "1.0"))
+
+# Deleted vectors stay in the index as tombstones until this many have
+# accumulated, or this fraction of the index is dead, then they are compacted
+TOMBSTONE_COMPACT_THRESHOLD = int(os.environ.get("TOMBSTONE_COMPACT_THRESHOLD", "256"))
+TOMBSTONE_COMPACT_RATIO = float(os.environ.get("TOMBSTONE_COMPACT_RATIO", "0.1"))
+
+class RWLock:
+    """Readers-writer lock; waiting writers block new readers so they cannot starve"""
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = 0
+        self.writer = None
+        self.writer_depth = 0
+        self.writers_waiting = 0
+
+    def acquire_read(self):
+        with self.cond:
+            me = threading.get_ident()
+            if self.writer == me:
+                # A writer may read what it is writing
+                self.writer_depth += 1
+                return
+            while self.writer is not None or self.writers_waiting:
+                self.cond.wait()
+            self.readers += 1
+
+    def release_read(self):
+        with self.cond:
+            if self.writer == threading.get_ident():
+                self.writer_depth -= 1
+                return
+            self.readers -= 1
+            if self.readers == 0:
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        with self.cond:
+            me = threading.get_ident()
+            if self.writer == me:
+                self.writer_depth += 1
+                return
+            self.writers_waiting += 1
+            while self.writer is not None or self.readers:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = me
+            self.writer_depth = 1
+
+    def release_write(self):
+        with self.cond:
+            self.writer_depth -= 1
+            if self.writer_depth == 0:
+                self.writer = None
+                self.cond.notify_all()
+
+    @contextmanager
+    def read_locked(self):
+        self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read()
+
+    @contextmanager
+    def write_locked(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+class _WriteLockContext:
+    """Reusable `with` adapter so IndexLog.snapshot can take the write lock"""
+
+    def __init__(self, lock: RWLock):
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire_write()
+
+    def __exit__(self, *exc):
+        self.lock.release_write()
+
+class IndexHolder:
+    """
+    The one FAISS index of a process, shared by search and insert.
+
+    Readers (search) take a shared lock and writers (insert/delete) an
+    exclusive one. Every local mutation bumps `generation`. The on-disk
+    state (snapshot file + mutation log) is checked at most every
+    INDEX_RELOAD_CHECK_INTERVAL seconds: records another process appended to
+    the log are replayed incrementally, and a new snapshot triggers a full
+    reload. Otherwise a query never touches the disk.
+
+    Deletes are tombstoned: the ids are logged and excluded from searches
+    immediately (in every process, through the log) and their vectors are
+    dropped later, in one pass, by compact().
+    """
+
+    def __init__(self, load_snapshot: Callable, index_log, check_interval: float = INDEX_RELOAD_CHECK_INTERVAL):
+        self.load_snapshot = load_snapshot
+        self.log = index_log
+        self.check_interval = check_interval
+        self.lock = RWLock()
+        self.write_lock = _WriteLockContext(self.lock)
+        self.generation = 0
+        self.index = None
+        self.snapshot_signature = None
+        self.log_offset = 0
+        self.log_reopens = index_log.reopens
+        self.last_check = 0.0
+        self.snapshotting = False
+        self.reloads = 0
+        self.catch_ups = 0
+        self.tombstones = set()
+        self.tombstone_array = np.empty(0, dtype="int64")
+        self.compactions = 0
+        self._id_offsets = None
+        self._id_offsets_generation = None
+        self.reload()
+
+    def _live_log_size(self) -> int:
+        try:
+            return os.path.getsize(self.log.path)
+        except FileNotFoundError:
+            return 0
+
+    def reload(self):
+        """Load the last snapshot and replay the whole log (startup or a newer snapshot)"""
+        with self.lock.write_locked():
+            signature = self.log.signature()
+            index = self.load_snapshot()
+            tombstones = set()
+            self.log_offset = self.log.replay(index, tombstones=tombstones)
+            self.index = index
+            self._set_tombstones(tombstones)
+            self.snapshot_signature = self.log.signature() if signature is None else signature
+            self.generation += 1
+            self.reloads += 1
+
+    def _catch_up(self, stop_offset: Optional[int] = None):
+        """Replay log records appended by other processes (write lock held)"""
+        tombstones = set(self.tombstones)
+        new_offset = self.log.replay(self.index, start_offset=self.log_offset,
+                                     stop_offset=stop_offset, include_rotated=False, tombstones=tombstones)
+        if new_offset != self.log_offset:
+            self.log_offset = new_offset
+            if tombstones != self.tombstones:
+                self._set_tombstones(tombstones)
+            self.generation += 1
+            self.catch_ups += 1
+
+    def refresh(self, force: bool = False):
+        """Pick up changes another process published on disk"""
+        now = time.monotonic()
+        if self.snapshotting or (not force and now - self.last_check < self.check_interval):
+            return
+        self.last_check = now
+
+        if self.log.signature() != self.snapshot_signature:
+            self.reload()
+        elif self._live_log_size() > self.log_offset:
+            with self.lock.write_locked():
+                self._catch_up()
+
+    @contextmanager
+    def read(self):
+        """Shared access to the current index: `with holder.read() as index:`"""
+        self.refresh()
+        with self.lock.read_locked():
+            yield self.index
+
+    @contextmanager
+    def write(self):
+        """Exclusive access to the current index"""
+        with self.lock.write_locked():
+            yield self.index
+
+    def _applied(self, start: int, end: int):
+        """Account for a record this process appended at [start, end)"""
+        if self.log.reopens != self.log_reopens:
+            # Another process snapshotted since our last append, so log_offset
+            # points into the old log: reload (the new log has our record)
+            self.log_reopens = self.log.reopens
+            self.reload()
+            return
+        if start > self.log_offset:
+            # Another process appended in between: apply its records too
+            self._catch_up(stop_offset=start)
+        self.log_offset = max(self.log_offset, end)
+        self.generation += 1
+
+    def add(self, embeddings, row_ids, sync: bool = True):
+        """Add vectors to the index and append them to the mutation log"""
+        embeddings = np.ascontiguousarray(embeddings, dtype="float32")
+        row_ids = np.ascontiguousarray(row_ids, dtype="int64")
+        with self.lock.write_locked():
+            self.index.add_with_ids(embeddings, row_ids)
+            try:
+                start, end = self.log.append_add(row_ids, embeddings, sync=sync)
+            except Exception:
+                # Not durable, so not visible either
+                self.index.remove_ids(row_ids)
+                raise
+            self._applied(start, end)
+            self._untombstone(row_ids)
+
+    def remove(self, row_ids, sync: bool = True) -> int:
+        """Remove vectors from the index and log the delete"""
+        row_ids = np.ascontiguousarray(row_ids, dtype="int64")
+        with self.lock.write_locked():
+            start, end = self.log.append_delete(row_ids, sync=sync)
+            removed = self.index.remove_ids(row_ids)
+            self._applied(start, end)
+            self._untombstone(row_ids)
+            return removed
+
+    def committed(self):
+        """
+        Call once the SQLite rows of vectors added before their commit are
+        committed: searches in between may have cached results without those
+        rows. Bumps the generation here and, through a logged marker, in every
+        process that catches up on it.
+        """
+        with self.lock.write_locked():
+            start, end = self.log.append_commit()
+            self._applied(start, end)
+
+    def id_offsets(self) -> IdOffsets:
+        """id -> offset lookups for the current index, rebuilt only after a mutation"""
+        with self.lock.read_locked():
+            if self._id_offsets_generation != self.generation:
+                self._id_offsets = IdOffsets(self.index)
+                self._id_offsets_generation = self.generation
+            return self._id_offsets
+
+    def _set_tombstones(self, tombstones):
+        self.tombstones = tombstones
+        self.tombstone_array = np.array(sorted(tombstones), dtype="int64")
+        self.generation += 1
+
+    def _untombstone(self, row_ids):
+        """An add or delete of an id clears its tombstone, as replay does"""
+        if self.tombstones:
+            cleared = self.tombstones.intersection(int(i) for i in row_ids)
+            if cleared:
+                self._set_tombstones(self.tombstones - cleared)
+
+    def tombstone(self, row_ids, sync: bool = True):
+        """Hide vectors from searches now; compact() drops them from the index later"""
+        row_ids = np.ascontiguousarray(row_ids, dtype="int64")
+        if len(row_ids) == 0:
+            return
+        with self.lock.write_locked():
+            start, end = self.log.append_tombstone(row_ids, sync=sync)
+            self._applied(start, end)
+            self._set_tombstones(self.tombstones | {int(i) for i in row_ids})
+
+    def excluded_ids(self) -> np.ndarray:
+        """Sorted tombstoned ids, for search to filter out (read lock held)"""
+        return self.tombstone_array
+
+    def needs_compaction(self) -> bool:
+        count = len(self.tombstones)
+        if count == 0:
+            return False
+        return count >= TOMBSTONE_COMPACT_THRESHOLD or count >= TOMBSTONE_COMPACT_RATIO * max(self.index.ntotal, 1)
+
+    def compact(self) -> int:
+        """
+        Drop tombstoned vectors from the index. Indexes that support it use a
+        logged remove_ids; HNSW is rebuilt without them and snapshotted, since
+        the log cannot express a rebuild. Returns the number of vectors dropped.
+        """
+        with self.lock.write_locked():
+            ids = self.tombstone_array
+            if len(ids) == 0:
+                return 0
+            if supports_remove(self.index):
+                removed = self.remove(ids)
+                rebuilt = False
+            else:
+                before = self.index.ntotal
+                self.index = rebuild_without(self.index, ids)
+                removed = before - self.index.ntotal
+                rebuilt = True
+            if rebuilt:
+                # remove() cleared them otherwise; the snapshot drops their records
+                self._set_tombstones(self.tombstones - set(ids.tolist()))
+            self.compactions += 1
+        if rebuilt:
+            self.snapshot()
+        print(f"Compacted {removed} deleted vectors, index has {self.index.ntotal} vectors")
+        return removed
+
+    def replace(self, embeddings, row_ids, sync: bool = True):
+        """Swap the stored vectors of existing ids (listing updates)"""
+        with self.lock.write_locked():
+            if supports_remove(self.index):
+                self.remove(row_ids, sync=sync)
+            else:
+                self.tombstone(row_ids, sync=sync)
+                self.compact()
+            self.add(embeddings, row_ids, sync=sync)
+
+    def snapshot(self):
+        """Fold the log into a new snapshot file and remember it as our own version"""
+        def catch_up():
+            # Records other processes logged must not be dropped with the old log
+            if self.log.signature() != self.snapshot_signature:
+                self.reload()
+            else:
+                self._catch_up()
+
+        def reset_offset():
+            # The new log only holds the tombstones carried over
+            self.log_offset = self._live_log_size()
+
+        self.snapshotting = True
+        try:
+            self.log.snapshot(lambda: self.index, self.write_lock,
+                              before_serialize=catch_up, after_rotate=reset_offset,
+                              tombstones=lambda: self.tombstone_array)
+            with self.lock.write_locked():
+                self.snapshot_signature = self.log.signature()
+        finally:
+            self.snapshotting = False
+
+    def stats(self) -> Dict:
+        return {
+            'generation': self.generation,
+            'reloads': self.reloads,
+            'catch_ups': self.catch_ups,
+            'log_offset': self.log_offset,
+            'tombstones': len(self.tombstones),
+            'compactions': self.compactions,
+        }
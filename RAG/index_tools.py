@@ -0,0 +1,365 @@
+import json
+import sqlite3
+import sys
+import time
+import faiss
+import numpy as np
+from contextlib import nullcontext
+from typing import Dict, Tuple
+from index_factory import (create_index, configure_search, extract_vectors, train_and_fill, describe_index,
+                           is_compressed, index_memory_bytes)
+from index_log import IndexLog
+from index_store import IndexHolder
+from db import init_db, get_sync_state, set_sync_state
+
+class IndexChanged(Exception):
+    """Another process installed a snapshot while a new index was being built"""
+
+def read_current_index(faiss_index_path: str) -> Tuple:
+    """
+    Last snapshot plus the mutation log, exactly what the service would load,
+    and the log position it reflects (for install_index)
+    """
+    index_log = IndexLog(faiss_index_path)
+    # Shared lock: writers may append meanwhile, but nobody can rotate the log
+    with index_log.locked(exclusive=False):
+        signature = index_log.signature()
+        index = configure_search(faiss.read_index(faiss_index_path))
+        offset = index_log.replay(index)
+    return index, (signature, offset)
+
+def load_current_index(faiss_index_path: str):
+    return read_current_index(faiss_index_path)[0]
+
+def load_live_vectors(db_path: str, index) -> Tuple[np.ndarray, np.ndarray, Dict]:
+    """(ids, vectors) of an index restricted to ids that still exist in SQLite"""
+    ids, vectors = extract_vectors(index)
+
+    conn = sqlite3.connect(db_path)
+    try:
+        sqlite_ids = np.array([row[0] for row in conn.execute("SELECT id FROM listings")], dtype="int64")
+    finally:
+        conn.close()
+
+    keep = np.isin(ids, sqlite_ids)
+    info = {
+        'source_index': describe_index(index),
+        'vectors': int(index.ntotal),
+        'orphans_dropped': int((~keep).sum()),
+        'rows_without_vector': int((~np.isin(sqlite_ids, ids)).sum()),
+    }
+    return ids[keep], vectors[keep], info
+
+def rerank_with_originals(queries: np.ndarray, candidate_ids: np.ndarray, ids: np.ndarray,
+                          vectors: np.ndarray, k: int) -> np.ndarray:
+    """Exact top-k among each query's candidates, using the original float32 vectors"""
+    order = np.argsort(ids)
+    sorted_ids = ids[order]
+    reranked = np.full((len(queries), k), -1, dtype="int64")
+    for row, (query, candidates) in enumerate(zip(queries, candidate_ids)):
+        candidates = candidates[candidates != -1]
+        positions = order[np.searchsorted(sorted_ids, candidates)]
+        diffs = vectors[positions] - query
+        best = np.argsort(np.einsum("ij,ij->i", diffs, diffs), kind="stable")[:k]
+        reranked[row, :len(best)] = candidates[best]
+    return reranked
+
+def evaluate_recall(exact_index, candidate_index, queries: np.ndarray, k: int = 10,
+                    originals: Tuple[np.ndarray, np.ndarray] = None, rerank_factor: int = 4) -> Dict:
+    """
+    recall@k of candidate_index against exact_index, plus per-query latency of both.
+    With originals=(ids, vectors) the candidate index fetches k * rerank_factor
+    hits that are re-ranked exactly, as search does for compressed indexes.
+    """
+    k = min(k, exact_index.ntotal)
+    if k == 0 or len(queries) == 0:
+        return {'k': k, 'queries': 0}
+
+    start = time.perf_counter()
+    _, exact_ids = exact_index.search(queries, k)
+    exact_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    start = time.perf_counter()
+    if originals is not None:
+        fetch_k = min(k * rerank_factor, candidate_index.ntotal)
+        _, candidate_ids = candidate_index.search(queries, fetch_k)
+        candidate_ids = rerank_with_originals(queries, candidate_ids, originals[0], originals[1], k)
+    else:
+        _, candidate_ids = candidate_index.search(queries, k)
+    candidate_ms = (time.perf_counter() - start) * 1000 / len(queries)
+
+    hits = 0
+    total = 0
+    for truth, found in zip(exact_ids, candidate_ids):
+        truth = truth[truth != -1]
+        hits += np.intersect1d(truth, found).size
+        total += truth.size
+
+    return {
+        'k': k,
+        'queries': len(queries),
+        'recall_at_k': round(hits / total, 4) if total else 1.0,
+        'exact_ms_per_query': round(exact_ms, 4),
+        'candidate_ms_per_query': round(candidate_ms, 4),
+        'latency_saved_ms_per_query': round(exact_ms - candidate_ms, 4),
+        'speedup': round(exact_ms / candidate_ms, 2) if candidate_ms > 0 else None,
+    }
+
+def sample_queries(vectors: np.ndarray, n_queries: int = 200, seed: int = 1234) -> np.ndarray:
+    """Stored vectors used as queries (the same distribution real queries hit)"""
+    if len(vectors) <= n_queries:
+        return vectors
+    rng = np.random.default_rng(seed)
+    return vectors[rng.choice(len(vectors), n_queries, replace=False)]
+
+def rebuild_index(db_path: str, faiss_index_path: str, factory: str, k: int = 10, dry_run: bool = False) -> Dict:
+    """
+    Train a `factory` index on the existing vectors and SQLite ids, report
+    its recall@k and latency against an exact index, and (unless dry_run)
+    install it as the new snapshot. A running service picks the new
+    snapshot up on its next reload check.
+    """
+    current, read_position = read_current_index(faiss_index_path)
+    ids, vectors, report = load_live_vectors(db_path, current)
+
+    start = time.perf_counter()
+    candidate = train_and_fill(factory, ids, vectors)
+    report['build_seconds'] = round(time.perf_counter() - start, 3)
+    report['target_index'] = describe_index(candidate)
+
+    exact = create_index("Flat", vectors.shape[1])
+    if len(ids):
+        exact.add_with_ids(vectors, ids)
+    report['evaluation'] = evaluate_recall(exact, candidate, sample_queries(vectors), k)
+
+    report['installed'] = install_index(candidate, faiss_index_path, read_position) if not dry_run else False
+    return report
+
+def install_index(index, faiss_index_path: str, read_position: Tuple) -> bool:
+    """
+    Install `index` as the new snapshot. Records other processes logged after
+    `read_position` (from read_current_index) are replayed onto it first,
+    under the exclusive log lock, and the log is then rotated away like for
+    any snapshot, so writers holding it open reopen it; tombstones logged
+    meanwhile are carried over into the new log. Returns False, and
+    installs nothing, if another snapshot was written since the read.
+    """
+    index_log = IndexLog(faiss_index_path)
+    signature, offset = read_position
+    tombstones = set()
+
+    def replay_newer():
+        if index_log.signature() != signature:
+            raise IndexChanged()
+        index_log.replay(index, start_offset=offset, include_rotated=False, tombstones=tombstones)
+
+    try:
+        index_log.snapshot(lambda: index, nullcontext(), before_serialize=replay_newer,
+                           tombstones=lambda: sorted(tombstones))
+    except IndexChanged:
+        print("The index changed on disk during the rebuild, not installing it (run it again)")
+        return False
+    return True
+
+def load_texts(db_path: str, ids: np.ndarray) -> list:
+    """Listing texts in the order of `ids`"""
+    conn = sqlite3.connect(db_path)
+    try:
+        texts = dict(conn.execute("SELECT id, text FROM listings"))
+    finally:
+        conn.close()
+    return [texts[int(row_id)] for row_id in ids]
+
+def compress_index(db_path: str, faiss_index_path: str, factory: str, k: int = 10, dry_run: bool = False) -> Dict:
+    """
+    Convert the installed index to a compressed one (SQ8, SQfp16, PQ48,
+    IVF256,PQ48, ...). The original float32 vectors are written to the
+    embedding cache first, so search can re-rank the compressed candidates
+    exactly. Reports memory per vector and recall@k with and without re-ranking.
+    """
+    from embedder import lookup_cached_vectors, seed_embedding_cache
+    from search import RERANK_FACTOR
+
+    current, read_position = read_current_index(faiss_index_path)
+    ids, vectors, report = load_live_vectors(db_path, current)
+    texts = load_texts(db_path, ids)
+
+    if is_compressed(current):
+        # Decoded vectors are approximate: prefer the cached originals
+        cached = lookup_cached_vectors(texts)
+        for position, text in enumerate(texts):
+            if text in cached:
+                vectors[position] = cached[text]
+        report['originals_from_cache'] = len(cached)
+    else:
+        seed_embedding_cache(texts, vectors)
+        report['originals_cached'] = len(texts)
+
+    candidate = train_and_fill(factory, ids, vectors)
+    report['target_index'] = describe_index(candidate)
+
+    source_bytes = index_memory_bytes(current)
+    target_bytes = index_memory_bytes(candidate)
+    count = max(len(ids), 1)
+    report['memory'] = {
+        'source_bytes': source_bytes,
+        'target_bytes': target_bytes,
+        'source_bytes_per_vector': round(source_bytes / count, 1),
+        'target_bytes_per_vector': round(target_bytes / count, 1),
+        'reduction': round(source_bytes / target_bytes, 2) if target_bytes else None,
+    }
+
+    exact = create_index("Flat", vectors.shape[1])
+    if len(ids):
+        exact.add_with_ids(vectors, ids)
+    queries = sample_queries(vectors)
+    report['evaluation'] = evaluate_recall(exact, candidate, queries, k)
+    report['evaluation_reranked'] = evaluate_recall(exact, candidate, queries, k,
+                                                    originals=(ids, vectors), rerank_factor=RERANK_FACTOR)
+
+    report['installed'] = install_index(candidate, faiss_index_path, read_position) if not dry_run else False
+    return report
+
+def fetch_texts(conn, ids) -> Dict[int, str]:
+    """{id: text} for the given listing ids (one IN query per 500 ids)"""
+    ids = [int(row_id) for row_id in ids]
+    texts = {}
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        placeholders = ','.join(['?' for _ in chunk])
+        texts.update(conn.execute(f"SELECT id, text FROM listings WHERE id IN ({placeholders})", chunk))
+    return texts
+
+def reconcile_index(db_path: str, faiss_index_path: str, full: bool = False, dry_run: bool = False,
+                    batch_size: int = 256) -> Dict:
+    """
+    Repair drift between SQLite and the index (e.g. a crash between the
+    SQLite commit and the index write): rows without a vector are
+    re-embedded in batches, vectors without a row are removed.
+
+    Only listings changed since the last reconciliation are checked: the
+    listing_changes table (filled by triggers) is read from the high-water
+    mark kept in sync_state. The first run, or full=True, compares every id.
+    Repairs go through the mutation log, so a running service replays them.
+    """
+    from embedder import get_embedder
+
+    conn = init_db(db_path)
+    holder = IndexHolder(lambda: configure_search(faiss.read_index(faiss_index_path)),
+                         IndexLog(faiss_index_path), check_interval=0)
+    mark = get_sync_state(conn, 'reconciled_change')
+    # Changes up to the mark are pruned, so an empty table means nothing new
+    latest = max(conn.execute("SELECT COALESCE(MAX(seq), 0) FROM listing_changes").fetchone()[0], mark or 0)
+
+    index_ids = holder.id_offsets()
+    if full or mark is None:
+        sqlite_ids = np.fromiter((row[0] for row in conn.execute("SELECT id FROM listings")), dtype="int64")
+        missing = index_ids.missing(sqlite_ids)
+        orphans = index_ids.extra(sqlite_ids)
+        report = {'mode': 'full', 'checked': len(sqlite_ids)}
+    else:
+        changed = np.fromiter(
+            (row[0] for row in conn.execute(
+                "SELECT DISTINCT listing_id FROM listing_changes WHERE seq > ? AND seq <= ?", (mark, latest))),
+            dtype="int64"
+        )
+        existing = np.array(sorted(fetch_texts(conn, changed)), dtype="int64")
+        missing = index_ids.missing(existing)
+        gone = np.setdiff1d(changed, existing)
+        orphans = gone[index_ids.contains(gone)]
+        report = {'mode': 'incremental', 'since_change': mark, 'checked': len(changed)}
+
+    report.update({
+        'index_vectors': len(index_ids),
+        'missing_in_faiss': len(missing),
+        'orphans_in_faiss': len(orphans),
+        'dry_run': dry_run,
+    })
+    if dry_run:
+        report['missing_ids'] = missing[:100].tolist()
+        report['orphan_ids'] = orphans[:100].tolist()
+        return report
+
+    # Step 1: Re-embed the rows without a vector, one batch at a time
+    start = time.perf_counter()
+    embedder = get_embedder()
+    reembedded = 0
+    for offset in range(0, len(missing), batch_size):
+        chunk = missing[offset:offset + batch_size]
+        # Re-check after catching up, a live insert may have logged its vector meanwhile
+        holder.refresh(force=True)
+        chunk = chunk[~holder.id_offsets().contains(chunk)]
+        texts = fetch_texts(conn, chunk)
+        chunk = np.array([row_id for row_id in chunk if int(row_id) in texts], dtype="int64")
+        if len(chunk) == 0:
+            continue
+        vectors = embedder.embed_texts([texts[int(row_id)] or "" for row_id in chunk])
+        holder.add(vectors, chunk, sync=False)
+        reembedded += len(chunk)
+    if reembedded:
+        holder.log.sync()
+
+    # Step 2: Drop vectors whose rows are gone (logged remove, or rebuild for HNSW)
+    removed = 0
+    if len(orphans):
+        holder.tombstone(orphans)
+        removed = holder.compact()
+
+    # Step 3: Advance the high-water mark and forget the changes it covers
+    set_sync_state(conn, 'reconciled_change', latest)
+    conn.execute("DELETE FROM listing_changes WHERE seq <= ?", (latest,))
+    conn.commit()
+    conn.close()
+
+    report.update({
+        'reembedded': reembedded,
+        'removed': removed,
+        'high_water_mark': latest,
+        'repair_seconds': round(time.perf_counter() - start, 3),
+    })
+    return report
+
+def evaluate_index(db_path: str, faiss_index_path: str, k: int = 10) -> Dict:
+    """recall@k and latency of the installed index against exact search"""
+    index = load_current_index(faiss_index_path)
+    ids, vectors, report = load_live_vectors(db_path, index)
+    exact = create_index("Flat", vectors.shape[1])
+    if len(ids):
+        exact.add_with_ids(vectors, ids)
+    report['evaluation'] = evaluate_recall(exact, index, sample_queries(vectors), k)
+    return report
+
+# CLI interface
+if __name__ == "__main__":
+    if len(sys.argv) < 4:
+        print("Usage: python index_tools.py <sqlite_db_path> <faiss_index_path> <command>")
+        print("Commands:")
+        print("  rebuild <factory> [k] [--dry-run]   e.g. rebuild IVF256,Flat | IVF256,PQ48 | HNSW32 | Flat")
+        print("  compress <factory> [k] [--dry-run]  e.g. compress SQ8 | SQfp16 | PQ48 | IVF256,PQ48")
+        print("  evaluate [k]                        recall@k of the installed index vs exact search")
+        print("  reconcile [--full] [--dry-run]      re-embed rows missing from the index, drop orphan vectors")
+        sys.exit(1)
+
+    db_path, faiss_index_path, command = sys.argv[1], sys.argv[2], sys.argv[3]
+    args = [arg for arg in sys.argv[4:] if not arg.startswith("--")]
+
+    if command == 'rebuild' and args:
+        k = int(args[1]) if len(args) > 1 else 10
+        report = rebuild_index(db_path, faiss_index_path, args[0], k, dry_run='--dry-run' in sys.argv)
+        print(json.dumps(report, indent=2))
+
+    elif command == 'compress' and args:
+        k = int(args[1]) if len(args) > 1 else 10
+        report = compress_index(db_path, faiss_index_path, args[0], k, dry_run='--dry-run' in sys.argv)
+        print(json.dumps(report, indent=2))
+
+    elif command == 'evaluate':
+        k = int(args[0]) if args else 10
+        print(json.dumps(evaluate_index(db_path, faiss_index_path, k), indent=2))
+
+    elif command == 'reconcile':
+        report = reconcile_index(db_path, faiss_index_path, full='--full' in sys.argv, dry_run='--dry-run' in sys.argv)
+        print(json.dumps(report, indent=2))
+
+    else:
+        print("Unknown command or missing parameters")
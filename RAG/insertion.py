@@ -1,43 +1,176 @@
 import faiss
-import requests
 import numpy as np
 import json
 import os
-from extraction import extract_metadata
+import threading
+import time
+from extraction import extract_metadata, extract_metadata_batch
+from embedder import get_embedder, dim
+from index_log import IndexLog, write_snapshot, SNAPSHOT_INTERVAL, SNAPSHOT_MIN_BYTES
+from index_store import IndexHolder
+from index_factory import create_empty_index, configure_search, describe_index
+from metadata_store import mirror_listings, unmirror_listings
+from dedup import DEDUP_MODE, check_duplicates, record_duplicates, remember_listings, forget_listings, minhash
+from shards import shard_index_file
 
 # Initialize FAISS index (dimension = 384 for MiniLM)
-dim = 384
 index_file = 'faiss_listings_index.idx'
 
-def get_or_create_index():
-    """Get existing index or create new one with ID support"""
+# Mutations are appended to faiss_listings_index.idx.log instead of rewriting the index
+index_log = IndexLog(index_file)
+
+def load_index_snapshot(path=None):
+    """Load the last index snapshot, or create and save an empty index with ID support"""
     global index_file, dim
+    path = path or index_file
     
-    if os.path.exists(index_file):
+    if os.path.exists(path):
         # Load existing index
         try:
-            index = faiss.read_index(index_file)
+            index = faiss.read_index(path)
             print(f"Loaded existing FAISS index with {index.ntotal} vectors")
-            return index
+            return configure_search(index)
         except Exception as e:
             print(f"Error loading index: {e}, creating new one...")
     
-    # Create new index with ID support
-    base_index = faiss.IndexFlatL2(dim)
-    index = faiss.IndexIDMap(base_index)  # This wrapper enables add_with_ids
+    # Create new index with ID support (IndexIDMap around FAISS_INDEX_FACTORY)
+    index = create_empty_index(dim)
     
     # Save the empty index
-    faiss.write_index(index, index_file)
+    write_snapshot(index, path)
     print("Created new FAISS index with ID support")
     return index
 
-# Initialize index once when module is imported
-index = get_or_create_index()
+def get_or_create_index(repair_log=False):
+    """
+    Get existing index or create new one with ID support.
+    The on-disk state is the last snapshot plus the mutation log replayed on top.
+    repair_log cuts a torn trailing record off the log (writer process only).
+    This always reads from disk; in-process code should use get_index_holder() instead.
+    """
+    index = load_index_snapshot()
+    if repair_log:
+        index_log.repair()
+    index_log.replay(index)
+    return index
+
+# One shared index per process, used by both search and insert. Nothing is
+# read from disk at import: each index (the default store's and every campus
+# shard's) is loaded on first use, or up front by lifecycle.warm_up()
+_holders = {}
+_holders_lock = threading.Lock()
+
+def get_index_holder(shard=None):
+    """
+    The process-wide index holder (reader/writer locked, reloads on newer disk
+    state) of the default store, or of a campus shard
+    """
+    holder = _holders.get(shard)
+    if holder is None:
+        with _holders_lock:
+            holder = _holders.get(shard)
+            if holder is None:
+                path = shard_index_file(shard, index_file)
+                log = index_log if shard is None else IndexLog(path)
+                log.repair()
+                holder = IndexHolder(lambda: load_index_snapshot(path), log)
+                _holders[shard] = holder
+    return holder
+
+def index_loaded(shard=None):
+    """Whether this process has loaded the index yet (without loading it)"""
+    return shard in _holders
+
+def loaded_shards():
+    """Campus shards that have an index holder in this process"""
+    return [shard for shard in list(_holders) if shard is not None]
+
+def add_vectors(embeddings, row_ids, sync=True, shard=None):
+    """Add vectors to the shared index and append them to the mutation log"""
+    get_index_holder(shard).add(embeddings, row_ids, sync=sync)
+
+def remove_vectors(row_ids, sync=True, shard=None):
+    """Remove vectors from the shared index and log the delete"""
+    return get_index_holder(shard).remove(row_ids, sync=sync)
+
+def snapshot_index(shard=None):
+    """Fold the mutation log into a fresh faiss_listings_index.idx (or the shard's index file)"""
+    get_index_holder(shard).snapshot()
+
+def compact_index(shard=None):
+    """Drop the vectors of deleted listings from the shared index"""
+    return get_index_holder(shard).compact()
+
+def start_index_snapshots():
+    """
+    Start the background thread that compacts tombstoned vectors once enough
+    have accumulated and snapshots once the log grows large
+    """
+    def run():
+        while True:
+            time.sleep(SNAPSHOT_INTERVAL)
+            for holder in list(_holders.values()):
+                try:
+                    if holder.needs_compaction():
+                        holder.compact()
+                except Exception as e:
+                    print(f"Error during FAISS compaction: {e}")
+                try:
+                    if holder.log.size() >= SNAPSHOT_MIN_BYTES:
+                        holder.snapshot()
+                except Exception as e:
+                    print(f"Error during FAISS snapshot: {e}")
+
+    thread = threading.Thread(target=run, name="faiss-snapshotter", daemon=True)
+    thread.start()
+    return thread
+
+def batch_duplicates(listings_data, matches, new_positions, row_ids):
+    """
+    Ids for every input listing (a repost gets the id of the listing it
+    repeats) and the duplicates table entries for the reposts
+    """
+    result_ids = [None] * len(listings_data)
+    for position, row_id in zip(new_positions, row_ids):
+        result_ids[position] = row_id
+    entries = []
+    for position, match in enumerate(matches):
+        if match is None:
+            continue
+        kind, target, similarity = match
+        result_ids[position] = target if kind == 'listing' else result_ids[target]
+        action = "merged" if kind == 'listing' and DEDUP_MODE == "merge" else "skipped"
+        listing = listings_data[position]
+        entries.append((result_ids[position], similarity, action, listing['text'],
+                        listing.get('user_id', ''), listing.get('user_name', '')))
+    return result_ids, entries
+
+def merge_duplicates(conn, listings_data, matches, shard=None):
+    """In merge mode, stored listings take the text of their latest repost"""
+    if DEDUP_MODE != "merge":
+        return
+    latest = {}
+    for position, match in enumerate(matches):
+        if match is not None and match[0] == 'listing':
+            latest[match[1]] = listings_data[position]
+    for row_id, listing in latest.items():
+        update_listing(conn, row_id, listing['text'], listing.get('user_id') or None, listing.get('user_name') or None,
+                       shard)
 
-def insert_listing(conn, text, user_id, user_name):
-    global index, index_file
+def insert_listing(conn, text, user_id, user_name, shard=None):
     
     try:
+        # Near-duplicates of a stored listing are not inserted (or embedded) again
+        signatures, matches = check_duplicates(conn, [text], shard)
+        if matches[0] is not None:
+            listing = {"text": text, "user_id": user_id, "user_name": user_name}
+            result_ids, entries = batch_duplicates([listing], matches, [], [])
+            record_duplicates(conn, entries)
+            conn.commit()
+            merge_duplicates(conn, [listing], matches, shard)
+            print(f"Listing repeats listing {result_ids[0]} (similarity {matches[0][2]:.2f}), {entries[0][2]}")
+            return result_ids[0]
+
         # Extract metadata
         price_min, price_max, beds, baths, location = extract_metadata(text)
 
@@ -51,18 +184,14 @@ def insert_listing(conn, text, user_id, user_name):
         row_id = cur.lastrowid
         cur.close()
 
-        # Get embedding from your embedding server
-        resp = requests.post("http://localhost:5000/embed", json={"text": text})
-        if resp.status_code != 200:
-            raise Exception(f"Embedding server error: {resp.status_code}")
-            
-        embedding = np.array(resp.json()["embedding"], dtype="float32")
+        # Get embedding from the configured embedder (in-process by default)
+        embedding = get_embedder().embed_text(text)
 
-        # Add to FAISS with SQLite row_id as mapping
-        index.add_with_ids(np.array([embedding]), np.array([row_id], dtype="int64"))
-        
-        # Save updated index to disk
-        faiss.write_index(index, index_file)
+        # Add to FAISS with SQLite row_id as mapping (logged, no full index rewrite)
+        add_vectors(np.array([embedding]), np.array([row_id], dtype="int64"), shard=shard)
+        added = True
+        mirror_listings([(row_id, price_min, price_max, beds, baths, location)], shard)
+        remember_listings([(row_id, signatures[0])], shard)
         
         print(f"Successfully inserted listing {row_id}")
         return row_id
@@ -79,29 +208,103 @@ def insert_listing(conn, text, user_id, user_name):
                 print(f"Rolled back database insertion for row {row_id}")
             except Exception as rollback_error:
                 print(f"Error during rollback: {rollback_error}")
+        # The vector was added (and logged) before the step that failed
+        if 'added' in locals():
+            try:
+                remove_vectors(np.array([row_id], dtype="int64"), shard=shard)
+                unmirror_listings([row_id], shard)
+                print(f"Removed vector {row_id} from FAISS")
+            except Exception as faiss_rollback_error:
+                print(f"Error during FAISS rollback: {faiss_rollback_error}")
         raise e
 
-def batch_insert_listings(conn, listings_data):
+def delete_listings(conn, row_ids, shard=None):
+    """
+    Delete listings. The rows go right away and their vectors are tombstoned:
+    searches skip them immediately, and the background thread drops them
+    from the index once enough deletes have accumulated.
+    Returns the ids that existed.
+    """
+    row_ids = [int(row_id) for row_id in row_ids]
+    if not row_ids:
+        return []
+    placeholders = ','.join(['?' for _ in row_ids])
+    cur = conn.cursor()
+    cur.execute(f"SELECT id FROM listings WHERE id IN ({placeholders})", row_ids)
+    existing = [row[0] for row in cur.fetchall()]
+    if existing:
+        cur.execute(f"DELETE FROM listings WHERE id IN ({placeholders})", row_ids)
+    conn.commit()
+    cur.close()
+
+    get_index_holder(shard).tombstone(existing)
+    unmirror_listings(existing, shard)
+    forget_listings(existing, shard)
+    print(f"Deleted {len(existing)} listings")
+    return existing
+
+def update_listing(conn, row_id, text, user_id=None, user_name=None, shard=None):
+    """
+    Replace a listing's text (and re-extracted metadata) and its vector.
+    user_id/user_name are kept when not given. Returns False for an unknown id.
+    """
+    price_min, price_max, beds, baths, location = extract_metadata(text)
+
+    cur = conn.cursor()
+    cur.execute("""
+        UPDATE listings
+        SET text = ?, location = ?, price_min = ?, price_max = ?, beds = ?, baths = ?,
+            user_id = COALESCE(?, user_id), user_name = COALESCE(?, user_name)
+        WHERE id = ?
+    """, (text, location, price_min, price_max, beds, baths, user_id, user_name, row_id))
+    updated = cur.rowcount > 0
+    cur.close()
+    if not updated:
+        conn.rollback()
+        return False
+
+    holder = get_index_holder(shard)
+    try:
+        embedding = get_embedder().embed_text(text)
+        holder.replace(np.array([embedding]), np.array([row_id], dtype="int64"))
+    except Exception:
+        conn.rollback()
+        raise
+    conn.commit()
+    # Searches since the replace may have cached the old row under the new generation
+    holder.committed()
+    mirror_listings([(row_id, price_min, price_max, beds, baths, location)], shard)
+    remember_listings([(row_id, minhash(text))], shard)
+
+    print(f"Successfully updated listing {row_id}")
+    return True
+
+def batch_insert_listings(conn, listings_data, shard=None):
     """
     More efficient batch insertion
     listings_data: list of dicts with keys: text, user_id, user_name
     """
-    global index, index_file
     
     try:
+        # Reposts (of stored listings or within the batch) are not inserted
+        signatures, matches = check_duplicates(conn, [listing['text'] for listing in listings_data], shard)
+        new_positions = [position for position, match in enumerate(matches) if match is None]
+
         cur = conn.cursor()
         inserted_rows = []
         texts_for_embedding = []
+        mirrored_rows = []
+        
+        # Extract metadata for the whole batch (across processes for large loads)
+        new_listings = [listings_data[position] for position in new_positions]
+        metadata = extract_metadata_batch([listing_data['text'] for listing_data in new_listings])
         
         # First, insert all into database
-        for listing_data in listings_data:
+        for listing_data, (price_min, price_max, beds, baths, location) in zip(new_listings, metadata):
             text = listing_data['text']
             user_id = listing_data.get('user_id', '')
             user_name = listing_data.get('user_name', '')
             
-            # Extract metadata
-            price_min, price_max, beds, baths, location = extract_metadata(text)
-            
             # Insert into SQLite
             cur.execute("""
                 INSERT INTO listings (text, location, price_min, price_max, beds, baths, user_id, user_name)
@@ -111,26 +314,26 @@ def batch_insert_listings(conn, listings_data):
             row_id = cur.lastrowid
             inserted_rows.append(row_id)
             texts_for_embedding.append(text)
+            mirrored_rows.append((row_id, price_min, price_max, beds, baths, location))
         
+        result_ids, duplicate_entries = batch_duplicates(listings_data, matches, new_positions, inserted_rows)
+        record_duplicates(conn, duplicate_entries)
         conn.commit()
         cur.close()
         
         # Get embeddings in batch (more efficient)
-        resp = requests.post("http://localhost:5000/embeds", json={"texts": texts_for_embedding})
-        if resp.status_code != 200:
-            raise Exception(f"Embedding server error: {resp.status_code}")
+        if inserted_rows:
+            embeddings = get_embedder().embed_texts(texts_for_embedding)
+            row_ids_array = np.array(inserted_rows, dtype="int64")
             
-        embeddings = np.array(resp.json()["embeddings"], dtype="float32")
-        row_ids_array = np.array(inserted_rows, dtype="int64")
-        
-        # Add all to FAISS at once
-        index.add_with_ids(embeddings, row_ids_array)
-        
-        # Save updated index
-        faiss.write_index(index, index_file)
+            # Add all to FAISS at once (one log record, one fsync)
+            add_vectors(embeddings, row_ids_array, shard=shard)
+        mirror_listings(mirrored_rows, shard)
+        remember_listings(zip(inserted_rows, (signatures[position] for position in new_positions)), shard)
+        merge_duplicates(conn, listings_data, matches, shard)
         
-        print(f"Successfully batch inserted {len(inserted_rows)} listings")
-        return inserted_rows
+        print(f"Successfully batch inserted {len(inserted_rows)} listings ({len(duplicate_entries)} duplicates)")
+        return result_ids
         
     except Exception as e:
         print(f"Error in batch insertion: {e}")
@@ -147,11 +350,15 @@ def batch_insert_listings(conn, listings_data):
                 print(f"Error during rollback: {rollback_error}")
         raise e
 
-def get_index_stats():
-    """Get statistics about the current index"""
-    global index
-    return {
-        "total_vectors": index.ntotal,
-        "dimension": index.d,
-        "index_type": type(index).__name__
-    }
\ No newline at end of file
+def get_index_stats(shard=None):
+    """Get statistics about the current index (or a campus shard's)"""
+    holder = get_index_holder(shard)
+    with holder.read() as index:
+        stats = {
+            "total_vectors": index.ntotal,
+            "dimension": index.d,
+            "log_bytes": holder.log.size()
+        }
+        stats.update(describe_index(index))
+    stats.update(holder.stats())
+    return stats
\ No newline at end of file
@@ -1,10 +1,10 @@
 import sqlite3
-import faiss
 import numpy as np
-import pandas as pd
 from typing import List, Dict, Optional, Tuple
 import json
 from datetime import datetime
+from index_factory import IdOffsets, inner_index, reconstruct_at
+from index_tools import load_current_index
 
 class DatabaseInspector:
     def __init__(self, db_path: str, faiss_index_path: str):
@@ -16,9 +16,9 @@ class DatabaseInspector:
         return sqlite3.connect(self.db_path)
     
     def load_faiss_index(self):
-        """Load FAISS index"""
+        """Load FAISS index (the snapshot plus its mutation log, as the service sees it)"""
         try:
-            return faiss.read_index(self.faiss_index_path)
+            return load_current_index(self.faiss_index_path)
         except Exception as e:
             print(f"Error loading FAISS index: {e}")
             return None
@@ -120,21 +120,14 @@ class DatabaseInspector:
         try:
             cur = conn.cursor()
             cur.execute("SELECT id FROM listings ORDER BY id")
-            sqlite_ids = [row[0] for row in cur.fetchall()]
+            sqlite_ids = np.fromiter((row[0] for row in cur), dtype="int64")
             results['sqlite_count'] = len(sqlite_ids)
             
-            # For IndexIDMap, we can get the IDs
+            # For IndexIDMap, we can get the IDs (one vectorized copy, numpy set differences)
             if hasattr(index, 'id_map'):
-                # Get all IDs from FAISS
-                faiss_ids = []
-                for i in range(index.ntotal):
-                    faiss_ids.append(index.id_map.at(i))
-                
-                sqlite_set = set(sqlite_ids)
-                faiss_set = set(faiss_ids)
-                
-                results['missing_in_faiss'] = list(sqlite_set - faiss_set)
-                results['extra_in_faiss'] = list(faiss_set - sqlite_set)
+                faiss_ids = IdOffsets(index)
+                results['missing_in_faiss'] = faiss_ids.missing(sqlite_ids).tolist()
+                results['extra_in_faiss'] = faiss_ids.extra(sqlite_ids).tolist()
                 results['consistency_ok'] = len(results['missing_in_faiss']) == 0 and len(results['extra_in_faiss']) == 0
             else:
                 results['note'] = 'Cannot check ID consistency - index does not support ID mapping'
@@ -174,12 +167,11 @@ class DatabaseInspector:
                     'sample_vector_norms': []
                 }
                 
-                # Get a few vector norms as samples
+                # Get a few vector norms as samples (decoded only for these rows)
                 if index.ntotal > 0:
-                    for i in range(min(3, index.ntotal)):
-                        vector = index.reconstruct(i)
-                        norm = np.linalg.norm(vector)
-                        results['faiss_info']['sample_vector_norms'].append(float(norm))
+                    vectors = inner_index(index).reconstruct_n(0, min(3, index.ntotal))
+                    norms = np.linalg.norm(vectors, axis=1)
+                    results['faiss_info']['sample_vector_norms'] = [float(norm) for norm in norms]
         
         except Exception as e:
             results['error'] = str(e)
@@ -216,6 +208,24 @@ class DatabaseInspector:
                     'count': row[1],
                     'ids': row[2]
                 })
+            
+            # Reposts the insert-time near-duplicate check kept out of the index
+            cur.execute("SELECT name FROM sqlite_master WHERE type='table' AND name='duplicates'")
+            if cur.fetchone():
+                cur.execute("""
+                    SELECT duplicate_of, COUNT(*) as count, MAX(similarity), GROUP_CONCAT(DISTINCT action)
+                    FROM duplicates
+                    GROUP BY duplicate_of
+                    ORDER BY count DESC
+                    LIMIT 10
+                """)
+                for row in cur.fetchall():
+                    results['similar_listings'].append({
+                        'listing_id': row[0],
+                        'reposts': row[1],
+                        'max_similarity': row[2],
+                        'actions': row[3]
+                    })
         
         except Exception as e:
             results['error'] = str(e)
@@ -244,16 +254,15 @@ class DatabaseInspector:
                 # Try to find in FAISS
                 if index and hasattr(index, 'id_map'):
                     try:
-                        # This is a bit tricky - we need to find the internal index
-                        for i in range(index.ntotal):
-                            if index.id_map.at(i) == listing_id:
-                                vector = index.reconstruct(i)
-                                result['faiss_data'] = {
-                                    'internal_index': i,
-                                    'vector_norm': float(np.linalg.norm(vector)),
-                                    'vector_preview': vector[:10].tolist()  # First 10 dimensions
-                                }
-                                break
+                        # Map the listing id to its internal offset
+                        offset = int(IdOffsets(index).offsets([listing_id])[0])
+                        if offset >= 0:
+                            vector = reconstruct_at(index, offset)
+                            result['faiss_data'] = {
+                                'internal_index': offset,
+                                'vector_norm': float(np.linalg.norm(vector)),
+                                'vector_preview': vector[:10].tolist()  # First 10 dimensions
+                            }
                         else:
                             result['faiss_data'] = {'status': 'ID not found in FAISS'}
                     except Exception as e:
@@ -0,0 +1,87 @@
+import os
+import threading
+import time
+from typing import Dict
+
+# Load the model and the index in the background as soon as the service
+# starts, instead of on the first request. /health answers right away either
+# way; /ready reports whether the warm-up has finished.
+WARMUP_ENABLED = os.environ.get("WARMUP", "1") != "0"
+
+_state = {
+    'started': False,
+    'warmup': None,      # None (not run), "running", "done" or "failed"
+    'model_seconds': None,
+    'index_seconds': None,
+    'error': None,
+}
+_state_lock = threading.Lock()
+
+def warm_up():
+    """Load the embedding model and the default index now (idempotent)"""
+    # Imported here so that importing this module stays cheap
+    from embedder import EMBEDDER_BACKEND, get_model
+    from insertion import get_index_holder
+
+    with _state_lock:
+        _state['warmup'] = "running"
+    try:
+        # 1. Embedding model (only loaded in-process for the local and onnx backends)
+        start = time.perf_counter()
+        if EMBEDDER_BACKEND == "local":
+            get_model()
+        elif EMBEDDER_BACKEND == "onnx":
+            from onnx_backend import get_onnx_model
+            get_onnx_model()
+        _state['model_seconds'] = round(time.perf_counter() - start, 3)
+
+        # 2. FAISS index (snapshot plus log replay)
+        start = time.perf_counter()
+        get_index_holder()
+        _state['index_seconds'] = round(time.perf_counter() - start, 3)
+        _state['warmup'] = "done"
+        print(f"Warm-up done (model {_state['model_seconds']}s, index {_state['index_seconds']}s)")
+    except Exception as e:
+        _state['warmup'] = "failed"
+        _state['error'] = str(e)
+        print(f"Error during warm-up: {e}")
+        raise
+
+def start(warmup: bool = WARMUP_ENABLED):
+    """
+    Start the service's background work: the snapshot/compaction thread and,
+    with warmup, the model and index warm-up. Safe to call more than once.
+    """
+    from insertion import start_index_snapshots
+
+    with _state_lock:
+        if _state['started']:
+            return
+        _state['started'] = True
+    start_index_snapshots()
+    if warmup:
+        def run():
+            try:
+                warm_up()
+            except Exception:
+                pass
+        threading.Thread(target=run, name="warm-up", daemon=True).start()
+
+def is_ready() -> bool:
+    """
+    Ready once the warm-up has finished. Without a warm-up the service is
+    ready immediately and loads the model and index on first use.
+    """
+    return _state['warmup'] == "done" or (_state['warmup'] is None and _state['started'])
+
+def readiness() -> Dict:
+    """Warm-up state and timings, plus what this process has loaded so far"""
+    from embedder import model_loaded
+    from insertion import index_loaded
+
+    with _state_lock:
+        state = dict(_state)
+    state['ready'] = is_ready()
+    state['model_loaded'] = model_loaded()
+    state['index_loaded'] = index_loaded()
+    return state
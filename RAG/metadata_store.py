@@ -0,0 +1,167 @@
+import threading
+import numpy as np
+from typing import Dict, Iterable, List, Optional
+from db import get_sync_state
+
+LISTING_COLUMNS_SQL = "SELECT id, price_min, price_max, beds, baths, location FROM listings"
+
+class MetadataColumns:
+    """
+    Columnar in-memory mirror of the filterable listing fields.
+
+    Columns are numpy arrays indexed directly by listing id (the same id FAISS
+    stores), so a filter is a handful of vectorized comparisons over the
+    arrays and `np.flatnonzero` of the result gives the matching ids.
+    Missing values are NaN, which fails every comparison just like NULL does
+    in SQL.
+
+    Inserts, updates and deletes made by other processes are picked up from
+    the listing_changes table, from the last change sequence applied.
+    """
+
+    def __init__(self, capacity: int = 1024):
+        self.lock = threading.Lock()
+        self.max_id = 0
+        self.change_seq = 0
+        self._allocate(capacity)
+
+    def _allocate(self, capacity: int):
+        self.live = np.zeros(capacity, dtype=bool)
+        self.price_min = np.full(capacity, np.nan)
+        self.price_max = np.full(capacity, np.nan)
+        self.beds = np.full(capacity, np.nan)
+        self.baths = np.full(capacity, np.nan)
+        self.location = np.full(capacity, None, dtype=object)
+
+    def _grow(self, needed: int):
+        """Double the arrays until id `needed - 1` fits"""
+        capacity = len(self.live)
+        if needed <= capacity:
+            return
+        while capacity < needed:
+            capacity *= 2
+        old = (self.live, self.price_min, self.price_max, self.beds, self.baths, self.location)
+        self._allocate(capacity)
+        for new_column, old_column in zip(
+            (self.live, self.price_min, self.price_max, self.beds, self.baths, self.location), old
+        ):
+            new_column[:len(old_column)] = old_column
+
+    @staticmethod
+    def _value(value):
+        return np.nan if value is None else float(value)
+
+    def upsert(self, rows: Iterable):
+        """rows: (id, price_min, price_max, beds, baths, location) tuples"""
+        rows = list(rows)
+        if not rows:
+            return
+        with self.lock:
+            self._grow(max(row[0] for row in rows) + 1)
+            for row_id, price_min, price_max, beds, baths, location in rows:
+                self.live[row_id] = True
+                self.price_min[row_id] = self._value(price_min)
+                self.price_max[row_id] = self._value(price_max)
+                self.beds[row_id] = self._value(beds)
+                self.baths[row_id] = self._value(baths)
+                self.location[row_id] = location.lower() if location else None
+                self.max_id = max(self.max_id, row_id)
+
+    def remove(self, ids: Iterable[int]):
+        with self.lock:
+            for row_id in ids:
+                if 0 <= row_id < len(self.live):
+                    self.live[row_id] = False
+
+    def load(self, conn):
+        """Mirror every listing (first use, or after missing pruned changes)"""
+        cur = conn.cursor()
+        # Read before the scan: a change racing it is applied again by refresh()
+        cur.execute("SELECT COALESCE(MAX(seq), 0) FROM listing_changes")
+        change_seq = cur.fetchone()[0]
+        cur.execute(f"{LISTING_COLUMNS_SQL} ORDER BY id")
+        rows = cur.fetchall()
+        cur.close()
+        with self.lock:
+            self._allocate(len(self.live))
+            self.max_id = 0
+        self.upsert(rows)
+        self.change_seq = max(change_seq, get_sync_state(conn, 'reconciled_change') or 0)
+        return len(rows)
+
+    def refresh(self, conn):
+        """Apply the inserts, updates and deletes (of any process) since the last load"""
+        # Reconciliation prunes listing_changes up to its mark: reload if that
+        # dropped changes not applied here yet
+        if (get_sync_state(conn, 'reconciled_change') or 0) > self.change_seq:
+            return self.load(conn)
+        cur = conn.cursor()
+        cur.execute("SELECT seq, listing_id FROM listing_changes WHERE seq > ? ORDER BY seq", (self.change_seq,))
+        changes = cur.fetchall()
+        if not changes:
+            cur.close()
+            return 0
+        changed = sorted({listing_id for _, listing_id in changes})
+        rows = []
+        for start in range(0, len(changed), 500):
+            chunk = changed[start:start + 500]
+            placeholders = ','.join(['?' for _ in chunk])
+            cur.execute(f"{LISTING_COLUMNS_SQL} WHERE id IN ({placeholders})", chunk)
+            rows.extend(cur.fetchall())
+        cur.close()
+        self.upsert(rows)
+        self.remove(set(changed) - {row[0] for row in rows})
+        self.change_seq = changes[-1][0]
+        return len(changed)
+
+    def filter_ids(self, max_price=None, min_beds=None, min_baths=None, location: Optional[str] = None) -> np.ndarray:
+        """Ids of live listings passing every given filter, as a vectorized boolean mask"""
+        with self.lock:
+            mask = self.live.copy()
+            # Comparisons against NaN are False, so rows without a value are excluded
+            with np.errstate(invalid="ignore"):
+                if max_price:
+                    mask &= self.price_min <= max_price
+                if min_beds:
+                    mask &= self.beds >= min_beds
+                if min_baths:
+                    mask &= self.baths >= min_baths
+            ids = np.flatnonzero(mask)
+            if location:
+                needle = location.lower()
+                locations = self.location[ids]
+                ids = ids[np.fromiter((loc is not None and needle in loc for loc in locations),
+                                      dtype=bool, count=len(ids))]
+        return ids.astype("int64")
+
+    def stats(self) -> Dict:
+        with self.lock:
+            return {'live_rows': int(self.live.sum()), 'capacity': len(self.live), 'max_id': self.max_id}
+
+# One mirror per shard (None is the default store)
+_columns = {}
+_columns_lock = threading.Lock()
+
+def get_metadata_columns(conn=None, shard: Optional[str] = None) -> MetadataColumns:
+    """Process-wide metadata mirror of a shard, loaded from SQLite on first use"""
+    columns = _columns.get(shard)
+    if columns is None:
+        with _columns_lock:
+            columns = _columns.get(shard)
+            if columns is None:
+                columns = MetadataColumns()
+                if conn is not None:
+                    columns.load(conn)
+                _columns[shard] = columns
+    return columns
+
+def mirror_listings(rows: List, shard: Optional[str] = None):
+    """Insert paths call this after commit; a no-op until the mirror is first used"""
+    columns = _columns.get(shard)
+    if columns is not None:
+        columns.upsert(rows)
+
+def unmirror_listings(ids: Iterable[int], shard: Optional[str] = None):
+    columns = _columns.get(shard)
+    if columns is not None:
+        columns.remove(ids)
@@ -0,0 +1,171 @@
+import json
+import os
+import threading
+import numpy as np
+from typing import Dict, List
+from batching import EMBED_BUCKET_SIZE, EMBED_BUCKETING_ENABLED, EMBED_MAX_TOKENS, length_buckets, padding_stats
+
+# ONNX Runtime inference for the sentence-transformers model (EMBEDDER_BACKEND=onnx).
+# `python onnx_backend.py export` writes the graph, its int8 version and the
+# tokenizer to ONNX_MODEL_DIR; at run time only onnxruntime and tokenizers
+# are needed (no torch).
+ONNX_MODEL_DIR = os.environ.get("ONNX_MODEL_DIR", "onnx_model")
+ONNX_VARIANT = os.environ.get("ONNX_VARIANT", "int8")  # "int8" (dynamically quantized) or "fp32"
+# Threads inside one operator (matrix multiplies) and across independent operators
+ONNX_INTRA_OP_THREADS = int(os.environ.get("ONNX_INTRA_OP_THREADS", str(os.cpu_count() or 1)))
+ONNX_INTER_OP_THREADS = int(os.environ.get("ONNX_INTER_OP_THREADS", "1"))
+
+VARIANT_FILES = {"fp32": "model.onnx", "int8": "model_int8.onnx"}
+CONFIG_FILE = "embedding_config.json"
+
+def export_model(model_name: str, out_dir: str = ONNX_MODEL_DIR, quantize: bool = True) -> Dict:
+    """
+    Export a sentence-transformers model (a hub name or a local directory) to
+    ONNX, plus a dynamically quantized int8 copy. The pooling and
+    normalization of the original pipeline are recorded in embedding_config.json
+    so OnnxModel can reproduce them.
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    os.makedirs(out_dir, exist_ok=True)
+    st_model = SentenceTransformer(model_name, device="cpu")
+    transformer = st_model[0]
+    pooling = [module for module in st_model if type(module).__name__ == "Pooling"]
+    config = {
+        "model_name": model_name,
+        "max_seq_length": int(st_model.get_max_seq_length() or 256),
+        "pooling": "cls" if pooling and pooling[0].pooling_mode_cls_token else "mean",
+        "normalize": any(type(module).__name__ == "Normalize" for module in st_model),
+    }
+
+    # 1. fp32 graph of the transformer with dynamic batch and sequence axes
+    tokenizer = transformer.tokenizer
+    tokenizer.save_pretrained(out_dir)
+    sample = tokenizer(["export sample"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in sample]
+    dynamic_axes = {name: {0: "batch", 1: "sequence"} for name in input_names}
+    dynamic_axes["last_hidden_state"] = {0: "batch", 1: "sequence"}
+    auto_model = transformer.auto_model.eval()
+    fp32_path = os.path.join(out_dir, VARIANT_FILES["fp32"])
+    with torch.no_grad():
+        torch.onnx.export(
+            auto_model, tuple(sample[name] for name in input_names), fp32_path,
+            input_names=input_names, output_names=["last_hidden_state"],
+            dynamic_axes=dynamic_axes, opset_version=14, do_constant_folding=True,
+        )
+
+    # 2. int8 weights for the matrix multiplies (activations quantized on the fly)
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+        quantize_dynamic(fp32_path, os.path.join(out_dir, VARIANT_FILES["int8"]), weight_type=QuantType.QInt8)
+
+    with open(os.path.join(out_dir, CONFIG_FILE), "w") as f:
+        json.dump(config, f, indent=2)
+    report = dict(config, out_dir=out_dir)
+    for variant, file_name in VARIANT_FILES.items():
+        path = os.path.join(out_dir, file_name)
+        if os.path.exists(path):
+            report[f"{variant}_bytes"] = os.path.getsize(path)
+    return report
+
+class OnnxModel:
+    """Tokenizer + ONNX Runtime session + pooling, with the encode() of a SentenceTransformer"""
+
+    def __init__(self, model_dir: str = ONNX_MODEL_DIR, variant: str = ONNX_VARIANT,
+                 intra_op_threads: int = ONNX_INTRA_OP_THREADS, inter_op_threads: int = ONNX_INTER_OP_THREADS):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        if variant not in VARIANT_FILES:
+            raise ValueError(f"Unknown ONNX variant {variant!r}, expected one of {', '.join(VARIANT_FILES)}")
+        path = os.path.join(model_dir, VARIANT_FILES[variant])
+        if not os.path.exists(path):
+            raise FileNotFoundError(f"{path} not found, run `python onnx_backend.py export` first")
+        with open(os.path.join(model_dir, CONFIG_FILE)) as f:
+            self.config = json.load(f)
+        self.variant = variant
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = intra_op_threads
+        options.inter_op_num_threads = inter_op_threads
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        self.session = ort.InferenceSession(path, sess_options=options, providers=["CPUExecutionProvider"])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+
+        self.tokenizer = Tokenizer.from_file(os.path.join(model_dir, "tokenizer.json"))
+        # Truncation policy: the export's limit, tightened by EMBED_MAX_TOKENS.
+        # Padding is done per bucket in encode()
+        self.max_tokens = min(self.config["max_seq_length"], EMBED_MAX_TOKENS)
+        self.tokenizer.enable_truncation(max_length=self.max_tokens)
+        self.tokenizer.no_padding()
+
+    def encode(self, texts: List[str], batch_size: int = EMBED_BUCKET_SIZE,
+               sort_by_length: bool = EMBED_BUCKETING_ENABLED) -> np.ndarray:
+        """
+        (len(texts), dim) float32 embeddings in input order, pooled and
+        normalized like the original pipeline. With sort_by_length, each
+        forward pass holds texts of similar token counts.
+        """
+        encodings = self.tokenizer.encode_batch(list(texts))
+        lengths = np.array([len(encoding.ids) for encoding in encodings])
+        cut = np.array([bool(encoding.overflowing) for encoding in encodings])
+        vectors = None
+        for bucket in length_buckets(lengths, batch_size, sort_by_length):
+            # 1. Pad the bucket to its own longest (truncated) member
+            width = int(lengths[bucket].max())
+            inputs = {name: np.zeros((len(bucket), width), dtype="int64")
+                      for name in ("input_ids", "attention_mask", "token_type_ids")}
+            for row, position in enumerate(bucket):
+                encoding, length = encodings[position], lengths[position]
+                inputs["input_ids"][row, :length] = encoding.ids
+                inputs["token_type_ids"][row, :length] = encoding.type_ids
+                inputs["attention_mask"][row, :length] = 1
+
+            # 2. Run the graph and pool over the real tokens
+            hidden = self.session.run(None, {name: inputs[name] for name in self.input_names})[0]
+            if self.config["pooling"] == "cls":
+                pooled = hidden[:, 0]
+            else:
+                mask = inputs["attention_mask"][:, :, None].astype("float32")
+                pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if self.config["normalize"]:
+                pooled = pooled / np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+
+            # 3. Back to input order
+            if vectors is None:
+                vectors = np.empty((len(encodings), pooled.shape[1]), dtype="float32")
+            vectors[bucket] = pooled
+            padding_stats.record(lengths[bucket], int(cut[bucket].sum()))
+        if vectors is None:
+            return np.empty((0, 0), dtype="float32")
+        return vectors
+
+_onnx_model = None
+_onnx_model_lock = threading.Lock()
+
+def get_onnx_model() -> OnnxModel:
+    """Lazy load the ONNX session (one per process)"""
+    global _onnx_model
+    if _onnx_model is None:
+        with _onnx_model_lock:
+            if _onnx_model is None:
+                _onnx_model = OnnxModel()
+    return _onnx_model
+
+def onnx_model_loaded() -> bool:
+    return _onnx_model is not None
+
+# CLI interface
+if __name__ == "__main__":
+    import sys
+    # Usage: python onnx_backend.py export [model name or local path] [out_dir] [--no-quantize]
+    args = [arg for arg in sys.argv[1:] if not arg.startswith("--")]
+    if not args or args[0] != "export":
+        print("Usage: python onnx_backend.py export [model_name_or_path] [out_dir] [--no-quantize]")
+        sys.exit(1)
+    from embedder import MODEL_NAME
+    model_name = args[1] if len(args) > 1 else MODEL_NAME
+    out_dir = args[2] if len(args) > 2 else ONNX_MODEL_DIR
+    print(json.dumps(export_model(model_name, out_dir, quantize='--no-quantize' not in sys.argv), indent=2))
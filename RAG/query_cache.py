@@ -0,0 +1,120 @@
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+from embedding_cache import normalize_text
+
+# Bounded LRU of recent search results, each entry valid for QUERY_CACHE_TTL seconds
+QUERY_CACHE_ENABLED = os.environ.get("QUERY_CACHE", "1") != "0"
+QUERY_CACHE_SIZE = int(os.environ.get("QUERY_CACHE_SIZE", "1024"))
+QUERY_CACHE_TTL = float(os.environ.get("QUERY_CACHE_TTL", "300"))
+
+def query_key(query: str, max_price=None, min_beds=None, top_k=5, min_baths=None, location=None,
+              mode: str = "vector") -> Tuple:
+    """Normalized query text, filters, top_k and search mode (case and spacing do not matter)"""
+    return (
+        normalize_text(query).lower(),
+        None if max_price is None else float(max_price),
+        None if min_beds is None else float(min_beds),
+        None if min_baths is None else float(min_baths),
+        normalize_text(location).lower() if location else None,
+        int(top_k),
+        mode,
+    )
+
+class QueryCache:
+    """
+    Search results keyed by query_key and tagged with the index generation
+    they were computed at. Every insert or delete bumps the generation (also
+    for writes from other processes, once the index holder has caught up),
+    so an entry from an older generation is never served.
+    """
+
+    def __init__(self, capacity: int = QUERY_CACHE_SIZE, ttl: float = QUERY_CACHE_TTL):
+        self.capacity = capacity
+        self.ttl = ttl
+        self.lru = OrderedDict()
+        self.lock = threading.Lock()
+        self.generation = None
+        self.stats_counters = {'hits': 0, 'misses': 0, 'invalidations': 0}
+        self.hit_seconds = 0.0
+        self.miss_seconds = 0.0
+
+    def _check_generation(self, generation):
+        """Drop everything once the index has changed (lock held)"""
+        if generation != self.generation:
+            if self.lru:
+                self.stats_counters['invalidations'] += 1
+            self.lru.clear()
+            self.generation = generation
+
+    def get(self, key: Tuple, generation) -> Optional[list]:
+        with self.lock:
+            self._check_generation(generation)
+            entry = self.lru.get(key)
+            if entry is None or time.monotonic() - entry[0] > self.ttl:
+                if entry is not None:
+                    del self.lru[key]
+                self.stats_counters['misses'] += 1
+                return None
+            self.lru.move_to_end(key)
+            self.stats_counters['hits'] += 1
+            return entry[1]
+
+    def put(self, key: Tuple, generation, results: list):
+        with self.lock:
+            if generation != self.generation:
+                # Computed against an index that has changed since
+                return
+            self.lru[key] = (time.monotonic(), results)
+            self.lru.move_to_end(key)
+            while len(self.lru) > self.capacity:
+                self.lru.popitem(last=False)
+
+    def record_latency(self, hit: bool, seconds: float):
+        with self.lock:
+            if hit:
+                self.hit_seconds += seconds
+            else:
+                self.miss_seconds += seconds
+
+    def clear(self):
+        with self.lock:
+            self.lru.clear()
+
+    def stats(self) -> Dict:
+        with self.lock:
+            stats = dict(self.stats_counters)
+            lookups = stats['hits'] + stats['misses']
+            stats['entries'] = len(self.lru)
+            stats['hit_ratio'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+            stats['avg_hit_ms'] = round(self.hit_seconds * 1000 / stats['hits'], 3) if stats['hits'] else None
+            stats['avg_miss_ms'] = round(self.miss_seconds * 1000 / stats['misses'], 3) if stats['misses'] else None
+            return stats
+
+# One cache per shard (None is the default store): each follows its own index generation
+_query_caches = {}
+_query_cache_lock = threading.Lock()
+
+def get_query_cache(shard: Optional[str] = None) -> QueryCache:
+    """Process-wide search result cache of a shard"""
+    cache = _query_caches.get(shard)
+    if cache is None:
+        with _query_cache_lock:
+            cache = _query_caches.get(shard)
+            if cache is None:
+                cache = QueryCache()
+                _query_caches[shard] = cache
+    return cache
+
+def query_cache_stats() -> Dict:
+    """Hit ratio and latency of the search result cache (per campus shard under "shards")"""
+    if not QUERY_CACHE_ENABLED:
+        return {'enabled': False}
+    stats = get_query_cache().stats()
+    stats['enabled'] = True
+    for shard, cache in list(_query_caches.items()):
+        if shard is not None:
+            stats.setdefault('shards', {})[shard] = cache.stats()
+    return stats
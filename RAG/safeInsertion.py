@@ -1,111 +1,116 @@
 import faiss
-import requests
 import numpy as np
 import json
 import os
 import sqlite3
-from extraction import extract_metadata
-from typing import List, Dict, Tuple
+import insertion
+from extraction import extract_metadata_batch
+from embedder import get_embedder
+from metadata_store import mirror_listings
+from dedup import check_duplicates, record_duplicates, remember_listings
+from db import insert_listings_bulk
+from typing import List, Dict, Optional, Tuple
 
-def safe_batch_insert_listings(conn, listings_data: List[Dict]) -> List[int]:
+# Number of listings embedded and added to FAISS per step of a bulk load
+BULK_CHUNK_SIZE = int(os.environ.get("BULK_CHUNK_SIZE", "256"))
+
+def safe_batch_insert_listings(conn, listings_data: List[Dict], chunk_size: int = BULK_CHUNK_SIZE,
+                               shard: Optional[str] = None) -> List[int]:
     """
     Safer batch insertion that ensures SQLite and FAISS stay in sync
     
     Process:
     1. Begin SQLite transaction
-    2. Insert all records and collect (row_id, text, metadata) tuples
-    3. Get embeddings for all texts
+    2. Insert all records that are not near-duplicates and collect (row_id, text) in input order
+    3. Embed the texts chunk by chunk (one batched embed call per chunk)
     4. Verify we have matching counts
-    5. Add to FAISS using the exact same order
-    6. Commit SQLite transaction only if FAISS succeeds
-    7. Save FAISS index
+    5. Add each chunk to FAISS with a single add_with_ids
+    6. fsync the FAISS mutation log once for the whole batch
+    7. Commit SQLite transaction only if FAISS succeeded
+    
+    On any failure the SQLite transaction is rolled back and the vectors this
+    batch added are removed from FAISS again, so either every listing lands
+    in both stores or none does.
+
+    Returns one id per input listing; a repost gets the id of the listing it repeats.
+    shard is the campus whose database `conn` belongs to (None for the default store).
     """
-    global index, index_file
+    holder = insertion.get_index_holder(shard)
     
     # Store original index state for rollback
-    original_faiss_count = index.ntotal
+    original_faiss_count = holder.index.ntotal
+    added_ids = []
+    cur = None
     
     try:
-        # Step 1: Begin transaction
-        conn.execute("BEGIN TRANSACTION")
+        # Step 1: Begin transaction (IMMEDIATE takes the write lock up front)
+        if not conn.in_transaction:
+            conn.execute("BEGIN IMMEDIATE")
         cur = conn.cursor()
         
-        # Step 2: Insert all into database and collect data in exact order
-        insertion_records = []  # (row_id, text, metadata)
-        
-        for i, listing_data in enumerate(listings_data):
+        # Step 2: Insert all new listings with one executemany, keeping input order
+        # (reposts of stored listings or of earlier batch entries are only recorded)
+        signatures, matches = check_duplicates(conn, [listing['text'] for listing in listings_data], shard)
+        new_positions = [position for position, match in enumerate(matches) if match is None]
+        new_listings = [listings_data[position] for position in new_positions]
+        # Extract metadata for the whole batch (across processes for large loads)
+        metadata = extract_metadata_batch([listing_data['text'] for listing_data in new_listings])
+        texts_ordered = []
+        rows = []
+        for listing_data, (price_min, price_max, beds, baths, location) in zip(new_listings, metadata):
             text = listing_data['text']
             user_id = listing_data.get('user_id', '')
             user_name = listing_data.get('user_name', '')
             
-            # Extract metadata
-            price_min, price_max, beds, baths, location = extract_metadata(text)
+            texts_ordered.append(text)
+            rows.append((text, location, price_min, price_max, beds, baths, user_id, user_name))
+        
+        row_ids = insert_listings_bulk(conn, rows)
+        result_ids, duplicate_entries = insertion.batch_duplicates(listings_data, matches, new_positions, row_ids)
+        record_duplicates(conn, duplicate_entries)
+        mirrored_rows = [
+            (row_id, row[2], row[3], row[4], row[5], row[1]) for row_id, row in zip(row_ids, rows)
+        ]
+        
+        embedder = get_embedder()
+        for start in range(0, len(texts_ordered), chunk_size):
+            chunk_texts = texts_ordered[start:start + chunk_size]
+            chunk_ids = np.array(row_ids[start:start + chunk_size], dtype="int64")
             
-            # Insert into SQLite
-            cur.execute("""
-                INSERT INTO listings (text, location, price_min, price_max, beds, baths, user_id, user_name)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (text, location, price_min, price_max, beds, baths, user_id, user_name))
+            # Step 3: Get embeddings for this chunk in the same order
+            embeddings_array = np.ascontiguousarray(embedder.embed_texts(chunk_texts), dtype="float32")
             
-            row_id = cur.lastrowid
+            # Step 4: Verify counts match
+            if embeddings_array.shape[0] != chunk_ids.shape[0]:
+                raise Exception(
+                    f"Embedding count mismatch! Expected {chunk_ids.shape[0]}, "
+                    f"got {embeddings_array.shape[0]}"
+                )
             
-            # Store in exact order for later processing
-            insertion_records.append({
-                'index_in_batch': i,  # Original position in input
-                'row_id': row_id,
-                'text': text,
-                'metadata': {
-                    'location': location,
-                    'price_min': price_min,
-                    'price_max': price_max,
-                    'beds': beds,
-                    'baths': baths,
-                    'user_id': user_id,
-                    'user_name': user_name
-                }
-            })
-        
-        # Step 3: Get embeddings in the same order
-        texts_ordered = [record['text'] for record in insertion_records]
-        
-        resp = requests.post("http://localhost:5000/embeds", json={"texts": texts_ordered})
-        if resp.status_code != 200:
-            raise Exception(f"Embedding server error: {resp.status_code} - {resp.text}")
-        
-        embeddings_response = resp.json()["embeddings"]
-        
-        # Step 4: Verify counts match
-        if len(embeddings_response) != len(insertion_records):
-            raise Exception(
-                f"Embedding count mismatch! Expected {len(insertion_records)}, "
-                f"got {len(embeddings_response)}"
-            )
+            # Step 5: Add the chunk to FAISS and the mutation log (this is the critical section)
+            insertion.add_vectors(embeddings_array, chunk_ids, sync=False, shard=shard)
+            added_ids.extend(chunk_ids.tolist())
         
-        # Step 5: Create aligned arrays for FAISS
-        embeddings_array = np.array(embeddings_response, dtype="float32")
-        row_ids_array = np.array([record['row_id'] for record in insertion_records], dtype="int64")
-        
-        # Verify array shapes
-        if embeddings_array.shape[0] != row_ids_array.shape[0]:
-            raise Exception(f"Array shape mismatch: embeddings {embeddings_array.shape}, ids {row_ids_array.shape}")
-        
-        # Step 6: Add to FAISS (this is the critical section)
-        index.add_with_ids(embeddings_array, row_ids_array)
+        # Step 6: Make the whole batch durable with a single fsync of the log
+        if added_ids:
+            holder.log.sync()
         
         # Step 7: If we got here, everything worked - commit the transaction
         conn.commit()
         cur.close()
-        
-        # Step 8: Save FAISS index
-        faiss.write_index(index, index_file)
+        if added_ids:
+            # Searches since Step 5 may have cached results without the new rows
+            holder.committed()
+        mirror_listings(mirrored_rows, shard)
+        remember_listings(zip(row_ids, (signatures[position] for position in new_positions)), shard)
+        insertion.merge_duplicates(conn, listings_data, matches, shard)
         
         # Log success with verification
-        inserted_ids = [record['row_id'] for record in insertion_records]
-        print(f"Successfully batch inserted {len(inserted_ids)} listings")
-        print(f"Row IDs: {inserted_ids[:5]}..." + (f" (and {len(inserted_ids)-5} more)" if len(inserted_ids) > 5 else ""))
-        print(f"FAISS now has {index.ntotal} vectors (was {original_faiss_count})")
+        print(f"Successfully batch inserted {len(row_ids)} listings ({len(duplicate_entries)} duplicates)")
+        print(f"Row IDs: {row_ids[:5]}..." + (f" (and {len(row_ids)-5} more)" if len(row_ids) > 5 else ""))
+        print(f"FAISS now has {holder.index.ntotal} vectors (was {original_faiss_count})")
         
-        return inserted_ids
+        return result_ids
         
     except Exception as e:
         print(f"Error in batch insertion: {e}")
@@ -113,33 +118,28 @@ def safe_batch_insert_listings(conn, listings_data: List[Dict]) -> List[int]:
         # Rollback SQLite transaction
         try:
             conn.rollback()
-            cur.close()
+            if cur is not None:
+                cur.close()
             print("Rolled back SQLite transaction")
         except Exception as rollback_error:
             print(f"Error during SQLite rollback: {rollback_error}")
         
-        # Rollback FAISS changes (if any were made)
+        # Rollback FAISS changes by removing exactly the ids this batch added
         try:
-            if index.ntotal > original_faiss_count:
-                # We need to reconstruct the index without the added vectors
-                # This is complex, so let's reload from disk instead
+            if added_ids:
                 print("Attempting to rollback FAISS changes...")
-                global index
-                if os.path.exists(index_file):
-                    index = faiss.read_index(index_file)
-                    print(f"Reloaded FAISS index from disk. Vector count: {index.ntotal}")
-                else:
-                    print("Warning: Could not rollback FAISS - no saved index file found")
+                insertion.remove_vectors(np.array(added_ids, dtype="int64"), shard=shard)
+                print(f"Removed {len(added_ids)} vectors from FAISS. Vector count: {holder.index.ntotal}")
         except Exception as faiss_rollback_error:
             print(f"Error during FAISS rollback: {faiss_rollback_error}")
         
         raise e
 
-def verify_insertion_integrity(conn, inserted_ids: List[int]) -> Dict:
+def verify_insertion_integrity(conn, inserted_ids: List[int], shard: Optional[str] = None) -> Dict:
     """
     Verify that inserted records are properly aligned between SQLite and FAISS
     """
-    global index
+    holder = insertion.get_index_holder(shard)
     
     verification_results = {
         'total_checked': len(inserted_ids),
@@ -151,37 +151,32 @@ def verify_insertion_integrity(conn, inserted_ids: List[int]) -> Dict:
     }
     
     try:
-        cur = conn.cursor()
-        
-        for row_id in inserted_ids:
-            # Check SQLite
-            cur.execute("SELECT id, text FROM listings WHERE id = ?", (row_id,))
-            sqlite_result = cur.fetchone()
-            
-            if sqlite_result:
-                verification_results['sqlite_found'] += 1
-            else:
-                verification_results['missing_from_sqlite'].append(row_id)
-                verification_results['alignment_verified'] = False
-            
-            # Check FAISS (if it supports ID mapping)
-            if hasattr(index, 'id_map'):
-                found_in_faiss = False
-                try:
-                    for i in range(index.ntotal):
-                        if index.id_map.at(i) == row_id:
-                            verification_results['faiss_found'] += 1
-                            found_in_faiss = True
-                            break
-                    
-                    if not found_in_faiss:
-                        verification_results['missing_from_faiss'].append(row_id)
-                        verification_results['alignment_verified'] = False
-                        
-                except Exception as e:
-                    verification_results['faiss_error'] = str(e)
+        ids = np.asarray(inserted_ids, dtype="int64")
         
+        # Check SQLite (one IN query per 500 ids)
+        cur = conn.cursor()
+        sqlite_ids = []
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500].tolist()
+            placeholders = ','.join(['?' for _ in chunk])
+            cur.execute(f"SELECT id FROM listings WHERE id IN ({placeholders})", chunk)
+            sqlite_ids.extend(row[0] for row in cur.fetchall())
         cur.close()
+        in_sqlite = np.isin(ids, np.asarray(sqlite_ids, dtype="int64"))
+        verification_results['sqlite_found'] = int(in_sqlite.sum())
+        verification_results['missing_from_sqlite'] = ids[~in_sqlite].tolist()
+        
+        # Check FAISS (if it supports ID mapping) against the cached id -> offset map
+        if hasattr(holder.index, 'id_map'):
+            try:
+                found = holder.id_offsets().contains(ids)
+                verification_results['faiss_found'] = int(found.sum())
+                verification_results['missing_from_faiss'] = ids[~found].tolist()
+            except Exception as e:
+                verification_results['faiss_error'] = str(e)
+        
+        if verification_results['missing_from_sqlite'] or verification_results['missing_from_faiss']:
+            verification_results['alignment_verified'] = False
         
     except Exception as e:
         verification_results['error'] = str(e)
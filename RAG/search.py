@@ -1,49 +1,461 @@
 import faiss
+import os
+import re
 import numpy as np
-import requests
 import sqlite3
-from insertion import get_or_create_index, dim # Assuming dim is defined here
-
-def search(conn, query, max_price=None, min_beds=None, top_k=5):
-    # Step 1: Perform the full FAISS search first
-    index = get_or_create_index()
-    
-    # Embed the query
-    resp = requests.post("http://localhost:5000/embed", json={"text": query})
-    query_vec = np.array(resp.json()["embedding"], dtype="float32").reshape(1, -1)
-    
-    # Search the full FAISS index for a larger number of candidates
-    # We retrieve more than top_k to account for filtering
-    # For example, search for 20 candidates and then filter down to the best 5
-    search_k = top_k * 5
-    D, I = index.search(query_vec, search_k)
-
-    # Step 2: Retrieve the ID-text pairs for filtering
-    # Get the raw candidate data from the database using the hard filters
-    sql = "SELECT id FROM listings WHERE 1=1"
-    params = []
-    if max_price:
-        sql += " AND price_min <= ?"
-        params.append(max_price)
-    if min_beds:
-        sql += " AND beds >= ?"
-        params.append(min_beds)
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from insertion import get_index_holder
+from embedder import EMBEDDING_CACHE_ENABLED, get_embedder, lookup_cached_vectors
+from metadata_store import get_metadata_columns
+from index_factory import make_search_params, is_compressed
+from query_cache import QUERY_CACHE_ENABLED, get_query_cache, query_key
+from db import get_pool
+from shards import SHARD_SEARCH_WORKERS, existing_shards
 
+# Candidates fetched per result when the index is compressed, re-ranked exactly
+RERANK_FACTOR = int(os.environ.get("RERANK_FACTOR", "4"))
+
+# Hybrid search: candidates taken from each of the BM25 and vector rankings,
+# and the reciprocal rank fusion constant (score = sum of 1 / (RRF_K + rank))
+HYBRID_CANDIDATES = int(os.environ.get("HYBRID_CANDIDATES", "100"))
+# The lexical matches are scored alone, instead of searching the whole index,
+# when they are fewer than this fraction of the indexed listings
+HYBRID_SELECTIVE_FRACTION = float(os.environ.get("HYBRID_SELECTIVE_FRACTION", "0.05"))
+RRF_K = int(os.environ.get("RRF_K", "60"))
+
+# Original vectors of recently re-ranked listings kept per listing id, so
+# re-ranking does not hash every candidate's text into a cache key per query
+RERANK_ORIGINALS_SIZE = int(os.environ.get("RERANK_ORIGINALS_SIZE", "10000"))
+
+SEARCH_MODES = ("vector", "hybrid")
+
+# Index generation each shard's metadata mirror was last refreshed at
+_mirror_generations = {}
+_fts_token = re.compile(r"\w+")
+# (shard, listing id) -> (text, original vector), least recently used first
+_originals = OrderedDict()
+_originals_lock = threading.Lock()
+
+def get_valid_ids(conn, max_price=None, min_beds=None, min_baths=None, location=None, shard=None):
+    """Ids matching the hard filters, or None when no filter is set"""
+    if not max_price and not min_beds and not min_baths and not location:
+        return None
+
+    columns = get_metadata_columns(conn, shard)
+    generation = get_index_holder(shard).generation
+    if generation != _mirror_generations.get(shard):
+        # The index changed (possibly from another process): pull any newer rows
+        columns.refresh(conn)
+        _mirror_generations[shard] = generation
+    return columns.filter_ids(max_price, min_beds, min_baths, location)
+
+def fetch_listings(conn, ids):
+    """Hydrate all hit rows with one query, returned in the order of `ids`"""
+    if not ids:
+        return {}
+    placeholders = ','.join(['?' for _ in ids])
+    cur = conn.cursor()
+    cur.execute(f"SELECT * FROM listings WHERE id IN ({placeholders})", list(ids))
+    rows = {row[0]: row for row in cur.fetchall()}
+    cur.close()
+    return rows
+
+def expanding_search(index, query_vec, top_k, valid_ids=None, excluded=None):
+    """
+    Fallback for index types that cannot take an ID selector: search a
+    growing number of candidates until top_k of them pass the filter
+    """
+    valid_set = None if valid_ids is None else set(valid_ids.tolist())
+    excluded_set = set() if excluded is None else set(excluded.tolist())
+    search_k = top_k * 2
+    while True:
+        k = min(search_k, index.ntotal)
+        D, I = index.search(query_vec, k)
+        hits = [(dist, idx) for dist, idx in zip(D[0], I[0])
+                if idx != -1 and idx not in excluded_set and (valid_set is None or idx in valid_set)]
+        if len(hits) >= top_k or k >= index.ntotal:
+            break
+        search_k *= 4
+    hits = hits[:top_k]
+    return [float(dist) for dist, _ in hits], [int(idx) for _, idx in hits]
+
+def filtered_search_many(index, query_vecs, top_k, valid_ids=None, excluded=None):
+    """
+    Nearest neighbours of every row of query_vecs, restricted to valid_ids
+    (None means unfiltered) and skipping excluded (tombstoned) ids, with one
+    index.search over the whole matrix. The filter is pushed into FAISS as
+    an ID selector so exactly min(top_k, len(valid_ids)) hits come back
+    without over-fetching.
+    Returns one (distances, ids) pair of flat lists per query.
+    """
+    if excluded is not None and len(excluded) == 0:
+        excluded = None
+    if valid_ids is not None and excluded is not None:
+        valid_ids = np.setdiff1d(valid_ids, excluded, assume_unique=True)
+        excluded = None
+
+    if valid_ids is None and excluded is None:
+        k = min(top_k, index.ntotal)
+        if k == 0:
+            return [([], []) for _ in query_vecs]
+        D, I = index.search(query_vecs, k)
+    else:
+        if valid_ids is not None:
+            k = min(top_k, len(valid_ids), index.ntotal)
+        else:
+            k = min(top_k, index.ntotal - len(excluded))
+        if k <= 0:
+            return [([], []) for _ in query_vecs]
+        try:
+            if valid_ids is not None:
+                selector = faiss.IDSelectorBatch(valid_ids)
+            else:
+                selector = faiss.IDSelectorNot(faiss.IDSelectorBatch(excluded))
+            params = make_search_params(index, selector)
+            D, I = index.search(query_vecs, k, params=params)
+        except RuntimeError:
+            return [expanding_search(index, query_vecs[row:row + 1], k, valid_ids, excluded)
+                    for row in range(len(query_vecs))]
+
+    results = []
+    for distances, ids in zip(D, I):
+        # Selected ids missing from the index come back as -1
+        hits = [(float(dist), int(idx)) for dist, idx in zip(distances, ids) if idx != -1]
+        results.append(([dist for dist, _ in hits], [idx for _, idx in hits]))
+    return results
+
+def filtered_search(index, query_vec, top_k, valid_ids=None, excluded=None):
+    """Single-query filtered_search_many; returns (distances, ids) as flat lists"""
+    return filtered_search_many(index, query_vec, top_k, valid_ids, excluded)[0]
+
+def original_vectors(ids, texts, shard=None):
+    """
+    Original vectors of listings by id. Each entry remembers the text it was
+    embedded from, so an edited listing misses and is looked up again. Misses
+    come from the embedding cache, and the few missing from it are embedded
+    again in one batch (which caches them).
+    """
+    vectors, misses = {}, []
+    with _originals_lock:
+        for idx, text in zip(ids, texts):
+            entry = _originals.get((shard, idx))
+            if entry is not None and entry[0] == text:
+                _originals.move_to_end((shard, idx))
+                vectors[idx] = entry[1]
+            else:
+                misses.append((idx, text))
+    if not misses:
+        return vectors
+
+    wanted = list({text for _, text in misses})
+    found = lookup_cached_vectors(wanted)
+    missing = [text for text in wanted if text not in found]
+    if missing:
+        found.update(zip(missing, get_embedder().embed_texts(missing)))
+    with _originals_lock:
+        for idx, text in misses:
+            vectors[idx] = found[text]
+            _originals[(shard, idx)] = (text, found[text])
+            _originals.move_to_end((shard, idx))
+        while len(_originals) > RERANK_ORIGINALS_SIZE:
+            _originals.popitem(last=False)
+    return vectors
+
+def rerank_exact(query_vec, distances, ids, rows, shard=None):
+    """
+    Re-score candidates from a compressed index with exact L2 distances to
+    their original vectors, so every candidate is ranked by the same exact
+    distance. Candidates whose row is gone are dropped.
+    """
+    ids = [idx for idx in ids if idx in rows]
+    if not ids:
+        return [], []
+    originals = original_vectors(ids, [rows[idx][1] or "" for idx in ids], shard)
+    vectors = np.stack([originals[idx] for idx in ids]).astype("float32")
+    diffs = vectors - query_vec[0]
+    exact = np.einsum("ij,ij->i", diffs, diffs)
+    order = np.argsort(exact, kind="stable")
+    return [float(exact[pos]) for pos in order], [ids[pos] for pos in order]
+
+def reranks(index) -> bool:
+    """
+    Whether searches over-fetch and re-rank exactly: compressed indexes only,
+    and only with the embedding cache (without it every candidate would be
+    embedded again on every query)
+    """
+    return EMBEDDING_CACHE_ENABLED and is_compressed(index)
+
+def fts_query(query):
+    """FTS5 MATCH expression for free text: every word quoted (no operators), any may match"""
+    return " OR ".join(f'"{token}"' for token in _fts_token.findall(query))
+
+def lexical_search(conn, query, limit):
+    """Up to `limit` listing ids ranked by BM25 over the full-text index, best first"""
+    expression = fts_query(query)
+    if not expression:
+        return []
     cur = conn.cursor()
-    cur.execute(sql, params)
-    
-    # Convert candidates from a list of tuples to a set for fast lookups
-    valid_ids = {row[0] for row in cur.fetchall()}
+    try:
+        cur.execute(
+            "SELECT rowid FROM listings_fts WHERE listings_fts MATCH ? ORDER BY bm25(listings_fts) LIMIT ?",
+            (expression, limit)
+        )
+        return [row[0] for row in cur.fetchall()]
+    except sqlite3.OperationalError:
+        # No full-text index in this database
+        return []
+    finally:
+        cur.close()
+
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """[(id, score)] best first, from several rankings of ids"""
+    scores = {}
+    for ranking in rankings:
+        for rank, idx in enumerate(ranking):
+            scores[idx] = scores.get(idx, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+def run_hybrid_search(conn, query, max_price=None, min_beds=None, top_k=5, min_baths=None, location=None,
+                      shard=None, query_vec=None):
+    """
+    BM25 and vector candidates fused with reciprocal rank fusion. Exact names
+    ("West 22", a street) rank through BM25, paraphrases through the vectors.
+    When the lexical match set is a small fraction of the index, only those
+    listings are scored against the query vector instead of the whole index,
+    and if they give fewer than top_k hits the rest comes from a vector
+    search over every listing.
+    """
+    if query_vec is None:
+        query_vec = get_embedder().embed_text(query).reshape(1, -1)
+
+    # Step 1: Collect the ids that pass the hard filters, and the BM25 candidates among them
+    valid_ids = get_valid_ids(conn, max_price, min_beds, min_baths, location, shard)
+    lexical_ids = lexical_search(conn, query, HYBRID_CANDIDATES)
+    matched = len(lexical_ids)
+    if valid_ids is not None:
+        lexical_ids = [idx for idx, keep in zip(lexical_ids, np.isin(lexical_ids, valid_ids)) if keep]
+
+    # Step 2: Vector candidates, restricted to the lexical matches when they are few
+    holder = get_index_holder(shard)
+    fill_distances, fill_ids = [], []
+    with holder.read() as index:
+        selective = 0 < matched < min(HYBRID_CANDIDATES, HYBRID_SELECTIVE_FRACTION * index.ntotal)
+        if selective:
+            candidates = np.array(lexical_ids, dtype="int64")
+            distances, vector_ids = filtered_search(index, query_vec, len(candidates), candidates,
+                                                    holder.excluded_ids())
+            if len(set(lexical_ids) | set(vector_ids)) < top_k:
+                fill_distances, fill_ids = filtered_search(index, query_vec, top_k, valid_ids,
+                                                           holder.excluded_ids())
+        else:
+            distances, vector_ids = filtered_search(index, query_vec, max(top_k, HYBRID_CANDIDATES), valid_ids,
+                                                    holder.excluded_ids())
+
+    # Step 3: Fuse both rankings (then top up from the full vector search) and
+    # fetch the winners in one batched query
+    fused = reciprocal_rank_fusion([lexical_ids, vector_ids])[:top_k]
+    seen = {idx for idx, _ in fused}
+    for rank, idx in enumerate(fill_ids):
+        if len(fused) >= top_k:
+            break
+        if idx not in seen:
+            fused.append((idx, 1.0 / (RRF_K + rank + 1)))
+            seen.add(idx)
+    rows = fetch_listings(conn, [idx for idx, _ in fused])
+    vector_distance = dict(zip(fill_ids, fill_distances))
+    vector_distance.update(zip(vector_ids, distances))
+
+    results = []
+    for idx, score in fused:
+        row = rows.get(idx)
+        if row is not None:
+            distance = vector_distance.get(idx)
+            results.append({"distance": None if distance is None else float(distance),
+                            "score": score, "listing": row})
+    return results
+
+def index_generation(shard=None):
+    """Generation of the shared index after picking up other processes' writes"""
+    holder = get_index_holder(shard)
+    holder.refresh()
+    return holder.generation
+
+def search(conn, query, max_price=None, min_beds=None, top_k=5, min_baths=None, location=None, mode="vector",
+           shard=None, query_vec=None):
+    """
+    Cached front of run_search (mode="vector") and run_hybrid_search
+    (mode="hybrid"): repeated searches skip embedding, FAISS and SQLite.
+    shard is the campus whose database `conn` belongs to (None for the
+    default store); query_vec is the query's embedding when already known.
+    """
+    runner = run_hybrid_search if mode == "hybrid" else run_search
+    if not QUERY_CACHE_ENABLED:
+        return runner(conn, query, max_price, min_beds, top_k, min_baths, location, shard, query_vec)
+
+    start = time.perf_counter()
+    cache = get_query_cache(shard)
+    key = query_key(query, max_price, min_beds, top_k, min_baths, location, mode)
+    generation = index_generation(shard)
+    results = cache.get(key, generation)
+    if results is None:
+        results = runner(conn, query, max_price, min_beds, top_k, min_baths, location, shard, query_vec)
+        cache.put(key, generation, results)
+        cache.record_latency(False, time.perf_counter() - start)
+    else:
+        cache.record_latency(True, time.perf_counter() - start)
+    return results
+
+def run_search(conn, query, max_price=None, min_beds=None, top_k=5, min_baths=None, location=None,
+               shard=None, query_vec=None):
+    # Embed the query (in-process by default, no HTTP round trip)
+    if query_vec is None:
+        query_vec = get_embedder().embed_text(query).reshape(1, -1)
+
+    # Step 1: Collect the ids that pass the hard filters (vectorized, in memory)
+    valid_ids = get_valid_ids(conn, max_price, min_beds, min_baths, location, shard)
+
+    # Step 2: Search only among those ids on the shared in-memory index
+    # (a compressed index returns extra candidates for exact re-ranking)
+    holder = get_index_holder(shard)
+    with holder.read() as index:
+        rerank = reranks(index)
+        fetch_k = top_k * RERANK_FACTOR if rerank else top_k
+        distances, ids = filtered_search(index, query_vec, fetch_k, valid_ids, holder.excluded_ids())
+
+    # Step 3: Fetch the matching listings in one batched query
+    rows = fetch_listings(conn, ids)
+    if rerank:
+        distances, ids = rerank_exact(query_vec, distances, ids, rows, shard)
+        distances, ids = distances[:top_k], ids[:top_k]
 
-    # Step 3: Post-filter the FAISS results
     results = []
-    for dist, idx in zip(D[0], I[0]):
-        # Check if the FAISS result ID is in our list of valid database candidates
-        if idx in valid_ids:
-            cur.execute("SELECT * FROM listings WHERE id=?", (int(idx),))
-            results.append({"distance": float(dist), "listing": cur.fetchone()})
-            if len(results) >= top_k:
-                break # Stop once we have our desired number of results
+    for dist, idx in zip(distances, ids):
+        row = rows.get(idx)
+        if row is not None:
+            results.append({"distance": float(dist), "listing": row})
 
     return results
 
+def search_many(conn, queries, shard=None):
+    """
+    Run several searches at the cost of about one. queries is a list of dicts
+    with the search() arguments ("query" plus optional max_price, min_beds,
+    min_baths, location and top_k). All queries are embedded in one batched
+    call, queries sharing the same filters go through one index.search over
+    their stacked vectors, and every hit is hydrated with one SQLite query.
+    Returns one result list per query, in order.
+    """
+    if not queries:
+        return []
+    if not QUERY_CACHE_ENABLED:
+        return run_search_many(conn, queries, shard)
+
+    # Answer what the result cache can, then run the rest as one batch
+    start = time.perf_counter()
+    cache = get_query_cache(shard)
+    generation = index_generation(shard)
+    keys = [query_key(q["query"], q.get("max_price"), q.get("min_beds"), q.get("top_k", 5),
+                      q.get("min_baths"), q.get("location")) for q in queries]
+    all_results = [cache.get(key, generation) for key in keys]
+    missing = [pos for pos, results in enumerate(all_results) if results is None]
+    if missing:
+        computed = run_search_many(conn, [queries[pos] for pos in missing], shard)
+        for pos, results in zip(missing, computed):
+            all_results[pos] = results
+            cache.put(keys[pos], generation, results)
+    elapsed = (time.perf_counter() - start) / len(queries)
+    computed_positions = set(missing)
+    for pos in range(len(queries)):
+        cache.record_latency(pos not in computed_positions, elapsed)
+    return all_results
+
+def run_search_many(conn, queries, shard=None):
+    """Uncached search_many: one embed call, stacked index searches, one hydration query"""
+    # Embed every query in one batch
+    query_vecs = get_embedder().embed_texts([q["query"] for q in queries])
+    query_vecs = np.ascontiguousarray(query_vecs, dtype="float32")
+
+    # Step 1: Group queries by filter so each group shares one selector
+    groups = {}
+    for pos, q in enumerate(queries):
+        key = (q.get("max_price"), q.get("min_beds"), q.get("min_baths"), q.get("location"))
+        groups.setdefault(key, []).append(pos)
+
+    # Step 2: One stacked search per filter group on the shared index
+    hits = [None] * len(queries)
+    holder = get_index_holder(shard)
+    with holder.read() as index:
+        rerank = reranks(index)
+        for key, positions in groups.items():
+            valid_ids = get_valid_ids(conn, *key, shard=shard)
+            top_k = max(int(queries[pos].get("top_k", 5)) for pos in positions)
+            fetch_k = top_k * RERANK_FACTOR if rerank else top_k
+            group_hits = filtered_search_many(index, query_vecs[positions], fetch_k, valid_ids,
+                                               holder.excluded_ids())
+            for pos, pair in zip(positions, group_hits):
+                hits[pos] = pair
+
+    # Step 3: Hydrate the hits of every query in one batched query
+    rows = fetch_listings(conn, sorted({idx for _, ids in hits for idx in ids}))
+
+    all_results = []
+    for pos, (distances, ids) in enumerate(hits):
+        top_k = int(queries[pos].get("top_k", 5))
+        if rerank:
+            distances, ids = rerank_exact(query_vecs[pos:pos + 1], distances, ids, rows, shard)
+        results = []
+        for dist, idx in zip(distances, ids):
+            row = rows.get(idx)
+            if row is not None:
+                results.append({"distance": float(dist), "listing": row})
+            if len(results) == top_k:
+                break
+        all_results.append(results)
+    return all_results
+
+_shard_executor = None
+_shard_executor_lock = threading.Lock()
+
+def get_shard_executor():
+    """Thread pool the per-shard searches of search_shards run on"""
+    global _shard_executor
+    if _shard_executor is None:
+        with _shard_executor_lock:
+            if _shard_executor is None:
+                _shard_executor = ThreadPoolExecutor(max_workers=SHARD_SEARCH_WORKERS,
+                                                     thread_name_prefix="shard-search")
+    return _shard_executor
+
+def search_shards(shards, query, max_price=None, min_beds=None, top_k=5, min_baths=None, location=None,
+                  mode="vector"):
+    """
+    Cross-campus search: the query is embedded once, every shard is searched
+    in parallel (each with its own pooled connection and cached search), and
+    the per-shard top_k lists are merged into one global top_k, by distance
+    (mode="vector") or fused score (mode="hybrid"). Each result carries the
+    "campus" it came from. Shards never created are skipped rather than
+    opened, which would create their database and index files.
+    """
+    shards = existing_shards(shards)
+    if not shards:
+        return []
+    query_vec = get_embedder().embed_text(query).reshape(1, -1)
+
+    def search_shard(shard):
+        with get_pool(shard).connection() as conn:
+            results = search(conn, query, max_price, min_beds, top_k, min_baths, location, mode, shard, query_vec)
+        # Cached result lists are shared, so tag copies
+        return [dict(result, campus=shard) for result in results]
+
+    if len(shards) == 1:
+        merged = search_shard(shards[0])
+    else:
+        merged = [result for results in get_shard_executor().map(search_shard, shards) for result in results]
+    if mode == "hybrid":
+        merged.sort(key=lambda result: result["score"], reverse=True)
+    else:
+        merged.sort(key=lambda result: result["distance"])
+    return merged[:top_k]
@@ -0,0 +1,89 @@
+import os
+from typing import List, Optional
+
+# Per-campus shards: each campus has its own SQLite file and FAISS index under
+# SHARD_DIR. The unsharded store (uga.db + faiss_listings_index.idx) remains
+# the default shard, used whenever no campus is given.
+CAMPUSES = ("FIU", "FSU", "GSU", "GT", "KSU", "UGA")
+SHARD_DIR = os.environ.get("SHARD_DIR", "shards")
+# Threads used to search shards in parallel (FAISS releases the GIL)
+SHARD_SEARCH_WORKERS = int(os.environ.get("SHARD_SEARCH_WORKERS", str(len(CAMPUSES))))
+
+def normalize_campus(campus: Optional[str]) -> Optional[str]:
+    """Canonical shard name for a campus, None for the default shard"""
+    if campus is None or campus == "":
+        return None
+    name = str(campus).strip().upper()
+    if name not in CAMPUSES:
+        raise ValueError(f"Unknown campus {campus!r}, expected one of {', '.join(CAMPUSES)}")
+    return name
+
+def resolve_campuses(campus) -> List[str]:
+    """Shards a cross-campus search fans out to: "all" or a list of campuses"""
+    if campus == "all":
+        return list(CAMPUSES)
+    if isinstance(campus, str):
+        return [normalize_campus(campus)]
+    return list(dict.fromkeys(normalize_campus(name) for name in campus))
+
+def _shard_db_file(shard: str) -> str:
+    return os.path.join(SHARD_DIR, f"{shard.lower()}.db")
+
+def shard_db_path(shard: Optional[str], default: str) -> str:
+    if shard is None:
+        return default
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    return _shard_db_file(shard)
+
+def existing_shards(shards: List[str]) -> List[str]:
+    """The shards whose database has been created, checked without creating anything"""
+    return [shard for shard in shards if os.path.exists(_shard_db_file(shard))]
+
+def shard_index_file(shard: Optional[str], default: str) -> str:
+    if shard is None:
+        return default
+    os.makedirs(SHARD_DIR, exist_ok=True)
+    return os.path.join(SHARD_DIR, f"faiss_{shard.lower()}_index.idx")
+
+def campus_of(path: str) -> Optional[str]:
+    """Campus of a dataFiles/<CAMPUS>.json file, None if the name is not a campus"""
+    name = os.path.splitext(os.path.basename(path))[0].upper()
+    return name if name in CAMPUSES else None
+
+def load_campus_file(path: str, campus: Optional[str] = None) -> List[int]:
+    """Bulk load a dataFiles JSON export into its campus shard (named after the file by default)"""
+    # Imported here: db imports this module
+    import json
+    from db import get_pool
+    from safeInsertion import safe_batch_insert_listings
+
+    shard = normalize_campus(campus) if campus else campus_of(path)
+    if shard is None:
+        raise ValueError(f"Cannot tell the campus of {path}, pass it explicitly")
+    with open(path, encoding="utf-8") as f:
+        posts = [post for post in json.load(f) if isinstance(post, dict) and post.get("text")]
+    listings_data = [
+        {"text": post["text"],
+         "user_id": (post.get("user") or {}).get("id", ""),
+         "user_name": (post.get("user") or {}).get("name", "")}
+        for post in posts
+    ]
+    with get_pool(shard).connection() as conn:
+        return safe_batch_insert_listings(conn, listings_data, shard=shard)
+
+# CLI interface
+if __name__ == "__main__":
+    import sys
+    # Usage: python shards.py load ../dataFiles/FIU.json [../dataFiles/GT.json ...] [--campus FIU]
+    if len(sys.argv) < 3 or sys.argv[1] != "load":
+        print("Usage: python shards.py load <dataFiles/CAMPUS.json> [...] [--campus CAMPUS]")
+        sys.exit(1)
+    paths = sys.argv[2:]
+    campus = None
+    if "--campus" in paths:
+        position = paths.index("--campus")
+        campus = paths[position + 1]
+        paths = paths[:position] + paths[position + 2:]
+    for path in paths:
+        ids = load_campus_file(path, campus)
+        print(f"{path}: {len(ids)} listings")
@@ -14,6 +14,17 @@ def test_embed_single():
     assert isinstance(data["embedding"], list)
     assert all(isinstance(x, float) for x in data["embedding"])
 
+def test_embed_batch_binary():
+    url = f"{BASE_URL}/embeds"
+    payload = {"texts": ["Hello, world!", "2 bedroom near campus"]}
+    response = requests.post(url, json=payload, headers={"Accept": "application/octet-stream"})
+
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "application/octet-stream"
+    rows, cols = (int(n) for n in response.headers["X-Embedding-Shape"].split(","))
+    assert rows == 2
+    assert len(response.content) == rows * cols * 4
+
 def test_single_insertion():
     url = f"{BASE_URL}/insert"
     payload = {
@@ -28,6 +39,17 @@ def test_single_insertion():
     assert "id" in data
     assert isinstance(data["id"], int)
 
+def test_update_and_delete():
+    response = requests.post(f"{BASE_URL}/insert", json={"text": "Sublease 1 bed $700", "user_id": "123", "user_name": "Test User"})
+    row_id = response.json()["id"]
+
+    response = requests.post(f"{BASE_URL}/update", json={"id": row_id, "text": "Sublease 1 bed $650"})
+    assert response.status_code == 200
+
+    response = requests.post(f"{BASE_URL}/delete", json={"ids": [row_id]})
+    assert response.status_code == 200
+    assert response.json()["deleted_ids"] == [row_id]
+
 def test_batch_insertion():
     url = f"{BASE_URL}/batchInsertion"
     with open("UGA.json", "r") as f:
@@ -57,6 +79,21 @@ def test_search():
     # Pretty-print the JSON data with an indentation of 4 spaces
     pretty_json_string = json.dumps(data, indent=4)
     print(pretty_json_string)
+
+def test_search_batch():
+    url = f"{BASE_URL}/searches"
+    payload = {
+        "queries": [
+            {"query": "Looking for a 2 bedroom apartment under $1500", "max_price": 1500, "min_beds": 2, "top_k": 3},
+            {"query": "Studio close to campus", "top_k": 2},
+        ]
+    }
+    response = requests.post(url, json=payload)
+
+    assert response.status_code == 200
+    data = response.json()
+    assert len(data["results"]) == 2
+    assert len(data["results"][1]) <= 2
 if __name__ == "__main__":  
     #test_single_insertion()
     #test_batch_insertion()
@@ -0,0 +1,70 @@
+import re
+from corpus import load_texts
+from extraction import extract_location, extract_metadata, extract_metadata_batch
+
+# The original one-pattern-at-a-time implementation, kept as the reference
+def legacy_extract_location(text):
+    address_match = re.search(r'\d{1,5}\s[\w\s]+,\s*\w+,\s*[A-Z]{2}\s*\d{5}', text)
+    if address_match:
+        return address_match.group(0)
+
+    complex_match = re.search(r'(?:The\s)?[A-Z][A-Za-z0-9&\-\']+(?:\s[A-Z][A-Za-z0-9&\-\']+){0,4}', text)
+    if complex_match:
+        return complex_match.group(0)
+
+    city_uni_match = re.search(r'(Tallahassee|Athens|Tampa|College Town|FSU|UGA|USF)', text, re.IGNORECASE)
+    if city_uni_match:
+        return city_uni_match.group(0)
+
+    return None
+
+def legacy_extract_metadata(text):
+    bedrooms, bathrooms, location, min_price, max_price = None, None, None, None, None
+
+    br_match = re.search(r'(\d+)\s*(?:BR|Bed|Beds|Bedroom|Bedrooms)', text, re.IGNORECASE)
+    if br_match:
+        bedrooms = int(br_match.group(1))
+
+    ba_match = re.search(r'(\d+(\.\d+)?)\s*(?:BA|Bath|Baths|Bathroom|Bathrooms)', text, re.IGNORECASE)
+    if ba_match:
+        bathrooms = float(ba_match.group(1))
+
+    location = legacy_extract_location(text)
+
+    prices = re.findall(r'\$([0-9]+(?:,[0-9]{3})*(?:\.\d{1,2})?)', text)
+    prices = [float(p.replace(",", "")) for p in prices]
+    if prices:
+        if len(prices) == 1:
+            min_price = 0
+            max_price = prices[0]
+        else:
+            min_price = min(prices)
+            max_price = max(prices)
+
+    return min_price, max_price, bedrooms, bathrooms, location
+
+EDGE_CASES = [
+    "",
+    "2 Bed 2 Bath at The Standard, $850/month",
+    "2.5 Bed 1.5 Bath",
+    "$1,200 Beds available, 3 baths",
+    "$12.50 Bath fee, 4BR",
+    "3bedroom 2ba 🔥🔥 $700-$750 utilities included",
+    "sublease near uga, 1 br",
+    "123 Main St Apt 4, Athens, GA 30605 - 2 bedrooms",
+    "no numbers here at all",
+    "🏠🏠🏠 " * 50 + "Room at West 22 for $900",
+]
+
+def test_parity_with_legacy_extraction():
+    texts = load_texts() + EDGE_CASES
+    assert len(texts) > len(EDGE_CASES)
+    for text in texts:
+        assert extract_metadata(text) == legacy_extract_metadata(text), text[:80]
+        assert extract_location(text) == legacy_extract_location(text), text[:80]
+
+def test_batch_matches_single():
+    texts = load_texts()[:300] + EDGE_CASES
+    assert extract_metadata_batch(texts, workers=1) == [extract_metadata(text) for text in texts]
+    # Forced through the process pool
+    assert extract_metadata_batch(texts, workers=2, chunksize=64, min_parallel=1) == [extract_metadata(text) for text in texts]
@@ -0,0 +1,138 @@
+import threading
+import faiss
+import numpy as np
+
+from index_log import IndexLog
+from index_store import IndexHolder
+from index_tools import install_index, read_current_index
+
+DIM = 8
+
+def make_holder(index_file):
+    """A holder over `index_file` with its own log handle, like a separate process"""
+    def load_snapshot():
+        try:
+            return faiss.read_index(index_file)
+        except RuntimeError:
+            return faiss.IndexIDMap(faiss.IndexFlatL2(DIM))
+    return IndexHolder(load_snapshot, IndexLog(index_file), check_interval=0)
+
+def add(holder, *ids):
+    vectors = np.random.default_rng(ids[0]).random((len(ids), DIM), dtype="float32")
+    holder.add(vectors, np.array(ids, dtype="int64"))
+
+def stored_ids(holder):
+    with holder.read() as index:
+        return sorted(faiss.vector_to_array(index.id_map).tolist())
+
+def test_append_after_another_writer_snapshots(tmp_path):
+    index_file = str(tmp_path / "index.idx")
+    a, b = make_holder(index_file), make_holder(index_file)
+
+    add(b, 1, 2)
+    add(a, 3, 4)
+    a.snapshot()
+    add(b, 5, 6)
+
+    assert stored_ids(b) == [1, 2, 3, 4, 5, 6]
+    assert stored_ids(a) == [1, 2, 3, 4, 5, 6]
+    assert stored_ids(make_holder(index_file)) == [1, 2, 3, 4, 5, 6]
+
+def test_snapshots_from_both_writers(tmp_path):
+    index_file = str(tmp_path / "index.idx")
+    a, b = make_holder(index_file), make_holder(index_file)
+
+    add(a, 1)
+    a.snapshot()
+    add(b, 2)
+    add(a, 3)
+    b.snapshot()
+    add(a, 4)
+    b.remove(np.array([1], dtype="int64"))
+
+    assert stored_ids(make_holder(index_file)) == [2, 3, 4]
+    assert stored_ids(a) == [2, 3, 4]
+
+def test_concurrent_appends_and_snapshots(tmp_path):
+    index_file = str(tmp_path / "index.idx")
+    a, b = make_holder(index_file), make_holder(index_file)
+
+    def snapshot_loop():
+        for _ in range(20):
+            a.snapshot()
+
+    thread = threading.Thread(target=snapshot_loop)
+    thread.start()
+    for i in range(1, 201):
+        add(b, i)
+    thread.join()
+
+    assert stored_ids(make_holder(index_file)) == list(range(1, 201))
+
+def test_install_keeps_records_logged_during_rebuild(tmp_path):
+    index_file = str(tmp_path / "index.idx")
+    service = make_holder(index_file)
+    service.snapshot()
+    add(service, 1, 2, 3)
+
+    current, read_position = read_current_index(index_file)
+    add(service, 4, 5)
+    assert install_index(faiss.clone_index(current), index_file, read_position)
+    add(service, 6)
+
+    assert stored_ids(service) == [1, 2, 3, 4, 5, 6]
+    assert stored_ids(make_holder(index_file)) == [1, 2, 3, 4, 5, 6]
+
+def test_install_refuses_after_concurrent_snapshot(tmp_path):
+    index_file = str(tmp_path / "index.idx")
+    service = make_holder(index_file)
+    service.snapshot()
+    add(service, 1)
+
+    current, read_position = read_current_index(index_file)
+    add(service, 2)
+    service.snapshot()
+    assert not install_index(current, index_file, read_position)
+    assert stored_ids(make_holder(index_file)) == [1, 2]
+
+def test_tombstones_survive_restart_and_snapshot(tmp_path):
+    index_file = str(tmp_path / "index.idx")
+    a, b = make_holder(index_file), make_holder(index_file)
+    add(a, 1, 2, 3, 4)
+    a.tombstone([2, 3])
+
+    b.refresh(force=True)
+    assert b.tombstones == {2, 3}
+    assert make_holder(index_file).tombstones == {2, 3}
+
+    a.snapshot()
+    add(a, 3)
+    restarted = make_holder(index_file)
+    assert restarted.tombstones == {2}
+    assert restarted.compact() == 1
+    assert make_holder(index_file).tombstones == set()
+    assert stored_ids(make_holder(index_file)) == [1, 3, 4]
+
+def test_repair_waits_for_appends_in_progress(tmp_path):
+    index_file = str(tmp_path / "index.idx")
+    writer, starting = make_holder(index_file), IndexLog(index_file)
+    add(writer, 1)
+
+    # The bytes of a second record, written in two halves as another process would
+    scratch = IndexLog(str(tmp_path / "scratch.idx"))
+    scratch.append_add(np.array([2], dtype="int64"), np.ones((1, DIM), dtype="float32"))
+    with open(scratch.path, "rb") as f:
+        record = f.read()
+
+    repaired = threading.Event()
+    with writer.log.locked(exclusive=False):
+        with open(writer.log.path, "ab") as f:
+            f.write(record[:5])
+        thread = threading.Thread(target=lambda: (starting.repair(), repaired.set()))
+        thread.start()
+        assert not repaired.wait(0.2)
+        with open(writer.log.path, "ab") as f:
+            f.write(record[5:])
+    thread.join()
+
+    assert stored_ids(make_holder(index_file)) == [1, 2]
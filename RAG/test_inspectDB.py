@@ -0,0 +1,52 @@
+import zlib
+import numpy as np
+import pytest
+
+from db import DB_PATH, get_pool
+from embedder import Embedder, dim, set_embedder
+import insertion
+from insertion import batch_insert_listings, get_index_holder, index_file, insert_listing
+from inspectDB import DatabaseInspector
+from shards import shard_db_path, shard_index_file
+
+SHARD = "GT"
+
+class StubEmbedder(Embedder):
+    """Deterministic vectors, so no model is needed"""
+    name = "stub"
+
+    def embed_texts(self, texts):
+        return np.stack([np.random.default_rng(zlib.crc32(text.encode())).random(dim, dtype="float32")
+                         for text in texts])
+
+def test_consistency_sees_logged_inserts(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    set_embedder(StubEmbedder())
+    with get_pool(SHARD).connection() as conn:
+        batch_insert_listings(conn, [
+            {"text": "2 bed 2 bath at The Standard, $850/month", "user_id": "u1", "user_name": "A"},
+            {"text": "Studio sublease near campus for the summer", "user_id": "u2", "user_name": "B"},
+        ], shard=SHARD)
+        get_index_holder(SHARD).snapshot()
+        # Only in the mutation log, not in the snapshot
+        row_id = insert_listing(conn, "Room at West 22 for $900, utilities included", "u3", "C", shard=SHARD)
+
+    inspector = DatabaseInspector(shard_db_path(SHARD, DB_PATH), shard_index_file(SHARD, index_file))
+    report = inspector.check_consistency()
+    assert report['sqlite_count'] == report['faiss_count'] == 3
+    assert report['consistency_ok'], report
+    assert 'internal_index' in inspector.search_by_id(row_id)['faiss_data']
+
+def test_failed_insert_leaves_no_vector(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    set_embedder(StubEmbedder())
+
+    def fail(*args):
+        raise RuntimeError("dedup store unavailable")
+    monkeypatch.setattr(insertion, "remember_listings", fail)
+    with get_pool("FSU").connection() as conn:
+        with pytest.raises(RuntimeError):
+            insert_listing(conn, "Room at West 22 for $900, utilities included", "u3", "C", shard="FSU")
+
+    report = DatabaseInspector(shard_db_path("FSU", DB_PATH), shard_index_file("FSU", index_file)).check_consistency()
+    assert report['sqlite_count'] == report['faiss_count'] == 0
@@ -0,0 +1,40 @@
+import os
+import numpy as np
+import pytest
+
+pytest.importorskip("onnxruntime")
+pytest.importorskip("tokenizers")
+pytest.importorskip("sentence_transformers")
+
+from embedder import MODEL_NAME
+from onnx_backend import ONNX_MODEL_DIR, VARIANT_FILES, OnnxModel, export_model
+from corpus import load_texts
+from test_extraction import EDGE_CASES
+
+@pytest.fixture(scope="module")
+def model_dir(tmp_path_factory):
+    """The exported model in ONNX_MODEL_DIR, or a fresh export"""
+    if all(os.path.exists(os.path.join(ONNX_MODEL_DIR, name)) for name in VARIANT_FILES.values()):
+        return ONNX_MODEL_DIR
+    out_dir = str(tmp_path_factory.mktemp("onnx_model"))
+    try:
+        export_model(MODEL_NAME, out_dir)
+    except OSError as e:
+        pytest.skip(f"model files not available: {e}")
+    return out_dir
+
+@pytest.fixture(scope="module")
+def reference():
+    from sentence_transformers import SentenceTransformer
+    texts = load_texts()[:200] + [text for text in EDGE_CASES if text]
+    return texts, np.asarray(SentenceTransformer(MODEL_NAME, device="cpu").encode(texts), dtype="float32")
+
+@pytest.mark.parametrize("variant", sorted(VARIANT_FILES))
+def test_parity_with_pytorch(model_dir, reference, variant):
+    texts, expected = reference
+    vectors = OnnxModel(model_dir, variant).encode(texts)
+    assert vectors.shape == expected.shape
+    cosine = (vectors * expected).sum(axis=1) / (
+        np.linalg.norm(vectors, axis=1) * np.linalg.norm(expected, axis=1)
+    )
+    assert cosine.min() >= 0.99, texts[int(cosine.argmin())][:80]
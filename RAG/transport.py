@@ -0,0 +1,97 @@
+import base64
+import io
+import json
+import numpy as np
+from typing import Dict, Optional, Tuple
+
+# Wire formats for embedding responses
+# - json:   {"embedding": [float, ...]} (default, what older clients expect)
+# - f32:    raw little-endian float32 bytes, shape in the X-Embedding-Shape header
+# - npy:    a complete .npy file (shape and dtype are in the npy header)
+# - base64: {"embedding": "<base64 of raw float32>", "shape": [...], "dtype": "<f4"}
+JSON_MIMETYPE = "application/json"
+F32_MIMETYPE = "application/octet-stream"
+NPY_MIMETYPE = "application/x-npy"
+BASE64_MIMETYPE = "application/vnd.embeddings+base64"
+
+MIMETYPE_FORMATS = {
+    JSON_MIMETYPE: "json",
+    F32_MIMETYPE: "f32",
+    NPY_MIMETYPE: "npy",
+    BASE64_MIMETYPE: "base64",
+}
+FORMAT_MIMETYPES = {fmt: mimetype for mimetype, fmt in MIMETYPE_FORMATS.items()}
+
+SHAPE_HEADER = "X-Embedding-Shape"
+DTYPE_HEADER = "X-Embedding-Dtype"
+WIRE_DTYPE = "<f4"
+
+def negotiate_format(accept_mimetypes=None, requested: Optional[str] = None) -> str:
+    """
+    Pick the response format for an embedding request.
+    An explicit format name (?format=npy or "format" in the body) wins,
+    otherwise the Accept header is matched, with JSON as the default.
+    """
+    if requested:
+        if requested not in FORMAT_MIMETYPES:
+            raise ValueError(f"Unsupported embedding format: {requested}")
+        return requested
+
+    if accept_mimetypes is not None:
+        # JSON is listed first so that "*/*" (requests' default) keeps the old behaviour
+        best = accept_mimetypes.best_match(list(MIMETYPE_FORMATS), default=JSON_MIMETYPE)
+        return MIMETYPE_FORMATS.get(best, "json")
+    return "json"
+
+def encode_embeddings(vectors, fmt: str, key: str) -> Tuple[bytes, str, Dict[str, str]]:
+    """
+    Serialize embeddings for the wire.
+    Returns (body, content_type, extra_headers). `key` is the JSON field name
+    ("embedding" for /embed, "embeddings" for /embeds).
+    """
+    array = np.ascontiguousarray(vectors, dtype=WIRE_DTYPE)
+    shape_value = ",".join(str(n) for n in array.shape)
+
+    if fmt == "json":
+        body = json.dumps({key: array.tolist()}).encode("utf-8")
+        return body, JSON_MIMETYPE, {}
+
+    if fmt == "f32":
+        headers = {SHAPE_HEADER: shape_value, DTYPE_HEADER: WIRE_DTYPE}
+        return array.tobytes(), F32_MIMETYPE, headers
+
+    if fmt == "npy":
+        buffer = io.BytesIO()
+        np.save(buffer, array, allow_pickle=False)
+        return buffer.getvalue(), NPY_MIMETYPE, {}
+
+    if fmt == "base64":
+        payload = {
+            key: base64.b64encode(array.tobytes()).decode("ascii"),
+            "shape": list(array.shape),
+            "dtype": WIRE_DTYPE,
+        }
+        return json.dumps(payload).encode("utf-8"), BASE64_MIMETYPE, {}
+
+    raise ValueError(f"Unsupported embedding format: {fmt}")
+
+def decode_embeddings(body: bytes, content_type: str, headers, key: str) -> np.ndarray:
+    """Inverse of encode_embeddings, always returns native float32"""
+    mimetype = (content_type or JSON_MIMETYPE).split(";")[0].strip()
+
+    if mimetype == F32_MIMETYPE:
+        shape = tuple(int(n) for n in headers[SHAPE_HEADER].split(",") if n)
+        dtype = headers.get(DTYPE_HEADER, WIRE_DTYPE)
+        return np.frombuffer(body, dtype=dtype).reshape(shape).astype("float32")
+
+    if mimetype == NPY_MIMETYPE:
+        array = np.load(io.BytesIO(body), allow_pickle=False)
+        return array.astype("float32", copy=False)
+
+    payload = json.loads(body)
+    if mimetype == BASE64_MIMETYPE:
+        raw = base64.b64decode(payload[key])
+        dtype = payload.get("dtype", WIRE_DTYPE)
+        return np.frombuffer(raw, dtype=dtype).reshape(payload["shape"]).astype("float32")
+
+    return np.array(payload[key], dtype="float32")